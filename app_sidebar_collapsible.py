@@ -14,18 +14,33 @@ from datetime import date, timedelta
 
 import dash
 import dash_bootstrap_components as dbc
-from dash import Input, Output, dcc, html, Dash
+from dash import Input, Output, State, dcc, html, Dash
+from dash.exceptions import PreventUpdate
 import dash_auth
 import logging
 # Set the logging right at the top to make sure that debug
 # logs are displayed in dev mode
 # until https://github.com/plotly/dash/issues/532 is fixed
-if os.getenv('DASH_DEBUG_MODE', 'True').lower() == 'true':
+if os.getenv('DASH_DEBUG_MODE', 'False').lower() == 'true':
     logging.basicConfig(level=logging.DEBUG)
 
+# imported before anything that connects to the database, see utils/instrumentation.py
+# and utils/mongo_utils.py
+from utils.instrumentation import init_instrumentation
+from utils.mongo_utils import configure_connection_pool
+configure_connection_pool()
+from utils.http_utils import init_compression, init_static_caching
+from utils.export_utils import init_export
+from utils.admission_utils import init_admission, ServerBusy, BUSY_MESSAGE
+from utils.warmup import init_health_checks, warmup_process, warmup_caches
 from utils.db_utils import query_uuids, query_confirmed_trips, query_demographics
+from utils.db_utils import count_confirmed_trips, query_trip_aggregates, COARSE_TRIPS_THRESHOLD
+from utils.db_utils import query_confirmed_trips_in_region, REGION_TRIPS_LIMIT
+from utils.loader_utils import run_loaders
+from utils.store_utils import encode_frame, encode_frames, encode_aggregates
 from utils.permissions import has_permission
 import flask_talisman as flt
+from pymongo.errors import OperationFailure
 
 
 
@@ -52,77 +67,80 @@ if auth_type == 'basic':
     )
 
 
-sidebar = html.Div(
-    [
-        html.Div(
-            [
-                # width: 3rem ensures the logo is the exact width of the
-                # collapsed sidebar (accounting for padding)
-                html.Img(src=OPENPATH_LOGO, style={"width": "3rem"}),
-                html.H2("OpenPATH"),
-            ],
-            className="sidebar-header",
-        ),
-        html.Hr(),
-        dbc.Nav(
-            [
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-home me-2"), 
-                        html.Span("Overview")
-                    ],
-                    href=dash.get_relative_path("/"),
-                    active="exact",
-                ),
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-sharp fa-solid fa-database me-2"),
-                        html.Span("Data"),
-                    ],
-                    href=dash.get_relative_path("/data"),
-                    active="exact",
-                ),
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-solid fa-right-to-bracket me-2"),
-                        html.Span("Tokens"),
-                    ],
-                    href=dash.get_relative_path("/tokens"),
-                    active="exact",
-                    style={'display': 'block' if has_permission('token_generate') else 'none'},
-                ),
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-solid fa-globe me-2"),
-                        html.Span("Map"),
-                    ],
-                    href=dash.get_relative_path("/map"),
-                    active="exact",
-                ),
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-solid fa-envelope-open-text me-2"),
-                        html.Span("Push notification"),
-                    ],
-                    href=dash.get_relative_path("/push_notification"),
-                    active="exact",
-                    style={'display': 'block' if has_permission('push_send') else 'none'},
-                ),
-                dbc.NavLink(
-                    [
-                        html.I(className="fas fa-gear me-2"),
-                        html.Span("Settings"),
-                    ],
-                    href=dash.get_relative_path("/settings"),
-                    active="exact",
-                )
-            ],
-            vertical=True,
-            pills=True,
-        ),
-    ],
-    className="sidebar",
-)
+# The sidebar depends on the permissions, so it is built on the first page load
+# (the config is fetched over HTTP) instead of at import time
+def get_sidebar():
+    return html.Div(
+        [
+            html.Div(
+                [
+                    # width: 3rem ensures the logo is the exact width of the
+                    # collapsed sidebar (accounting for padding)
+                    html.Img(src=OPENPATH_LOGO, style={"width": "3rem"}),
+                    html.H2("OpenPATH"),
+                ],
+                className="sidebar-header",
+            ),
+            html.Hr(),
+            dbc.Nav(
+                [
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-home me-2"), 
+                            html.Span("Overview")
+                        ],
+                        href=dash.get_relative_path("/"),
+                        active="exact",
+                    ),
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-sharp fa-solid fa-database me-2"),
+                            html.Span("Data"),
+                        ],
+                        href=dash.get_relative_path("/data"),
+                        active="exact",
+                    ),
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-solid fa-right-to-bracket me-2"),
+                            html.Span("Tokens"),
+                        ],
+                        href=dash.get_relative_path("/tokens"),
+                        active="exact",
+                        style={'display': 'block' if has_permission('token_generate') else 'none'},
+                    ),
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-solid fa-globe me-2"),
+                            html.Span("Map"),
+                        ],
+                        href=dash.get_relative_path("/map"),
+                        active="exact",
+                    ),
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-solid fa-envelope-open-text me-2"),
+                            html.Span("Push notification"),
+                        ],
+                        href=dash.get_relative_path("/push_notification"),
+                        active="exact",
+                        style={'display': 'block' if has_permission('push_send') else 'none'},
+                    ),
+                    dbc.NavLink(
+                        [
+                            html.I(className="fas fa-gear me-2"),
+                            html.Span("Settings"),
+                        ],
+                        href=dash.get_relative_path("/settings"),
+                        active="exact",
+                    )
+                ],
+                vertical=True,
+                pills=True,
+            ),
+        ],
+        className="sidebar",
+    )
 
 
 content = html.Div([
@@ -136,95 +154,182 @@ content = html.Div([
             min_date_allowed=date(2010, 1, 1),
             max_date_allowed=date.today(),
             initial_visible_month=date.today(),
+            # only fire once both ends of the range have been picked
+            updatemode='bothdates',
         ), style={'margin': '10px 10px 0 0', 'display': 'flex', 'justify-content': 'right'}
     ),
 
-    # Pages Content
-    dcc.Loading(
-        type='default',
-        fullscreen=True,
-        children=html.Div(dash.page_container, style={
-            "margin-left": "5rem",
-            "margin-right": "2rem",
-            "padding": "2rem 1rem",
-        })
+    # Shown when the stores could not be loaded because the server is busy
+    dbc.Alert(
+        [
+            html.Span(BUSY_MESSAGE),
+            dbc.Button('Retry', id='button-busy-retry', size='sm', color='warning', className='ms-3'),
+        ],
+        id='alert-busy',
+        color='warning',
+        is_open=False,
+        style={'margin-left': '5rem', 'margin-right': '2rem'},
     ),
+
+    # Pages Content
+    html.Div(dash.page_container, style={
+        "margin-left": "5rem",
+        "margin-right": "2rem",
+        "padding": "2rem 1rem",
+    }),
 ])
 
 
-home_page = [
-    sidebar,
-    content,
-]
+def get_home_page():
+    return [
+        get_sidebar(),
+        content,
+    ]
 
-@app.callback(
-    Output("store-demographics", "data"),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-)
-def update_store_demographics(start_date, end_date):
-    df = query_demographics()
-    records = {}
-    for key, dataframe in df.items():
-        records[key] = dataframe.to_dict("records")
-    store = {
-        "data": records,
-        "length": len(records),
-    }
-    return store
 
-app.layout = html.Div(
-    [
-        dcc.Location(id='url', refresh=False),
-        dcc.Store(id='store-trips', data={}),
-        dcc.Store(id='store-uuids', data={}),
-        dcc.Store(id='store-demographics', data= {}),
-        dcc.Store(id ='store-trajectories', data = {}),   
-        html.Div(id='page-content', children=home_page),
-    ]
-)
+def serve_layout():
+    return html.Div(
+        [
+            dcc.Location(id='url', refresh=False),
+            # the spinner only covers the page while the stores load, not the polling of the
+            # live overview or of the settings page
+            dcc.Loading(
+                type='default',
+                fullscreen=True,
+                children=[
+                    dcc.Store(id='store-date-range', data={'start_date': None, 'end_date': None, 'version': 'None/None'}),
+                    dcc.Store(id='store-trips', data={}),
+                    dcc.Store(id='store-uuids', data={}),
+                    dcc.Store(id='store-demographics', data= {}),
+                    dcc.Store(id ='store-trajectories', data = {}),
+                    # the region selected on the map, and the trips in it
+                    dcc.Store(id='store-region', data=None),
+                    dcc.Store(id='store-region-trips', data={}),
+                ],
+            ),
+            html.Div(id='page-content', children=get_home_page()),
+        ]
+    )
 
+app.layout = serve_layout
 
-# Load data stores
+
+# The date picker only feeds this controller. Everything else keys on the range
+# (and its version token) that it publishes, so that a partial selection or a
+# re-selection of the current range does not re-run every query on the page.
 @app.callback(
-    Output("store-uuids", "data"),
+    Output('store-date-range', 'data'),
     Input('date-picker', 'start_date'),
     Input('date-picker', 'end_date'),
+    State('store-date-range', 'data'),
 )
-def update_store_uuids(start_date, end_date):
+def apply_date_range(start_date, end_date, current_range):
+    if bool(start_date) != bool(end_date):
+        # only one end of the range has been picked so far
+        raise PreventUpdate
+    version = f"{start_date}/{end_date}"
+    if current_range and current_range.get('version') == version:
+        raise PreventUpdate
+    logging.debug("Applying date range %s" % version)
+    return {
+        "start_date": start_date,
+        "end_date": end_date,
+        "version": version,
+    }
+
+
+def load_store_uuids(start_date, end_date):
     start_date_obj = date.fromisoformat(start_date) if start_date else None
     end_date_obj = date.fromisoformat(end_date) if end_date else None
     dff = query_uuids(start_date_obj, end_date_obj)
-    records = dff.to_dict("records")
-    store = {
-        "data": records,
-        "length": len(records),
-    }
-    return store
+    return encode_frame(dff)
 
 
-@app.callback(
-    Output("store-trips", "data"),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-)
-def update_store_trips(start_date, end_date):
+def get_trips_date_range(start_date, end_date):
     if not start_date or not end_date:
         end_date_obj = date.today()
         start_date_obj = end_date_obj - timedelta(days=7)
     else:
         start_date_obj = date.fromisoformat(start_date) 
         end_date_obj = date.fromisoformat(end_date)
+    return start_date_obj, end_date_obj
+
+
+def load_store_trips(start_date, end_date):
+    start_date_obj, end_date_obj = get_trips_date_range(start_date, end_date)
+    # for large ranges, only ship the counts that the home page and the map need;
+    # the Data tab pages through the trips themselves
+    number_of_trips = count_confirmed_trips(start_date_obj, end_date_obj)
+    if number_of_trips > COARSE_TRIPS_THRESHOLD:
+        logging.debug("%s trips, loading the aggregates only" % number_of_trips)
+        return encode_aggregates(query_trip_aggregates(start_date_obj, end_date_obj), number_of_trips)
     df = query_confirmed_trips(start_date_obj, end_date_obj)
-    records = df.to_dict("records")
-    # logging.debug("returning records %s" % records[0:2])
+    # logging.debug("returning records %s" % df.head(2))
+    return encode_frame(df)
+
+
+def load_store_demographics():
+    df = query_demographics()
     store = {
-        "data": records,
-        "length": len(records),
+        "data": encode_frames(df),
+        "length": len(df),
     }
     return store
 
 
+# Load data stores
+# The loaders are independent, so they run concurrently (see utils/loader_utils.py)
+# and share the pymongo connection pool of emission.core.get_database
+# If the server is too busy to admit the queries, the stores keep their data and the
+# "busy, retry" alert is shown instead (see utils/admission_utils.py)
+@app.callback(
+    Output("store-uuids", "data"),
+    Output("store-trips", "data"),
+    Output("store-demographics", "data"),
+    Output('alert-busy', 'is_open'),
+    Input('store-date-range', 'data'),
+    Input('button-busy-retry', 'n_clicks'),
+)
+def update_stores(date_range, n_clicks):
+    start_date, end_date = date_range.get('start_date'), date_range.get('end_date')
+    try:
+        results = run_loaders({
+            'uuids': (load_store_uuids, (start_date, end_date)),
+            'trips': (load_store_trips, (start_date, end_date)),
+            'demographics': (load_store_demographics, ()),
+        })
+    except ServerBusy:
+        return dash.no_update, dash.no_update, dash.no_update, True
+    stores = [results['uuids'], results['trips'], results['demographics']]
+    for store in stores:
+        store["version"] = date_range.get('version')
+    return stores + [False]
+
+
+# The region selected on the map is a geospatial query in the database, so it only
+# loads the trips that start or end in it, even when the range is too large for store-trips
+@app.callback(
+    Output('store-region-trips', 'data'),
+    Input('store-region', 'data'),
+    Input('store-date-range', 'data'),
+)
+def update_store_region_trips(region, date_range):
+    if not region:
+        return {}
+    start_date_obj, end_date_obj = get_trips_date_range(date_range.get('start_date'), date_range.get('end_date'))
+    try:
+        df = query_confirmed_trips_in_region(start_date_obj, end_date_obj, region['polygon'], region['match'])
+    except ServerBusy:
+        return {'error': BUSY_MESSAGE}
+    except OperationFailure as e:
+        # e.g. a lasso that crosses itself
+        logging.warning("Unable to query the trips in the region: %s" % e)
+        return {'error': 'The selected region is not a valid polygon, select it again.'}
+    store = encode_frame(df)
+    store['truncated'] = len(df) >= REGION_TRIPS_LIMIT
+    return store
+
+
 # Define the callback to display the page content based on the URL path
 @app.callback(
     Output('page-content', 'children'),
@@ -235,14 +340,14 @@ def display_page(search):
         try:
             is_authenticated = authenticate_user(search)
         except Exception as e:
-            print(e)
+            logging.debug("Unable to authenticate the user: %s" % e)
             return get_cognito_login_page('Unsuccessful authentication, try again.', 'red')
 
         if is_authenticated:
-            return home_page
+            return get_home_page()
         return get_cognito_login_page()
 
-    return home_page
+    return get_home_page()
 
 extra_csp_url = [
     "https://raw.githubusercontent.com",
@@ -258,10 +363,18 @@ csp = {
       }
 
 flt.Talisman(server, content_security_policy=csp, strict_transport_security=False)
+# after_request hooks run in the reverse order of registration, so registering the
+# compression first means that the instrumentation sees the uncompressed sizes
+init_compression(server)
+init_static_caching(server)
+init_instrumentation(server)
+init_health_checks(server)
+init_export(server)
+init_admission(server)
 
 if __name__ == "__main__":
     envPort = int(os.getenv('DASH_SERVER_PORT', '8050'))
-    envDebug = os.getenv('DASH_DEBUG_MODE', 'True').lower() == 'true'
+    envDebug = os.getenv('DASH_DEBUG_MODE', 'False').lower() == 'true'
     app.logger.setLevel(logging.DEBUG)
     logging.debug("before override, current server config = %s" % server.config)
     server.config.update(
@@ -270,4 +383,6 @@ if __name__ == "__main__":
         SESSION_COOKIE_HTTPONLY=True
     )
     logging.debug("after override, current server config = %s" % server.config)
+    warmup_process()
+    warmup_caches()
     app.run_server(debug=envDebug, host='0.0.0.0', port=envPort)
@@ -0,0 +1,68 @@
+"""
+Profile the cold start of the dashboard: how long importing the app takes, how much memory
+(max RSS) the process needs to get there, and which modules dominate the import time.
+
+    python benchmarks/profile_startup.py --top 25 --output startup.json
+
+The import runs in a fresh interpreter with `-X importtime`, exactly as a gunicorn worker
+would import `app_sidebar_collapsible`.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in the child interpreter, reports its own wall time and max RSS on stdout
+PROBE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+# ru_maxrss is in kilobytes on linux
+rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+loaded = [name for name in ('emission.core.get_database', 'plotly.express', 'qrcode', 'PIL.Image',
+                            'emission.net.ext_service.push.notify_usage') if name in sys.modules]
+print(json.dumps({{'import_s': elapsed, 'max_rss_mb': rss_mb, 'heavy_modules_loaded': loaded}}))
+"""
+
+
+def parse_importtime(stderr, top):
+    """Return the `top` modules by cumulative import time (in seconds)"""
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules.append({
+            'module': name.strip(),
+            'self_s': int(self_us) / 1e6,
+            'cumulative_s': int(cumulative_us) / 1e6,
+        })
+    return sorted(modules, key=lambda m: m['cumulative_s'], reverse=True)[:top]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="profile_startup")
+    parser.add_argument("--module", default="app_sidebar_collapsible")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(module=args.module)],
+        cwd=REPO_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['module'] = args.module
+    report['slowest_imports'] = parse_importtime(result.stderr, args.top)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
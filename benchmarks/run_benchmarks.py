@@ -0,0 +1,379 @@
+"""
+Offline benchmark of the dashboard's queries and data processing against a synthetic OpenPATH dataset.
+
+It seeds the database that emission is configured to use (DB_HOST / conf/storage/db.conf) with
+synthetic users, profiles, tokens, confirmed trips, recreated locations, server API calls and
+demographic surveys, times the db_utils queries and the page-level processing on top of them,
+and prints the results as JSON so that they can be compared across commits.
+
+Only run this against a scratch database, e.g. the `db` container of docker-compose-dev.yml. It
+refuses to start unless the database is named with --scratch-db, and unless --allow-nonlocal is
+passed when it is not on this host. With --mongomock, everything runs in memory instead:
+
+    python benchmarks/run_benchmarks.py --scratch-db Stage_database --users 1000 --output bench_1k.json
+    python benchmarks/run_benchmarks.py --scratch-db Stage_database --users 100000 --trips-per-user 2 --repeat 1
+    python benchmarks/run_benchmarks.py --mongomock --users 1000
+
+Every seeded document is tagged with `metadata.benchmark_run` (or `benchmark_run` for the
+collections without metadata) and removed at the end unless --keep is passed.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+
+import arrow
+
+# make the dashboard modules importable when run as `python benchmarks/run_benchmarks.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# emission.core.get_database is imported in main, once we know whether to swap in mongomock
+edb = None
+
+MODES = ['walk', 'bike', 'e-bike', 'car', 'bus', 'train', 'not_a_trip']
+PURPOSES = ['home', 'work', 'school', 'shopping', 'meal', 'exercise', 'entertainment']
+PLATFORMS = ['android', 'ios']
+TIMEZONE = 'America/Denver'
+CENTER_LON, CENTER_LAT = -105.08, 39.74
+BATCH_SIZE = 10000
+LOCAL_HOSTS = ('localhost', '127.0.0.1', '::1')
+
+
+def local_dt(ts):
+    dt = arrow.get(ts).to(TIMEZONE)
+    return {
+        'year': dt.year, 'month': dt.month, 'day': dt.day,
+        'hour': dt.hour, 'minute': dt.minute, 'second': dt.second,
+        'weekday': dt.weekday(), 'timezone': TIMEZONE,
+    }
+
+
+def random_point(rng):
+    return {'type': 'Point', 'coordinates': [CENTER_LON + rng.uniform(-0.2, 0.2), CENTER_LAT + rng.uniform(-0.2, 0.2)]}
+
+
+def insert_batched(collection, docs):
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) == BATCH_SIZE:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+
+
+def generate_users(args, rng, run_id, now):
+    users = []
+    for i in range(args.users):
+        user_id = uuid.UUID(int=rng.getrandbits(128), version=4)
+        update_ts = now - timedelta(days=rng.uniform(0, args.days))
+        users.append((user_id, f"nrelop_bench_{run_id}_{i}", update_ts))
+    return users
+
+
+def generate_trips(args, rng, run_id, users, now_ts):
+    for user_id, _, _ in users:
+        for _ in range(args.trips_per_user):
+            start_ts = now_ts - rng.uniform(0, args.days * 24 * 60 * 60)
+            duration = rng.uniform(60, 2 * 60 * 60)
+            end_ts = start_ts + duration
+            section = uuid.uuid4().hex
+            mode = rng.choice(MODES)
+            start_loc, end_loc = random_point(rng), random_point(rng)
+            yield {
+                'user_id': user_id,
+                'metadata': {
+                    'key': 'analysis/confirmed_trip', 'platform': rng.choice(PLATFORMS),
+                    'write_ts': end_ts, 'time_zone': TIMEZONE, 'benchmark_run': run_id,
+                },
+                'data': {
+                    'source': 'DwellSegmentationTimeFilter',
+                    'start_ts': start_ts, 'end_ts': end_ts,
+                    'start_fmt_time': arrow.get(start_ts).to(TIMEZONE).isoformat(),
+                    'end_fmt_time': arrow.get(end_ts).to(TIMEZONE).isoformat(),
+                    'start_local_dt': local_dt(start_ts), 'end_local_dt': local_dt(end_ts),
+                    'start_loc': start_loc, 'end_loc': end_loc,
+                    'duration': duration, 'distance': rng.uniform(100, 50000),
+                    'user_input': {} if rng.random() < 0.3 else {
+                        'mode_confirm': mode,
+                        'purpose_confirm': rng.choice(PURPOSES),
+                        'replaced_mode': rng.choice(MODES),
+                    },
+                },
+                # used to generate the matching trajectory, removed before inserting
+                '_section': section,
+            }
+
+
+def generate_locations(args, rng, run_id, trip):
+    start, end = trip['data']['start_loc']['coordinates'], trip['data']['end_loc']['coordinates']
+    n = args.points_per_trip
+    for i in range(n):
+        frac = i / max(n - 1, 1)
+        lon = start[0] + (end[0] - start[0]) * frac + rng.gauss(0, 0.0005)
+        lat = start[1] + (end[1] - start[1]) * frac + rng.gauss(0, 0.0005)
+        ts = trip['data']['start_ts'] + trip['data']['duration'] * frac
+        yield {
+            'user_id': trip['user_id'],
+            'metadata': {'key': 'analysis/recreated_location', 'write_ts': ts, 'benchmark_run': run_id},
+            'data': {
+                'ts': ts, 'fmt_time': arrow.get(ts).to(TIMEZONE).isoformat(), 'local_dt': local_dt(ts),
+                'loc': {'type': 'Point', 'coordinates': [lon, lat]}, 'longitude': lon, 'latitude': lat,
+                'mode': rng.randint(0, 9), 'section': trip['_section'],
+                'speed': rng.uniform(0, 30), 'distance': rng.uniform(0, 500), 'idx': i,
+            },
+        }
+
+
+def seed(args, run_id):
+    rng = random.Random(args.seed)
+    now = datetime.now(timezone.utc)
+    now_ts = now.timestamp()
+
+    users = generate_users(args, rng, run_id, now)
+    insert_batched(edb.get_uuid_db(), (
+        {'uuid': user_id, 'user_email': token, 'update_ts': update_ts, 'benchmark_run': run_id}
+        for user_id, token, update_ts in users
+    ))
+    insert_batched(edb.get_profile_db(), (
+        {
+            'user_id': user_id, 'curr_platform': rng.choice(PLATFORMS), 'manufacturer': 'bench',
+            'client_app_version': '1.6.0', 'client_os_version': '14', 'phone_lang': 'en',
+            'benchmark_run': run_id,
+        }
+        for user_id, _, _ in users
+    ))
+    insert_batched(edb.get_token_db(), ({'token': token, 'benchmark_run': run_id} for _, token, _ in users))
+
+    def trips_and_locations():
+        for trip in generate_trips(args, rng, run_id, users, now_ts):
+            locations = list(generate_locations(args, rng, run_id, trip))
+            del trip['_section']
+            yield trip
+            yield from locations
+    insert_batched(edb.get_analysis_timeseries_db(), trips_and_locations())
+
+    def api_calls():
+        for user_id, _, _ in users:
+            for _ in range(args.api_calls_per_user):
+                ts = now_ts - rng.uniform(0, args.days * 24 * 60 * 60)
+                yield {
+                    'user_id': user_id,
+                    'metadata': {'key': 'stats/server_api_time', 'write_ts': ts, 'benchmark_run': run_id},
+                    'data': {'name': rng.choice(['POST_/usercache/get', 'POST_/usercache/put']), 'ts': ts,
+                             'reading': rng.uniform(0, 2)},
+                }
+
+    def surveys():
+        for i, (user_id, _, update_ts) in enumerate(users):
+            survey = 'UserProfileSurvey' if i % 4 else 'UserProfileSurveyV2'
+            yield {
+                'user_id': user_id,
+                'metadata': {'key': 'manual/demographic_survey', 'write_ts': update_ts.timestamp(),
+                             'benchmark_run': run_id},
+                'data': {
+                    'label': 'Answered', 'name': survey, 'version': 1, 'xmlResponse': '<data/>',
+                    'jsonDocResponse': {survey: {
+                        'attrxmlns:jr': 'http://openrosa.org/javarosa', 'attrid': survey,
+                        'group_hg4zz25': {
+                            'How_old_are_you': rng.choice(['18___24_years_old', '25___34_years_old', '35___44_years_old']),
+                            'What_is_your_gender': rng.choice(['woman', 'man', 'nonbinary']),
+                            'Do_you_have_a_driver_license': rng.choice(['yes', 'no']),
+                            'What_is_your_race_ethnicity': rng.choice(['white', 'black', 'asian', 'other']),
+                        },
+                        'meta': {'instanceID': uuid.uuid4().hex},
+                    }},
+                },
+            }
+
+    timeseries_db = edb.get_timeseries_db()
+    insert_batched(timeseries_db, api_calls())
+    insert_batched(timeseries_db, surveys())
+
+
+def check_target(args):
+    """Refuse to seed a database that was not named as a scratch database on the command line"""
+    database = edb.get_uuid_db().database
+    host, port = database.client.address
+    if args.scratch_db != database.name:
+        sys.exit(f"emission is configured for the database {database.name} on {host}:{port}; "
+                 f"pass --scratch-db {database.name} if it is a scratch database")
+    if host not in LOCAL_HOSTS and not args.allow_nonlocal:
+        sys.exit(f"{host}:{port} is not on this host; pass --allow-nonlocal to seed it anyway")
+
+
+def cleanup(run_id):
+    edb.get_uuid_db().delete_many({'benchmark_run': run_id})
+    edb.get_profile_db().delete_many({'benchmark_run': run_id})
+    edb.get_token_db().delete_many({'benchmark_run': run_id})
+    edb.get_analysis_timeseries_db().delete_many({'metadata.benchmark_run': run_id})
+    edb.get_timeseries_db().delete_many({'metadata.benchmark_run': run_id})
+
+
+def measure(name, func, repeat, results, size=None):
+    """Run func `repeat` times and record the timings; returns the result of the last run"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    entry = {
+        'median_s': round(statistics.median(timings), 4),
+        'min_s': round(min(timings), 4),
+        'max_s': round(max(timings), 4),
+        'runs': repeat,
+    }
+    if size is not None:
+        entry.update(size(result))
+    results[name] = entry
+    logging.info("%s: %s" % (name, entry))
+    return result
+
+
+def serialized_size(obj):
+    import plotly
+    return len(json.dumps(obj, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def run(args):
+    # imported here so that the dashboard (and its config) is only loaded once the data is in place
+    import app_sidebar_collapsible as dashboard
+    from utils import db_utils
+    from utils.store_utils import decode_frame, decode_aggregates, is_aggregated
+    import pages.data as data_page
+    import pages.home as home_page
+    import pages.map as map_page
+
+    end_date = date.today()
+    start_date = end_date - timedelta(days=args.days)
+    start_str, end_str = start_date.isoformat(), end_date.isoformat()
+    results = {}
+    repeat = args.repeat
+
+    def uncached(func, *func_args):
+        def wrapper():
+            if hasattr(func, 'cache_clear'):
+                func.cache_clear()
+            return func(*func_args)
+        return wrapper
+
+    rows = lambda df: {'rows': len(df)}
+    measure('query_uuids', uncached(db_utils.query_uuids, start_date, end_date), repeat, results, rows)
+    measure('query_all_uuids', uncached(db_utils.query_all_uuids), repeat, results, rows)
+    measure('query_confirmed_trips', uncached(db_utils.query_confirmed_trips, start_date, end_date),
+            repeat, results, rows)
+    measure('query_trip_aggregates', uncached(db_utils.query_trip_aggregates, start_date, end_date),
+            repeat, results, lambda aggregates: {name: len(df) for name, df in aggregates.items()})
+    measure('query_demographics', uncached(db_utils.query_demographics), repeat, results,
+            lambda dfs: {'rows': sum(len(df) for df in dfs.values())})
+    measure('query_trajectories', uncached(db_utils.query_trajectories, start_date, end_date),
+            repeat, results, rows)
+
+    store_bytes = lambda store: {'bytes': serialized_size(store)}
+    store_uuids = measure('load_store_uuids', lambda: dashboard.load_store_uuids(start_str, end_str),
+                          repeat, results, store_bytes)
+    store_trips = measure('load_store_trips', lambda: dashboard.load_store_trips(start_str, end_str),
+                          repeat, results, store_bytes)
+
+    uuid_records = decode_frame(store_uuids).head(args.user_stats_sample).to_dict('records')
+    measure('add_user_stats', lambda: db_utils.add_user_stats([dict(r) for r in uuid_records]), repeat, results,
+            lambda stats: {'users': len(stats)})
+
+    trips_map = measure('store_trips_map_data', lambda: map_page.store_trips_map_data(store_trips, {}),
+                        repeat, results, store_bytes)
+    coordinates = trips_map.get('coordinates', {})
+    users_data = trips_map.get('users_data', {})
+    fig_bytes = lambda fig: {'bytes': serialized_size(fig)}
+    measure('create_heatmap_fig', lambda: map_page.create_heatmap_fig(coordinates), repeat, results, fig_bytes)
+    measure('create_bubble_fig', lambda: map_page.create_bubble_fig(coordinates), repeat, results, fig_bytes)
+    lines_users = set(list(users_data)[:args.lines_users])
+    measure('create_lines_map', lambda: map_page.create_lines_map(users_data, lines_users), repeat, results,
+            fig_bytes)
+
+    if is_aggregated(store_trips):
+        # above DASH_COARSE_TRIPS_THRESHOLD, the store only has the aggregates
+        measure('compute_trips_trend',
+                lambda: home_page.compute_trips_trend_from_aggregates(decode_aggregates(store_trips)['daily']),
+                repeat, results, rows)
+        return results
+    measure('compute_trips_trend',
+            lambda: home_page.compute_trips_trend(decode_frame(store_trips)),
+            repeat, results, rows)
+
+    trips_df = decode_frame(store_trips)
+    measure('populate_datatable_trips',
+            lambda: serialized_size(data_page.populate_datatable(trips_df.copy()).to_plotly_json()),
+            repeat, results, lambda size: {'bytes': size})
+
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog="run_benchmarks")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--trips-per-user", type=int, default=5)
+    parser.add_argument("--points-per-trip", type=int, default=20)
+    parser.add_argument("--api-calls-per-user", type=int, default=10)
+    parser.add_argument("--days", type=int, default=30, help="the synthetic data (and the benchmarked range) span this many days")
+    parser.add_argument("--user-stats-sample", type=int, default=100, help="number of users passed to add_user_stats")
+    parser.add_argument("--lines-users", type=int, default=50, help="number of users drawn in the lines map")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--keep", action="store_true", help="do not delete the synthetic data at the end")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--scratch-db", help="the name of the database emission is configured for, to confirm that it can be seeded")
+    parser.add_argument("--allow-nonlocal", action="store_true", help="seed the scratch database even if it is not on this host")
+    parser.add_argument("--mongomock", action="store_true", help="run against an in-memory mongomock instead of the configured database")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.mongomock:
+        try:
+            import mongomock
+        except ImportError:
+            parser.error("--mongomock needs the mongomock package")
+        import pymongo
+        # emission creates its client when get_database is imported
+        pymongo.MongoClient = mongomock.MongoClient
+    import emission.core.get_database as edb
+    if not args.mongomock:
+        check_target(args)
+
+    run_id = f"bench_{int(time.time())}"
+    try:
+        seed_start = time.perf_counter()
+        # in the try, so that a partial seed is cleaned up too
+        seed(args, run_id)
+        logging.info("Seeded %s users in %.1f s" % (args.users, time.perf_counter() - seed_start))
+        results = run(args)
+    finally:
+        if not args.keep:
+            cleanup(run_id)
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'scale': {k: v for k, v in vars(args).items() if k not in ('keep', 'output', 'scratch_db', 'allow_nonlocal')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
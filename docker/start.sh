@@ -4,12 +4,21 @@ source setup/activate.sh
 # change the db host
 echo "DB host = "${DB_HOST}
 if [ -z ${DB_HOST} ] ; then
-    local_host=`hostname -i`
-    sed "s_localhost_${local_host}_" conf/storage/db.conf.sample > conf/storage/db.conf
+    db_host=`hostname -i`
 else
-    sed "s_localhost_${DB_HOST}_" conf/storage/db.conf.sample > conf/storage/db.conf
+    db_host=${DB_HOST}
 fi
+# emission reads the url from db.conf, so the connection pool options go in there
+db_url=`python -m utils.mongo_utils "${db_host}"`
+echo "DB url = "${db_url}
+# the & of the URI options must be escaped for sed
+sed "s|localhost|${db_url//&/\\&}|" conf/storage/db.conf.sample > conf/storage/db.conf
 
 # run the app
 # python app.py
-python app_sidebar_collapsible.py
+if [ "${DASH_DEBUG_MODE,,}" = "true" ]; then
+    # flask dev server, with hot reloading
+    python app_sidebar_collapsible.py
+else
+    gunicorn -c gunicorn.conf.py wsgi:server
+fi
@@ -0,0 +1,34 @@
+# gunicorn settings for the production entry point (wsgi.py), driven by the environment
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.getenv('DASH_SERVER_PORT', '8050')}"
+
+# the callbacks mostly wait on Mongo, so a few threaded workers go a long way; each worker
+# holds its own copy of the caches, so don't scale the workers with the CPUs too aggressively
+workers = int(os.getenv('GUNICORN_WORKERS', str(min(multiprocessing.cpu_count(), 4))))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+# a year-long date range can take a while to load
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+# recycle the workers from time to time to bound the growth of the in-memory caches
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '0'))
+max_requests_jitter = max_requests // 10
+
+# import the app (and load the config) once in the master, before forking the workers
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def post_worker_init(worker):
+    # runs in each worker before it accepts requests; the database connections have to be
+    # created after the fork, so the Mongo backed caches are warmed here and not in the master.
+    # The warmup runs in the background, so that a slow database cannot hold the worker past
+    # the timeout; the worker reports as not ready on /readyz until it is done
+    from utils.warmup import start_warmup_caches
+    start_warmup_caches()
@@ -3,8 +3,11 @@ Note that the callback will trigger even if prevent_initial_call=True. This is b
 Since the dcc.Location component is not in the layout when navigating to this page, it triggers the callback.
 The workaround is to check if the input value is None.
 """
-from dash import dcc, html, Input, Output, callback, register_page, dash_table
+import dash
+from dash import dcc, html, Input, Output, State, callback, register_page, dash_table
+import dash_bootstrap_components as dbc
 from datetime import date, timedelta
+from urllib.parse import urlencode
 # Etc
 import logging
 import pandas as pd
@@ -12,7 +15,10 @@ from dash.exceptions import PreventUpdate
 
 from utils import permissions as perm_utils
 from utils import db_utils
+from utils.admission_utils import ServerBusy, BUSY_MESSAGE
+from utils import export_utils
 from utils.db_utils import query_trajectories
+from utils.store_utils import decode_frame, encode_frame, is_aggregated, is_stale, get_store_date_range
 register_page(__name__, path="/data")
 
 intro = """## Data"""
@@ -31,21 +37,33 @@ layout = html.Div(
 )
 
 
-def clean_location_data(df):
-    if 'data.start_loc.coordinates' in df.columns:
-        df['data.start_loc.coordinates'] = df['data.start_loc.coordinates'].apply(lambda x: f'({x[0]}, {x[1]})')
-    if 'data.end_loc.coordinates' in df.columns:
-        df['data.end_loc.coordinates'] = df['data.end_loc.coordinates'].apply(lambda x: f'({x[0]}, {x[1]})')
-    return df
+def get_date_range_objs(date_range):
+    start_date, end_date = date_range.get('start_date'), date_range.get('end_date')
+    if not start_date or not end_date:
+        end_date_obj = date.today()
+        start_date_obj = end_date_obj - timedelta(days=7)
+    else:
+        start_date_obj = date.fromisoformat(start_date)
+        end_date_obj = date.fromisoformat(end_date)
+    return start_date_obj, end_date_obj
+
+def get_export_links(dataset, start_date=None, end_date=None, survey=None):
+    # the full dataset, streamed by the server (see utils/export_utils.py)
+    params = {'start_date': start_date, 'end_date': end_date, 'survey': survey}
+    params = {key: value for key, value in params.items() if value}
+    formats = [('CSV', 'csv'), ('CSV (gzip)', 'csv.gz')]
+    if export_utils.pa is not None:
+        formats.append(('Parquet', 'parquet'))
+    links = []
+    for label, fmt in formats:
+        href = dash.get_relative_path(f'/export/{dataset}') + '?' + urlencode({'format': fmt, **params})
+        links.append(html.A(label, href=href, style={'margin-left': '10px'}))
+    return html.Div(['Download all:'] + links, style={'margin': '10px 0'})
 
 def update_store_trajectories(start_date_obj,end_date_obj):
     global store_trajectories
     df = query_trajectories(start_date_obj,end_date_obj)
-    records = df.to_dict("records")   
-    store = {
-        "data": records,
-        "length": len(records),
-    }
+    store = encode_frame(df)
     store_trajectories = store
     return store
 
@@ -57,32 +75,73 @@ def update_store_trajectories(start_date_obj,end_date_obj):
     Input('store-trips', 'data'),
     Input('store-demographics', 'data'),
     Input('store-trajectories', 'data'),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-
+    Input('store-region-trips', 'data'),
+    State('store-date-range', 'data'),
 )
-def render_content(tab, store_uuids, store_trips, store_demographics, store_trajectories, start_date, end_date):
-    data, columns, has_perm = None, [], False
+def render_content(tab, store_uuids, store_trips, store_demographics, store_trajectories, store_region_trips,
+                   date_range):
+    stale_store = next((store for store in [store_uuids, store_trips] if is_stale(store, date_range)), None)
+    if stale_store is None:
+        return render_tab(tab, store_uuids, store_trips, store_demographics, store_trajectories, store_region_trips,
+                          date_range)
+    # the stores of the selected range are still loading, or could not be loaded because the
+    # server was busy: show what they have, with the export links of the range they are for
+    date_range = get_store_date_range(stale_store)
+    shown_range = (f"{date_range['start_date']} to {date_range['end_date']}" if date_range['start_date']
+                   else 'the default range')
+    return html.Div([
+        dbc.Alert(f"The selected range is not loaded yet, showing the data of {shown_range}.", color='secondary'),
+        render_tab(tab, store_uuids, store_trips, store_demographics, store_trajectories, store_region_trips,
+                   date_range),
+    ])
+
+
+def render_tab(tab, store_uuids, store_trips, store_demographics, store_trajectories, store_region_trips,
+               date_range):
+    df, columns, has_perm, export_links = pd.DataFrame(), [], False, None
+    markdown_columns = []
     if tab == 'tab-uuids-datatable':
-        data = store_uuids["data"]
-        data = db_utils.add_user_stats(data)
-        columns = perm_utils.get_uuids_columns()
+        data = decode_frame(store_uuids).to_dict("records")
+        try:
+            data = db_utils.add_user_stats(data)
+        except ServerBusy:
+            return html.P(BUSY_MESSAGE)
+        df = pd.DataFrame(data)
+        columns = perm_utils.get_permission_profile().uuids_columns
         has_perm = perm_utils.has_permission('data_uuids')
+        export_links = get_export_links('uuids', date_range.get('start_date'), date_range.get('end_date'))
+        markdown_columns = ['user_id']
     elif tab == 'tab-trips-datatable':
-        data = store_trips["data"]
-        columns = perm_utils.get_allowed_trip_columns()
-        columns.update(
-            col['label'] for col in perm_utils.get_allowed_named_trip_columns()
-        )
         has_perm = perm_utils.has_permission('data_trips')
+        start_date_obj, end_date_obj = get_date_range_objs(date_range)
+        export_links = get_export_links('trips', start_date_obj, end_date_obj)
+        if store_region_trips and 'error' not in store_region_trips:
+            # a region is selected on the map, only show the trips in it
+            store_trips = store_region_trips
+            region_message = f"Showing the {store_region_trips['length']} trips in the region selected on the map."
+            if store_region_trips.get('truncated'):
+                # the region query is capped at db_utils.REGION_TRIPS_LIMIT
+                region_message = (
+                    f"Showing the first {store_region_trips['length']} trips in the region selected on the map,"
+                    " there are more: select a smaller region or a shorter range to see all of them."
+                )
+            export_links = html.Div([export_links, html.P(region_message)])
+        if is_aggregated(store_trips):
+            # too many trips in the range to ship them all, page through them instead
+            if not has_perm:
+                return None
+            return html.Div([export_links, populate_paged_datatable(store_trips['length'])])
+        df = decode_frame(store_trips)
+        columns = perm_utils.get_permission_profile().trips_table_columns
     elif tab == 'tab-demographics-datatable':
         data = store_demographics["data"]
         has_perm = perm_utils.has_permission('data_demographics')
         # if only one survey is available, process it without creating a subtab
         if len(data) == 1: 
             # here data is a dictionary 
-            data = list(data.values())[0]
-            columns = list(data[0].keys())
+            df = decode_frame(list(data.values())[0])
+            columns = list(df.columns)
+            export_links = get_export_links('demographics', survey=list(data.keys())[0])
         # for multiple survey, create subtabs for unique surveys
         else:
             #returns subtab only if has_perm is True
@@ -97,28 +156,32 @@ def render_content(tab, store_uuids, store_trips, store_demographics, store_traj
     elif tab == 'tab-trajectories-datatable':
         # Currently store_trajectories data is loaded only when the respective tab is selected
         #Here we query for trajectory data once "Trajectories" tab is selected
-        if not start_date or not end_date:
-            end_date_obj = date.today()
-            start_date_obj = end_date_obj - timedelta(days=7)
-        else:
-            start_date_obj = date.fromisoformat(start_date) 
-            end_date_obj = date.fromisoformat(end_date)
+        start_date_obj, end_date_obj = get_date_range_objs(date_range)
         if store_trajectories == {}:
-            store_trajectories = update_store_trajectories(start_date_obj,end_date_obj)
-        data = store_trajectories["data"]
-        if data:
-            columns = list(data[0].keys())
-            columns = perm_utils.get_trajectories_columns(columns)
+            try:
+                store_trajectories = update_store_trajectories(start_date_obj,end_date_obj)
+            except ServerBusy:
+                return html.P(BUSY_MESSAGE)
+        export_links = get_export_links('trajectories', start_date_obj, end_date_obj)
+        df = decode_frame(store_trajectories)
+        if not df.empty:
+            columns = perm_utils.get_trajectories_columns(df.columns)
             has_perm = perm_utils.has_permission('data_trajectories')
-       
-    df = pd.DataFrame(data)
+
     if df.empty or not has_perm:
         return None
 
     df = df.drop(columns=[col for col in df.columns if col not in columns])
-    df = clean_location_data(df)
+    column_specs = None
+    if tab == 'tab-trips-datatable':
+        # numeric distance, duration and coordinates, see db_utils.get_trips_datatable_columns
+        df = db_utils.to_display_units(df)
+        column_specs = db_utils.get_trips_datatable_columns(df.columns)
+    if 'user_id' in markdown_columns and 'user_id' in df.columns:
+        # link to the page of the user (pages/user.py)
+        df['user_id'] = df['user_id'].apply(lambda user_id: f"[{user_id}]({dash.get_relative_path(f'/user/{user_id}')})")
 
-    return populate_datatable(df)
+    return html.Div([export_links, populate_datatable(df, markdown_columns, column_specs)])
 
 # handle subtabs for demographic table when there are multiple surveys
 @callback(
@@ -130,24 +193,21 @@ def render_content(tab, store_uuids, store_trips, store_demographics, store_traj
 def update_sub_tab(tab, store_demographics):
     data = store_demographics["data"]
     if tab in data:
-        data = data[tab]
-        if data:
-            columns = list(data[0].keys())
-
-        df = pd.DataFrame(data)
+        df = decode_frame(data[tab])
         if df.empty:
             return None
 
-        df = df.drop(columns=[col for col in df.columns if col not in columns])
-
-        return populate_datatable(df)
+        return html.Div([get_export_links('demographics', survey=tab), populate_datatable(df)])
       
-def populate_datatable(df):
+def populate_datatable(df, markdown_columns=(), column_specs=None):
     if not isinstance(df, pd.DataFrame):
         raise PreventUpdate
     return dash_table.DataTable(
         # id='my-table',
-        # columns=[{"name": i, "id": i} for i in df.columns],
+        columns=column_specs or [
+            {"name": i, "id": i, "presentation": "markdown"} if i in markdown_columns else {"name": i, "id": i}
+            for i in df.columns
+        ],
         data=df.to_dict('records'),
         export_format="csv",
         filter_options={"case": "sensitive"},
@@ -164,3 +224,60 @@ def populate_datatable(df):
         },
         style_table={'overflowX': 'auto'}
     )
+
+
+TRIPS_PAGE_SIZE = 50
+
+def populate_paged_datatable(number_of_rows):
+    # the rows are loaded by update_trips_page, one page at a time
+    return html.Div([
+        dash_table.DataTable(
+            id='datatable-trips-paged',
+            export_format="csv",
+            page_action="custom",
+            page_current=0,
+            page_size=TRIPS_PAGE_SIZE,
+            page_count=max(1, -(-number_of_rows // TRIPS_PAGE_SIZE)),
+            style_cell={'textAlign': 'left'},
+            style_table={'overflowX': 'auto'},
+        ),
+        # where the loaded pages start (see db_utils.get_page_cursor)
+        dcc.Store(id='store-trips-page-keys', data={}),
+        dbc.Alert(
+            [
+                html.Span(BUSY_MESSAGE),
+                dbc.Button('Retry', id='button-trips-paged-retry', size='sm', color='warning', className='ms-3'),
+            ],
+            id='alert-trips-paged-busy',
+            color='warning',
+            is_open=False,
+        ),
+    ])
+
+
+@callback(
+    Output('datatable-trips-paged', 'data'),
+    Output('datatable-trips-paged', 'columns'),
+    Output('store-trips-page-keys', 'data'),
+    Output('alert-trips-paged-busy', 'is_open'),
+    Input('datatable-trips-paged', 'page_current'),
+    Input('datatable-trips-paged', 'page_size'),
+    Input('button-trips-paged-retry', 'n_clicks'),
+    State('store-date-range', 'data'),
+    State('store-trips-page-keys', 'data'),
+)
+def update_trips_page(page_current, page_size, n_clicks, date_range, page_keys):
+    if page_current is None or not perm_utils.has_permission('data_trips'):
+        raise PreventUpdate
+    start_date_obj, end_date_obj = get_date_range_objs(date_range)
+    after, skip = db_utils.get_page_cursor(page_keys, page_current, page_size)
+    try:
+        df = db_utils.query_confirmed_trips_page(start_date_obj, end_date_obj, after, page_size, skip)
+    except ServerBusy:
+        # keep the current page, the retry button loads the page again
+        return dash.no_update, dash.no_update, dash.no_update, True
+    page_keys = db_utils.add_page_key(page_keys, page_current, df)
+    columns = perm_utils.get_permission_profile().trips_table_columns
+    df = df.drop(columns=[col for col in df.columns if col not in columns])
+    df = db_utils.to_display_units(df)
+    return df.to_dict('records'), db_utils.get_trips_datatable_columns(df.columns), page_keys, False
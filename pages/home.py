@@ -4,26 +4,36 @@ be in app.py.  Since the dcc.Location component is not in the layout when naviga
 The workaround is to check if the input value is None.
 
 """
+import os
 from uuid import UUID
 from datetime import date, timedelta
-from dash import dcc, html, Input, Output, callback, register_page
+from dash import dcc, html, Input, Output, State, callback, register_page
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
 
-import plotly.express as px
-
 # Etc
 import pandas as pd
 import arrow
+import plotly.graph_objects as go
+
+from utils.import_utils import lazy_import
 
-# e-mission modules
-import emission.core.get_database as edb
+# plotly express and the e-mission modules are slow to import, so they are loaded on first use
+px = lazy_import('plotly.express')
+edb = lazy_import('emission.core.get_database')
 
+from utils import db_utils
+from utils.admission_utils import ServerBusy, BUSY_MESSAGE
+from utils.live_utils import get_live_summary
 from utils.permissions import has_permission
+from utils.store_utils import decode_frame, decode_aggregates, is_aggregated, is_stale
 
 register_page(__name__, path="/")
 
 intro = "## Home"
 
+LIVE_INTERVAL_SECONDS = int(os.getenv('DASH_LIVE_INTERVAL_SECONDS', '10'))
+
 card_icon = {
     "color": "white",
     "textAlign": "center",
@@ -35,6 +45,10 @@ layout = html.Div(
     [
         dcc.Markdown(intro),
 
+        # Live mode: poll for what was written since the last update
+        dbc.Switch(id='switch-live-mode', label='Live updates', value=False),
+        dcc.Interval(id='interval-live-mode', interval=LIVE_INTERVAL_SECONDS * 1000, disabled=True),
+
         # Cards
         dbc.Row([
             dbc.Col(id='card-users'),
@@ -46,32 +60,48 @@ layout = html.Div(
         dbc.Row([
             dcc.Graph(id="fig-sign-up-trend"),
             dcc.Graph(id="fig-trips-trend"),
-        ])
+        ]),
+
+        # Label statistics
+        dbc.Row([
+            dbc.Col(id='card-labeling-rate', width=4),
+        ]),
+        dbc.Row([
+            dcc.Graph(id="fig-label-counts"),
+            dcc.Graph(id="fig-mode-sankey"),
+        ]),
     ]
 )
 
 
-def compute_sign_up_trend(uuid_df):
-    uuid_df['update_ts'] = pd.to_datetime(uuid_df['update_ts'], utc=True)
-    res_df = (
-        uuid_df
-        .groupby(uuid_df['update_ts'].dt.date)
-        .size()
-        .reset_index(name='count')
-        .rename(columns={'update_ts': 'date'})
-    )
+def count_per_day(days):
+    # the days are datetime64 midnights, only the (few) distinct days become dates
+    res_df = days.groupby(days).size().reset_index(name='count')
+    res_df.columns = ['date', 'count']
+    res_df['date'] = res_df['date'].dt.date
     return res_df
 
 
-def compute_trips_trend(trips_df, date_col):
-    trips_df[date_col] = pd.to_datetime(trips_df[date_col], utc=True)
-    trips_df[date_col] = pd.DatetimeIndex(trips_df[date_col]).date
+def compute_sign_up_trend(uuid_df):
+    # update_ts comes out of the store as a datetime column (see utils/store_utils.py)
+    update_ts = uuid_df['update_ts']
+    if not pd.api.types.is_datetime64_any_dtype(update_ts):
+        update_ts = pd.to_datetime(update_ts, utc=True)
+    return count_per_day(update_ts.dt.floor('D'))
+
+
+def compute_trips_trend(trips_df):
+    # bucketed by the local day of the start of the trip, like the aggregates
+    return count_per_day(db_utils.get_local_dates(trips_df['data.start_ts'], trips_df['data.start_local_dt.timezone']))
+
+
+def compute_trips_trend_from_aggregates(daily_df):
+    # the daily counts are already bucketed by local day (and user and mode)
     res_df = (
-        trips_df
-        .groupby(date_col)
-        .size()
+        daily_df
+        .groupby('date')['count']
+        .sum()
         .reset_index(name='count')
-        .rename(columns={date_col: 'date'})
     )
     return res_df
 
@@ -133,7 +163,7 @@ def update_card_users(store_uuids):
     Input('store-uuids', 'data'),
 )
 def update_card_active_users(store_uuids):
-    uuid_df = pd.DataFrame(store_uuids.get('data'))
+    uuid_df = decode_frame(store_uuids)
     number_of_active_users = 0
     if not uuid_df.empty and has_permission('overview_active_users'):
         one_day = 24 * 60 * 60
@@ -165,7 +195,7 @@ def generate_barplot(data, x, y, title):
     Input('store-uuids', 'data'),
 )
 def generate_plot_sign_up_trend(store_uuids):
-    df = pd.DataFrame(store_uuids.get("data"))
+    df = decode_frame(store_uuids)
     trend_df = None
     if not df.empty and has_permission('overview_signup_trends'):
         trend_df = compute_sign_up_trend(df)
@@ -173,22 +203,137 @@ def generate_plot_sign_up_trend(store_uuids):
     return fig
 
 
-@callback(
-    Output('fig-trips-trend', 'figure'),
-    Input('store-trips', 'data'),
-    Input('date-picker', 'start_date'),
-    Input('date-picker', 'end_date'),
-)
-def generate_plot_trips_trend(store_trips, start_date, end_date):
-    df = pd.DataFrame(store_trips.get("data"))
-    trend_df = None
+def get_trips_date_range(date_range):
+    start_date, end_date = date_range.get('start_date'), date_range.get('end_date')
     if not start_date or not end_date:
         end_date_obj = date.today()
         start_date_obj = end_date_obj - timedelta(days=7)
     else:
         start_date_obj = date.fromisoformat(start_date) 
         end_date_obj = date.fromisoformat(end_date)
-    if not df.empty and has_permission('overview_trips_trend'):
-        trend_df = compute_trips_trend(df, date_col = "trip_start_time_str")
+    return start_date_obj, end_date_obj
+
+
+@callback(
+    Output('fig-trips-trend', 'figure'),
+    Input('store-trips', 'data'),
+    State('store-date-range', 'data'),
+)
+def generate_plot_trips_trend(store_trips, date_range):
+    if is_stale(store_trips, date_range):
+        # the trips of the new range are still loading, keep the plot until they are in
+        raise PreventUpdate
+    df = decode_frame(store_trips)
+    trend_df = None
+    start_date_obj, end_date_obj = get_trips_date_range(date_range)
+    if has_permission('overview_trips_trend'):
+        if is_aggregated(store_trips):
+            daily_df = decode_aggregates(store_trips)['daily']
+            if not daily_df.empty:
+                trend_df = compute_trips_trend_from_aggregates(daily_df)
+        elif not df.empty:
+            trend_df = compute_trips_trend(df)
     fig = generate_barplot(trend_df, x = 'date', y = 'count', title = f"Trips trend({start_date_obj} to {end_date_obj})")
     return fig
+
+
+@callback(
+    Output('interval-live-mode', 'disabled'),
+    Input('switch-live-mode', 'value'),
+)
+def toggle_live_mode(live):
+    return not live
+
+
+def counts_to_df(counts):
+    if not counts:
+        return None
+    return pd.DataFrame(sorted(counts.items()), columns=['date', 'count'])
+
+
+# In live mode, the cards and the trends are updated from the live counts (see utils/live_utils.py)
+# instead of the stores, so that only the entries written since the last tick are fetched
+@callback(
+    Output('card-users', 'children', allow_duplicate=True),
+    Output('card-active-users', 'children', allow_duplicate=True),
+    Output('card-trips', 'children', allow_duplicate=True),
+    Output('fig-sign-up-trend', 'figure', allow_duplicate=True),
+    Output('fig-trips-trend', 'figure', allow_duplicate=True),
+    Input('interval-live-mode', 'n_intervals'),
+    State('store-date-range', 'data'),
+    prevent_initial_call=True,
+)
+def update_live_overview(n_intervals, date_range):
+    start_date, end_date = date_range.get('start_date'), date_range.get('end_date')
+    start_date_obj = date.fromisoformat(start_date) if start_date else None
+    end_date_obj = date.fromisoformat(end_date) if end_date else None
+    trips_start_date_obj, trips_end_date_obj = get_trips_date_range(date_range)
+    try:
+        summary = get_live_summary(start_date_obj, end_date_obj, trips_start_date_obj, trips_end_date_obj)
+    except ServerBusy:
+        # keep the current numbers, the next tick will try again
+        raise PreventUpdate
+
+    number_of_users = summary['users'] if has_permission('overview_users') else 0
+    number_of_active_users = summary['active_users'] if has_permission('overview_active_users') else 0
+    number_of_trips = summary['trips'] if has_permission('overview_trips') else 0
+    sign_up_trend_df = counts_to_df(summary['signups_per_day']) if has_permission('overview_signup_trends') else None
+    trips_trend_df = counts_to_df(summary['trips_per_day']) if has_permission('overview_trips_trend') else None
+    return (
+        generate_card("# Users", f"{number_of_users} users", "fa fa-users"),
+        generate_card("# Active users", f"{number_of_active_users} users", "fa fa-person-walking"),
+        generate_card("# Confirmed trips", f"{number_of_trips} trips", "fa fa-angles-right"),
+        generate_barplot(sign_up_trend_df, x = 'date', y = 'count', title = "Sign-ups trend"),
+        generate_barplot(trips_trend_df, x = 'date', y = 'count',
+                         title = f"Trips trend({trips_start_date_obj} to {trips_end_date_obj})"),
+    )
+
+
+def create_label_counts_fig(counts_df):
+    fig = px.bar()
+    if not counts_df.empty:
+        fig = px.bar(counts_df, x='value', y='count', facet_col='label', facet_col_wrap=1,
+                     height=300 * counts_df['label'].nunique())
+        fig.update_xaxes(matches=None, showticklabels=True, title=None)
+        fig.for_each_annotation(lambda a: a.update(text=a.text.split('=')[-1]))
+    fig.update_layout(title='Trip labels')
+    return fig
+
+
+def create_mode_sankey_fig(transitions_df):
+    fig = go.Figure()
+    if not transitions_df.empty:
+        modes = sorted(transitions_df['mode'].astype(str).unique())
+        replaced_modes = sorted(transitions_df['replaced_mode'].astype(str).unique())
+        # the replaced modes are separate nodes on the right
+        nodes = modes + [f"replaced {mode}" for mode in replaced_modes]
+        source = transitions_df['mode'].astype(str).map({mode: i for i, mode in enumerate(modes)})
+        target = transitions_df['replaced_mode'].astype(str).map(
+            {mode: len(modes) + i for i, mode in enumerate(replaced_modes)})
+        fig.add_trace(go.Sankey(
+            node={'label': nodes, 'pad': 15},
+            link={'source': source.tolist(), 'target': target.tolist(), 'value': transitions_df['count'].tolist()},
+        ))
+    fig.update_layout(title='Mode -> replaced mode')
+    return fig
+
+
+@callback(
+    Output('card-labeling-rate', 'children'),
+    Output('fig-label-counts', 'figure'),
+    Output('fig-mode-sankey', 'figure'),
+    Input('store-date-range', 'data'),
+)
+def update_label_stats(date_range):
+    # computed in the database (and cached per range) instead of from store-trips,
+    # so it also works when the range is too large to load the trips
+    if not has_permission('overview_label_stats'):
+        return None, create_label_counts_fig(pd.DataFrame()), create_mode_sankey_fig(pd.DataFrame())
+    start_date_obj, end_date_obj = get_trips_date_range(date_range)
+    try:
+        stats = db_utils.query_label_stats(start_date_obj, end_date_obj)
+    except ServerBusy:
+        return html.P(BUSY_MESSAGE), create_label_counts_fig(pd.DataFrame()), create_mode_sankey_fig(pd.DataFrame())
+    labeling_rate = stats['labeled'] / stats['total'] * 100 if stats['total'] else 0
+    card = generate_card("Labeling rate", f"{labeling_rate:.1f}% of {stats['total']} trips", "fa fa-tags")
+    return card, create_label_counts_fig(stats['counts']), create_mode_sankey_fig(stats['transitions'])
@@ -5,23 +5,34 @@ in the layout when navigating to this page, it triggers the callback. The
 workaround is to check if the input value is None.
 """
 from uuid import UUID
+from datetime import date, timedelta
 
-from dash import dcc, html, Input, Output, State, callback, register_page
+from dash import dcc, html, Input, Output, State, callback, register_page, ctx
+from dash.exceptions import PreventUpdate
 import dash_bootstrap_components as dbc
+import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
 import random
 
-import emission.core.wrapper.user as ecwu
-import emission.core.get_database as edb
 import logging
 
+from utils import db_utils
+from utils.admission_utils import ServerBusy, BUSY_MESSAGE
+from utils.geo_utils import simplify_routes, selection_to_polygon
+from utils.import_utils import lazy_import
 from utils.permissions import has_permission
+from utils.store_utils import decode_frame, decode_aggregates, is_aggregated
+
+# e-mission modules, loaded on first use
+ecwu = lazy_import('emission.core.wrapper.user')
 
 register_page(__name__, path="/map")
 
 intro = """## Map"""
 
+DEFAULT_ZOOM = 11
+
 
 def create_lines_map(trips_group_by_user_id, user_id_list):
     start_lon, start_lat = 0, 0
@@ -32,13 +43,13 @@ def create_lines_map(trips_group_by_user_id, user_id_list):
 
         for i, trip in enumerate(trips):
             if i == 0:
-                start_lon = trip['start_coordinates'][0]
-                start_lat = trip['start_coordinates'][1]
+                start_lon = trip['data.start_loc.lon']
+                start_lat = trip['data.start_loc.lat']
             traces.append(
                 go.Scattermapbox(
                     mode="markers+lines",
-                    lon=[trip['start_coordinates'][0], trip['end_coordinates'][0]],
-                    lat=[trip['start_coordinates'][1], trip['end_coordinates'][1]],
+                    lon=[trip['data.start_loc.lon'], trip['data.end_loc.lon']],
+                    lat=[trip['data.start_loc.lat'], trip['data.end_loc.lat']],
                     marker={'size': 10, 'color': color},
                 )
             )
@@ -57,6 +68,53 @@ def create_lines_map(trips_group_by_user_id, user_id_list):
     return fig
 
 
+def create_trajectories_map(routes, users_data, user_id_list, zoom):
+    """
+    One trace per user, with the simplified routes of their trips separated by gaps, so that
+    thousands of trips are still a handful of traces. The routes are simplified for the zoom
+    level of the map (see utils/geo_utils.py).
+    """
+    if user_id_list:
+        routes = {key: route for key, route in routes.items() if route['user_id'] in user_id_list}
+    simplified, zoom_level = simplify_routes({key: route['points'] for key, route in routes.items()}, zoom)
+    users_routes = {}
+    for key, points in simplified.items():
+        users_routes.setdefault(routes[key]['user_id'], []).append(points)
+
+    traces = []
+    start_lon, start_lat = 0, 0
+    for user_id, user_routes in users_routes.items():
+        # a NaN row between two routes breaks the line
+        gap = np.full((1, 2), np.nan)
+        points = np.concatenate([part for route in user_routes for part in (route, gap)])
+        start_lon, start_lat = points[0]
+        traces.append(
+            go.Scattermapbox(
+                mode="lines",
+                lon=points[:, 0],
+                lat=points[:, 1],
+                line={'width': 2, 'color': users_data.get(user_id, {}).get('color', 'royalblue')},
+                name=user_id,
+            )
+        )
+
+    fig = go.Figure(data=traces)
+    fig.update_layout(
+        showlegend=False,
+        title=f"{len(simplified)} of {len(routes)} trip sections, "
+              f"{sum(len(points) for points in simplified.values())} points (simplified for zoom {zoom_level})",
+        margin={'l': 0, 't': 30, 'b': 0, 'r': 0},
+        mapbox_style="open-street-map",
+        mapbox_center_lon=start_lon,
+        mapbox_center_lat=start_lat,
+        mapbox_zoom=zoom,
+        # keep the view of the user when the routes are re-simplified after a zoom
+        uirevision='trajectories',
+        height=650,
+    )
+    return fig
+
+
 def create_heatmap_fig(data):
     fig = go.Figure()
     if len(data.get('lat', [])) > 0:
@@ -64,6 +122,8 @@ def create_heatmap_fig(data):
             go.Densitymapbox(
                 lon=data['lon'],
                 lat=data['lat'],
+                # the grid cell counts, when the trips were aggregated
+                z=data.get('weight'),
             )
         )
         fig.update_layout(
@@ -80,13 +140,18 @@ def create_heatmap_fig(data):
 def create_bubble_fig(data):
     fig = go.Figure()
     if len(data.get('lon', [])) > 0:
+        size = 9
+        if data.get('weight'):
+            # one bubble per grid cell, sized by the number of trip end points in it
+            weight = np.sqrt(np.asarray(data['weight'], dtype=float))
+            size = 5 + 20 * weight / weight.max()
         fig.add_trace(
             go.Scattermapbox(
                 lat=data['lat'],
                 lon=data['lon'],
                 mode='markers',
                 marker=go.scattermapbox.Marker(
-                    size=9,
+                    size=size,
                     color='royalblue',
                 ),
             )
@@ -106,7 +171,7 @@ def create_bubble_fig(data):
 
 def get_trips_group_by_user_id(trips_data):
     trips_group_by_user_id = None
-    trips_df = pd.DataFrame(trips_data['data'])
+    trips_df = decode_frame(trips_data)
     if not trips_df.empty:
         trips_group_by_user_id = trips_df.groupby('user_id')
     return trips_group_by_user_id
@@ -138,58 +203,85 @@ def create_user_emails_options(trips_group_by_user_id):
     if has_permission('options_emails'):
         for i, user_id in enumerate(trips_group_by_user_id):
             color = trips_group_by_user_id[user_id]['color']
-            logging.warn("dict is %s" % ecwu.User.fromUUID(UUID(user_id)).__dict__)
-            logging.warn("all users are %s" % list(edb.get_uuid_db().find()))
             try:
                 user_email = ecwu.User.fromUUID(UUID(user_id))._User__email
             except AttributeError as e:
                 continue
             user_emails.add(user_email)
             options.append(create_single_option(user_email, color))
+        logging.debug("Found the emails of %s of %s users" % (len(user_emails), len(trips_group_by_user_id)))
     return options, user_emails
 
-map_type_options = []
-if has_permission('map_heatmap'):
-    map_type_options.append({'label': 'Density Heatmap', 'value': 'heatmap'})
-if has_permission('map_bubble'):
-    map_type_options.append({'label': 'Bubble Map', 'value': 'bubble'})
-if has_permission('map_trip_lines'):
-    map_type_options.append({'label': 'Trips Lines', 'value': 'lines'})
-
-
-layout = html.Div(
-    [
-        dcc.Store(id="store-trips-map", data={}),
-        dcc.Markdown(intro),
-
-        dbc.Row([
-            dbc.Col(
-                [
-                    html.Label('Map Type'),
-                    dcc.Dropdown(id='map-type-dropdown', value='', options=map_type_options),
-                ],
-                xl=3,
-                lg=4,
-                sm=6,
-            )
-        ]),
-
-        dbc.Row([
-            dbc.Col([
-                html.Label('User UUIDs'),
-                dcc.Dropdown(id='user-id-dropdown', multi=True),
-            ], style={'display': 'block' if has_permission('options_uuids') else 'none'}),
-            dbc.Col([
-                html.Label('User Emails'),
-                dcc.Dropdown(id='user-email-dropdown', multi=True),
-            ], style={'display': 'block' if has_permission('options_emails') else 'none'})
-        ]),
-
-        dbc.Row(
-            dcc.Graph(id="trip-map")
-        ),
-    ]
-)
+def get_map_type_options():
+    map_type_options = []
+    if has_permission('map_heatmap'):
+        map_type_options.append({'label': 'Density Heatmap', 'value': 'heatmap'})
+    if has_permission('map_bubble'):
+        map_type_options.append({'label': 'Bubble Map', 'value': 'bubble'})
+    if has_permission('map_trip_lines'):
+        map_type_options.append({'label': 'Trips Lines', 'value': 'lines'})
+    if has_permission('map_trajectories'):
+        map_type_options.append({'label': 'Trajectories', 'value': 'trajectories'})
+    return map_type_options
+
+
+# a function so that the permissions are only checked when the page is displayed
+def layout():
+    return html.Div(
+        [
+            dcc.Store(id="store-trips-map", data={}),
+            dcc.Store(id="store-map-zoom", data=DEFAULT_ZOOM),
+            dcc.Markdown(intro),
+
+            dbc.Row([
+                dbc.Col(
+                    [
+                        html.Label('Map Type'),
+                        dcc.Dropdown(id='map-type-dropdown', value='', options=get_map_type_options()),
+                    ],
+                    xl=3,
+                    lg=4,
+                    sm=6,
+                )
+            ]),
+
+            dbc.Row([
+                dbc.Col([
+                    html.Label('User UUIDs'),
+                    dcc.Dropdown(id='user-id-dropdown', multi=True),
+                ], style={'display': 'block' if has_permission('options_uuids') else 'none'}),
+                dbc.Col([
+                    html.Label('User Emails'),
+                    dcc.Dropdown(id='user-email-dropdown', multi=True),
+                ], style={'display': 'block' if has_permission('options_emails') else 'none'})
+            ]),
+
+            dbc.Row([
+                dbc.Col([
+                    html.Label('Select a region with the box or lasso tool of the map, to keep the trips that'),
+                    dcc.RadioItems(
+                        id='region-match',
+                        options=[
+                            {'label': ' start in it', 'value': 'start'},
+                            {'label': ' end in it', 'value': 'end'},
+                            {'label': ' start or end in it', 'value': 'either'},
+                        ],
+                        value='either',
+                        inline=True,
+                        inputStyle={'margin-left': '10px'},
+                    ),
+                ]),
+                dbc.Col([
+                    html.Span(id='region-status', style={'margin-right': '10px'}),
+                    dbc.Button('Clear region', id='button-clear-region', size='sm', color='secondary'),
+                ], style={'text-align': 'right'}),
+            ], style={'margin-top': '10px'}),
+
+            dbc.Row(
+                dcc.Graph(id="trip-map")
+            ),
+        ]
+    )
 
 @callback(
     Output('user-id-dropdown', 'options'),
@@ -217,25 +309,66 @@ def update_user_emails_options(trips_data, selected_user_emails):
     return user_emails_options, selected_user_emails
 
 
+@callback(
+    Output('store-map-zoom', 'data'),
+    Input('trip-map', 'relayoutData'),
+    State('store-map-zoom', 'data'),
+)
+def update_map_zoom(relayout_data, zoom):
+    # only a change of the (integer) zoom level calls for re-simplifying the routes
+    new_zoom = (relayout_data or {}).get('mapbox.zoom')
+    if new_zoom is None or int(new_zoom) == int(zoom):
+        raise PreventUpdate
+    return new_zoom
+
+
+def get_trajectories_date_range(date_range):
+    start_date, end_date = date_range.get('start_date'), date_range.get('end_date')
+    if not start_date or not end_date:
+        end_date_obj = date.today()
+        start_date_obj = end_date_obj - timedelta(days=7)
+    else:
+        start_date_obj = date.fromisoformat(start_date)
+        end_date_obj = date.fromisoformat(end_date)
+    return start_date_obj, end_date_obj
+
+
 @callback(
     Output('trip-map', 'figure'),
     Input('map-type-dropdown', 'value'),
     Input('user-id-dropdown', 'value'),
     Input('user-email-dropdown', 'value'),
+    Input('store-map-zoom', 'data'),
     State('store-trips-map', 'data'),
+    State('store-date-range', 'data'),
 )
-def update_output(map_type, selected_user_ids, selected_user_emails, trips_data):
+def update_output(map_type, selected_user_ids, selected_user_emails, zoom, trips_data, date_range):
+    if ctx.triggered_id == 'store-map-zoom' and map_type != 'trajectories':
+        # the other maps do not depend on the zoom
+        raise PreventUpdate
     user_ids = set(selected_user_ids) if selected_user_ids is not None else set()
     if selected_user_emails is not None:
         for user_email in selected_user_emails:
             user_ids.add(str(ecwu.User.fromEmail(user_email).uuid))
 
     if map_type == 'lines':
+        if trips_data.get('aggregated'):
+            fig = go.Figure()
+            fig.update_layout(title='Too many trips in the selected range to draw them, select a shorter range')
+            return fig
         return create_lines_map(trips_data.get('users_data', {}), user_ids)
     elif map_type == 'heatmap':
         return create_heatmap_fig(trips_data.get('coordinates', {}))
     elif map_type == 'bubble':
         return create_bubble_fig(trips_data.get('coordinates', {}))
+    elif map_type == 'trajectories':
+        try:
+            routes = db_utils.query_trip_routes(*get_trajectories_date_range(date_range))
+        except ServerBusy:
+            fig = go.Figure()
+            fig.update_layout(title=BUSY_MESSAGE)
+            return fig
+        return create_trajectories_map(routes, trips_data.get('users_data', {}), user_ids, zoom)
     else:
         return go.Figure()
 
@@ -247,16 +380,64 @@ def update_output(map_type, selected_user_ids, selected_user_emails, trips_data)
 )
 def control_user_dropdowns(map_type):
     disabled = True
-    if map_type == 'lines':
+    if map_type in ('lines', 'trajectories'):
         disabled = False
     return disabled, disabled
 
 
+@callback(
+    Output('store-region', 'data'),
+    Input('trip-map', 'selectedData'),
+    Input('region-match', 'value'),
+    Input('button-clear-region', 'n_clicks'),
+    State('store-region', 'data'),
+)
+def update_region(selected_data, match, n_clicks, region):
+    if ctx.triggered_id == 'button-clear-region':
+        return None
+    if ctx.triggered_id == 'region-match':
+        if not region:
+            raise PreventUpdate
+        return {**region, 'match': match}
+    polygon = selection_to_polygon(selected_data)
+    if polygon is None:
+        raise PreventUpdate
+    return {'polygon': polygon, 'match': match}
+
+
+@callback(
+    Output('region-status', 'children'),
+    Input('store-region-trips', 'data'),
+)
+def update_region_status(region_trips_data):
+    if not region_trips_data:
+        return 'No region selected.'
+    if 'error' in region_trips_data:
+        return region_trips_data['error']
+    status = f"{region_trips_data['length']} trips in the selected region"
+    if region_trips_data.get('truncated'):
+        status += ' (only the first ones are shown)'
+    return status + '.'
+
+
 @callback(
     Output('store-trips-map', 'data'),
     Input('store-trips', 'data'),
+    Input('store-region-trips', 'data'),
 )
-def store_trips_map_data(trips_data):
+def store_trips_map_data(trips_data, region_trips_data):
+    if region_trips_data and 'error' not in region_trips_data:
+        # a region is selected, only show the trips in it
+        trips_data = region_trips_data
+    if is_aggregated(trips_data):
+        cells_df = decode_aggregates(trips_data)['cells']
+        coordinates = {
+            'lat': cells_df['lat'].tolist(),
+            'lon': cells_df['lon'].tolist(),
+            'weight': cells_df['count'].tolist(),
+        }
+        return {'users_data': {}, 'coordinates': coordinates, 'aggregated': True}
+
     trips_group_by_user_id = get_trips_group_by_user_id(trips_data)
     users_data = dict()
     coordinates = {'lat': [], 'lon': []}
@@ -266,11 +447,9 @@ def store_trips_map_data(trips_data):
         k = 359 // (n - 1) if n > 1 else 0
         for ind, user_id in enumerate(trips_group_by_user_id.groups.keys()):
             color = f'hsl({ind * k}, 100%, 50%)'
-            trips = trips_group_by_user_id.get_group(user_id).sort_values('trip_start_time_str').to_dict("records")
-            users_data[user_id] = {'color': color, 'trips': trips}
-            for trip in trips:
-                coordinates['lon'].append(trip['start_coordinates'][0])
-                coordinates['lon'].append(trip['end_coordinates'][0])
-                coordinates['lat'].append(trip['start_coordinates'][1])
-                coordinates['lat'].append(trip['end_coordinates'][1])
+            trips_df = trips_group_by_user_id.get_group(user_id).sort_values('data.start_ts')
+            users_data[user_id] = {'color': color, 'trips': trips_df.to_dict("records")}
+            # the start and the end of every trip, interleaved
+            coordinates['lon'] += np.column_stack([trips_df['data.start_loc.lon'], trips_df['data.end_loc.lon']]).ravel().tolist()
+            coordinates['lat'] += np.column_stack([trips_df['data.start_loc.lat'], trips_df['data.end_loc.lat']]).ravel().tolist()
     return {'users_data': users_data, 'coordinates': coordinates}
@@ -9,111 +9,121 @@ from uuid import UUID
 from dash import dcc, html, Input, Output, State, callback, register_page
 import pandas as pd
 
-import emission.storage.decorations.user_queries as esdu
-import emission.core.wrapper.user as ecwu
-import emission.net.ext_service.push.notify_usage as pnu
+from utils.import_utils import lazy_import
 from utils.permissions import has_permission
+from utils.store_utils import decode_frame
 
+# the e-mission user and push modules are only loaded when a push is actually sent
+esdu = lazy_import('emission.storage.decorations.user_queries')
+ecwu = lazy_import('emission.core.wrapper.user')
+pnu = lazy_import('emission.net.ext_service.push.notify_usage')
 
-if has_permission('push_send'):
-    register_page(__name__, path="/push_notification")
+# The page is always registered so that the permissions do not have to be loaded at
+# import time; the layout checks them instead
+register_page(__name__, path="/push_notification")
 
 intro = """
 ## Push notification
 """
 
-push_receiver_options = [{'label': 'All users', 'value': 'all'}]
-if has_permission('options_emails'):
-    push_receiver_options.append({'label': 'User Emails', 'value': 'email'})
-if has_permission('options_uuids'):
-    push_receiver_options.append({'label': 'User UUIDs', 'value': 'uuid'})
-
-
-layout = html.Div([
-    dcc.Markdown(intro),
-    html.Div([
-        html.Div(children=[
-            html.Label('Sending to:'),
-            dcc.RadioItems(
-                className='radio-items',
-                id='push-receiver-options',
-                options=push_receiver_options,
-                value='all',
-                style={
-                    'padding': '5px',
-                    'margin': 'auto'
-                }
-            ),
-
-            html.Div([
-                html.Label('User Emails', style={'padding-top': '5px'}),
-                dcc.Dropdown(multi=True, disabled=True, id='push-user-emails'),
-            ], style={'display': 'block' if has_permission('options_emails') else 'none'}),
-
-            html.Div([
-                html.Label('UUIDs', style={'padding-top': '5px'}),
-                dcc.Dropdown(multi=True, disabled=True, id='push-user-uuids'),
-            ], style={'display': 'block' if has_permission('options_uuids') else 'none'}),
-
-            html.Br(),
-            html.Label('Survey Specs'),
-            dcc.Dropdown(options=["Notify", "Survey", "Popup", "Website"], value='Notify', id='push-survey-spec'),
-
-            html.Br(),
-            dcc.Checklist(
-                className='radio-items',
-                id='push-log-options',
-                options=[
-                    {'label': 'Show UUIDs', 'value': 'show-uuids'},
-                    {'label': 'Show Emails', 'value': 'show-emails'},
-                    {'label': 'Dry Run', 'value': 'dry-run'},
-                ],
-                value=['show-uuids'],
-                style={
-                    'padding': '5px',
-                    'margin': 'auto'
-                }
-            ),
-
-            html.Label('Log Messages'),
-            dcc.Textarea(value='We can follow sending push here', id='push-log', disabled=True, style={
-                'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
-                'margin-right': '5px', 'height':'200px', 'verticalAlign': 'top', 'background-color': '#d4c49b',
-                'overflow': 'hidden',
-            })
-        ], style={'padding': 10, 'flex': 1}),
-
-        html.Div(children=[
-            html.Label('Title'),
-            html.Br(),
-            dcc.Textarea(value='', id='push-title', style={
-                'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
-                'margin-right': '5px', 'height': '30px', 'verticalAlign': 'top', 'background-color': '#b4dbf0',
-                'overflow': 'hidden',
-            }),
-
-            html.Label('Message'),
-            html.Br(),
-            dcc.Textarea(value='', id='push-message', style={
-                'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
-                'margin-right': '5px', 'height':'100px', 'verticalAlign': 'top', 'background-color': '#b4dbf0',
-                'overflow': 'hidden',
-            }),
-            html.Br(),
-
-            html.Button(children='Send', id='push-send-button', n_clicks=0, style={
-                'font-size': '14px', 'width': '140px', 'display': 'block', 'margin-bottom': '10px',
-                'margin-right': '5px', 'height':'40px', 'verticalAlign': 'top', 'background-color': 'green',
-                'color': 'white',
-            }),
-            html.Button(children='Clear Message', id='push-clear-message-button', n_clicks=0, style={
-                'font-size': '14px', 'width': '140px', 'display': 'block', 'margin-bottom': '10px',
-                'margin-right': '5px', 'height':'40px', 'verticalAlign': 'top', 'background-color': 'red',
-                'color': 'white',
-            }),
-        ], style={'padding': 10, 'flex': 1})
-    ], style={'display': 'flex', 'flex-direction': 'row'})
-])
+
+def get_push_receiver_options():
+    push_receiver_options = [{'label': 'All users', 'value': 'all'}]
+    if has_permission('options_emails'):
+        push_receiver_options.append({'label': 'User Emails', 'value': 'email'})
+    if has_permission('options_uuids'):
+        push_receiver_options.append({'label': 'User UUIDs', 'value': 'uuid'})
+    return push_receiver_options
+
+
+def layout():
+    if not has_permission('push_send'):
+        return dcc.Markdown(intro + "\nYou do not have the permission to send push notifications.")
+    return html.Div([
+        dcc.Markdown(intro),
+        html.Div([
+            html.Div(children=[
+                html.Label('Sending to:'),
+                dcc.RadioItems(
+                    className='radio-items',
+                    id='push-receiver-options',
+                    options=get_push_receiver_options(),
+                    value='all',
+                    style={
+                        'padding': '5px',
+                        'margin': 'auto'
+                    }
+                ),
+
+                html.Div([
+                    html.Label('User Emails', style={'padding-top': '5px'}),
+                    dcc.Dropdown(multi=True, disabled=True, id='push-user-emails'),
+                ], style={'display': 'block' if has_permission('options_emails') else 'none'}),
+
+                html.Div([
+                    html.Label('UUIDs', style={'padding-top': '5px'}),
+                    dcc.Dropdown(multi=True, disabled=True, id='push-user-uuids'),
+                ], style={'display': 'block' if has_permission('options_uuids') else 'none'}),
+
+                html.Br(),
+                html.Label('Survey Specs'),
+                dcc.Dropdown(options=["Notify", "Survey", "Popup", "Website"], value='Notify', id='push-survey-spec'),
+
+                html.Br(),
+                dcc.Checklist(
+                    className='radio-items',
+                    id='push-log-options',
+                    options=[
+                        {'label': 'Show UUIDs', 'value': 'show-uuids'},
+                        {'label': 'Show Emails', 'value': 'show-emails'},
+                        {'label': 'Dry Run', 'value': 'dry-run'},
+                    ],
+                    value=['show-uuids'],
+                    style={
+                        'padding': '5px',
+                        'margin': 'auto'
+                    }
+                ),
+
+                html.Label('Log Messages'),
+                dcc.Textarea(value='We can follow sending push here', id='push-log', disabled=True, style={
+                    'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
+                    'margin-right': '5px', 'height':'200px', 'verticalAlign': 'top', 'background-color': '#d4c49b',
+                    'overflow': 'hidden',
+                })
+            ], style={'padding': 10, 'flex': 1}),
+
+            html.Div(children=[
+                html.Label('Title'),
+                html.Br(),
+                dcc.Textarea(value='', id='push-title', style={
+                    'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
+                    'margin-right': '5px', 'height': '30px', 'verticalAlign': 'top', 'background-color': '#b4dbf0',
+                    'overflow': 'hidden',
+                }),
+
+                html.Label('Message'),
+                html.Br(),
+                dcc.Textarea(value='', id='push-message', style={
+                    'font-size': '14px', 'width': '100%', 'display': 'block', 'margin-bottom': '10px',
+                    'margin-right': '5px', 'height':'100px', 'verticalAlign': 'top', 'background-color': '#b4dbf0',
+                    'overflow': 'hidden',
+                }),
+                html.Br(),
+
+                html.Button(children='Send', id='push-send-button', n_clicks=0, style={
+                    'font-size': '14px', 'width': '140px', 'display': 'block', 'margin-bottom': '10px',
+                    'margin-right': '5px', 'height':'40px', 'verticalAlign': 'top', 'background-color': 'green',
+                    'color': 'white',
+                }),
+                html.Button(children='Clear Message', id='push-clear-message-button', n_clicks=0, style={
+                    'font-size': '14px', 'width': '140px', 'display': 'block', 'margin-bottom': '10px',
+                    'margin-right': '5px', 'height':'40px', 'verticalAlign': 'top', 'background-color': 'red',
+                    'color': 'white',
+                }),
+            ], style={'padding': 10, 'flex': 1})
+        ], style={'display': 'flex', 'flex-direction': 'row'})
+    ])
 
 @callback(
     Output('push-user-emails', 'disabled'),
@@ -138,7 +148,7 @@ def handle_receivers(value):
 def populate_data(uuids_data):
     emails = list()
     uuids = list()
-    uuids_df = pd.DataFrame(uuids_data.get('data'))
+    uuids_df = decode_frame(uuids_data)
     if has_permission('options_emails'):
         emails = uuids_df['user_token'].tolist()
     if has_permission('options_uuids'):
@@ -7,8 +7,11 @@ The workaround is to check if the input value is None.
 
 
 import dash
-from dash import dcc, html, Input, Output, State, callback, register_page
+from dash import dcc, html, Input, Output, State, callback, register_page, dash_table
 import dash_bootstrap_components as dbc
+import plotly.graph_objects as go
+
+from utils import instrumentation
 
 register_page(__name__, path="/settings")
 
@@ -17,9 +20,63 @@ intro = """
 
 """
 
+performance_intro = f"""
+### Performance
+
+Latencies of the callbacks, store loaders and queries handled by this worker process. Anything slower than
+{instrumentation.SLOW_THRESHOLD_SECONDS}s is listed in the slow log. All the metrics are also
+available in the Prometheus format at [/metrics](/metrics).
+"""
+
 
 layout = html.Div(
     [
-        dcc.Markdown(intro)
+        dcc.Markdown(intro),
+        dcc.Markdown(performance_intro),
+        dcc.Interval(id='interval-performance', interval=5 * 1000),
+        dbc.Row(
+            dcc.Graph(id='fig-latency-histogram'),
+        ),
+        html.P(id='text-compression-savings'),
+        html.H5('Slow log'),
+        html.Div(id='table-slow-log'),
     ]
 )
+
+
+def create_latency_histogram(samples_df):
+    fig = go.Figure()
+    for (kind, name), group in samples_df.groupby(['kind', 'name']):
+        fig.add_trace(go.Histogram(x=group['duration'], name=f"{kind}: {name}", opacity=0.75))
+    fig.update_layout(
+        barmode='overlay',
+        title='Latency of the recent callbacks, loaders and queries',
+        xaxis_title='seconds',
+        yaxis_title='count',
+    )
+    return fig
+
+
+@callback(
+    Output('fig-latency-histogram', 'figure'),
+    Output('table-slow-log', 'children'),
+    Output('text-compression-savings', 'children'),
+    Input('interval-performance', 'n_intervals'),
+)
+def update_performance(n_intervals):
+    fig = create_latency_histogram(instrumentation.get_recent_samples())
+    savings = instrumentation.get_compression_savings()
+    savings_text = 'Response compression saved ' + (
+        ', '.join(f"{saved / 1e6:.1f} MB ({encoding})" for encoding, saved in savings.items()) or '0 MB'
+    )
+    slow_log = instrumentation.get_slow_log()
+    if not slow_log:
+        return fig, html.P('No slow callbacks or queries so far.'), savings_text
+    table = dash_table.DataTable(
+        data=slow_log,
+        sort_action="native",
+        page_size=20,
+        style_cell={'textAlign': 'left'},
+        style_table={'overflowX': 'auto'},
+    )
+    return fig, table, savings_text
@@ -1,4 +1,3 @@
-import os
 import zipfile
 
 import pandas as pd
@@ -6,21 +5,25 @@ import pandas as pd
 import dash_bootstrap_components as dbc
 from dash import dcc, html, Input, Output, callback, State, register_page, dash_table
 
-from emission.storage.decorations.token_queries import insert_many_tokens
-import emission.core.get_database as edb
-
-from utils.generate_qr_codes import saveAsQRCode
 from utils.generate_random_tokens import generateRandomTokensForProgram
+from utils.import_utils import lazy_import
 from utils.permissions import get_token_prefix, has_permission
 
 
-if has_permission('token_generate'):
-    register_page(__name__, path="/tokens")
+# e-mission modules, loaded on first use
+estq = lazy_import('emission.storage.decorations.token_queries')
+edb = lazy_import('emission.core.get_database')
+# qrcode and PIL are only needed once tokens are generated
+qr_utils = lazy_import('utils.generate_qr_codes')
+
+# The page is always registered so that the permissions do not have to be loaded at
+# import time; the layout checks them instead
+register_page(__name__, path="/tokens")
 
 intro = """## Tokens"""
 QRCODE_PATH = 'assets/qrcodes'
 
-layout = html.Div(
+token_page = html.Div(
     [
         dcc.Markdown(intro),
         dbc.Row([
@@ -88,6 +91,15 @@ layout = html.Div(
         html.Div(id='token-table'),
 
         html.Br(),
+        html.Label('QR codes format'),
+        dcc.RadioItems(
+            id='token-export-format',
+            # PNG is rendered on demand, for the printing vendors that need raster images
+            options=[{'label': 'SVG', 'value': 'svg'}, {'label': 'PNG', 'value': 'png'}],
+            value='svg',
+            inline=True,
+            inputStyle={'margin-right': '5px', 'margin-left': '10px'},
+        ),
         html.Button(children='Export QR codes', id='token-export', n_clicks=0, style={
             'font-size': '14px', 'width': '140px', 'display': 'block', 'margin-bottom': '10px',
             'margin-right': '5px', 'height':'40px', 'verticalAlign': 'top', 'background-color': 'green',
@@ -96,6 +108,12 @@ layout = html.Div(
     ]
 )
 
+def layout():
+    if not has_permission('token_generate'):
+        return dcc.Markdown(intro + "\n\nYou do not have the permission to generate tokens.")
+    return token_page
+
+
 @callback(
     Output('token-generate', 'n_clicks'),
     Output('token-table', 'children'),
@@ -110,9 +128,9 @@ def generate_tokens(n_clicks, program, token_length, token_count, out_format, ch
     if n_clicks is not None and n_clicks > 0:
         token_prefix = get_token_prefix() + program + ('_test' if 'test-token' in checklist else '')
         tokens = generateRandomTokensForProgram(token_prefix, token_length, token_count, out_format)
-        insert_many_tokens(tokens)
+        estq.insert_many_tokens(tokens)
         for token in tokens:
-            saveAsQRCode(QRCODE_PATH, token)
+            qr_utils.saveAsQRCode(QRCODE_PATH, token)
     tokens_table = populate_datatable()
     return 0, tokens_table
 
@@ -120,18 +138,18 @@ def generate_tokens(n_clicks, program, token_length, token_count, out_format, ch
 @callback(
     Output('download-token', 'data'),
     Input('token-export', 'n_clicks'),
+    State('token-export-format', 'value'),
 )
-def export_tokens(n_clicks):
-    def zip_directory(bytes_io):
-        with zipfile.ZipFile(bytes_io, mode="w") as zf:
-            len_dir_path = len(QRCODE_PATH)
-            for root, _, files in os.walk(QRCODE_PATH):
-                for img in files:
-                    file_path = os.path.join(root, img)
-                    zf.write(file_path, file_path[len_dir_path:])
+def export_tokens(n_clicks, fmt):
+    def zip_qrcodes(bytes_io):
+        tokens = query_tokens()
+        # the cached files are content-addressed, they are named after their token in the zip
+        with zipfile.ZipFile(bytes_io, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for token in tokens.get('token', []):
+                zf.write(qr_utils.saveAsQRCode(QRCODE_PATH, token, fmt), f"{token}.{fmt}")
 
     if n_clicks > 0:
-        return dcc.send_bytes(zip_directory, "tokens.zip")
+        return dcc.send_bytes(zip_qrcodes, "tokens.zip")
 
 
 def populate_datatable():
@@ -139,7 +157,10 @@ def populate_datatable():
     if df.empty:
         return None
     df['id'] = df.index + 1
-    df['qr_code'] = "<img src='" + QRCODE_PATH + "/" + df['token'] + ".png' height='100px' />"
+    # renders the codes of the tokens created before the current template, the others are cached
+    df['qr_code'] = [
+        f"<img src='{qr_utils.saveAsQRCode(QRCODE_PATH, token)}' height='100px' />" for token in df['token']
+    ]
     df = df.reindex(columns=['id', 'token', 'qr_code'])
     return dash_table.DataTable(
         id='tokens-table',
@@ -0,0 +1,210 @@
+"""
+Drill-down into a single participant: /user/<user_id>
+
+Unlike the other pages, this one does not use the global stores. Every section runs its own
+small query bounded by the user_id (see the query_user_* functions of db_utils), so looking at
+one participant does not load the trips of the whole deployment.
+"""
+from uuid import UUID
+
+import dash
+from dash import dcc, html, Input, Output, State, callback, register_page, dash_table
+import dash_bootstrap_components as dbc
+from dash.exceptions import PreventUpdate
+import plotly.graph_objects as go
+
+from utils import constants
+from utils import db_utils
+from utils import permissions as perm_utils
+from utils.admission_utils import ServerBusy, BUSY_MESSAGE
+from utils.import_utils import lazy_import
+
+# plotly express is slow to import, so it is loaded on first use
+px = lazy_import('plotly.express')
+
+register_page(__name__, path_template="/user/<user_id>")
+
+TRIPS_PAGE_SIZE = 20
+API_CALLS_LIMIT = 500
+
+
+def is_valid_user_id(user_id):
+    try:
+        UUID(user_id)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def layout(user_id=None, **kwargs):
+    if not is_valid_user_id(user_id):
+        return html.Div([dcc.Markdown("## User"), html.P(f"{user_id} is not a valid user id.")])
+    return html.Div(
+        [
+            dcc.Markdown(f"## User {user_id}"),
+            dcc.Store(id='store-user-id', data=user_id),
+
+            html.H5('Profile'),
+            html.Div(id='user-profile'),
+
+            html.H5('Trips', style={'margin-top': '20px'}),
+            html.Div(id='user-trips'),
+            dcc.Graph(id='fig-user-trajectory'),
+
+            html.H5('Server API calls'),
+            dcc.Graph(id='fig-user-api-calls'),
+        ]
+    )
+
+
+@callback(
+    Output('user-profile', 'children'),
+    Input('store-user-id', 'data'),
+)
+def update_user_profile(user_id):
+    if not perm_utils.has_permission('data_uuids'):
+        return None
+    try:
+        user = db_utils.query_user_profile(user_id)
+    except ServerBusy:
+        return html.P(BUSY_MESSAGE)
+    if user is None:
+        return html.P('Unknown user.')
+    columns = perm_utils.get_permission_profile().uuids_columns
+    rows = [
+        {'field': col, 'value': str(user[col])}
+        for col in constants.valid_uuids_columns if col in columns and col in user
+    ]
+    return dash_table.DataTable(
+        data=rows,
+        style_cell={'textAlign': 'left'},
+        style_table={'width': 'auto'},
+    )
+
+
+@callback(
+    Output('user-trips', 'children'),
+    Input('store-user-id', 'data'),
+)
+def create_user_trips_table(user_id):
+    if not perm_utils.has_permission('data_trips'):
+        return None
+    # the rows are loaded by update_user_trips_page, one page at a time
+    return html.Div([
+        dash_table.DataTable(
+            id='datatable-user-trips',
+            page_action="custom",
+            page_current=0,
+            page_size=TRIPS_PAGE_SIZE,
+            row_selectable="single",
+            style_cell={'textAlign': 'left'},
+            style_table={'overflowX': 'auto'},
+        ),
+        # where the loaded pages start (see db_utils.get_page_cursor)
+        dcc.Store(id='store-user-trips-page-keys', data={}),
+        dbc.Alert(
+            [
+                html.Span(BUSY_MESSAGE),
+                dbc.Button('Retry', id='button-user-trips-retry', size='sm', color='warning', className='ms-3'),
+            ],
+            id='alert-user-trips-busy',
+            color='warning',
+            is_open=False,
+        ),
+    ])
+
+
+@callback(
+    Output('datatable-user-trips', 'data'),
+    Output('datatable-user-trips', 'columns'),
+    Output('datatable-user-trips', 'page_count'),
+    Output('datatable-user-trips', 'selected_rows'),
+    Output('store-user-trips-page-keys', 'data'),
+    Output('alert-user-trips-busy', 'is_open'),
+    Input('datatable-user-trips', 'page_current'),
+    Input('datatable-user-trips', 'page_size'),
+    Input('button-user-trips-retry', 'n_clicks'),
+    State('store-user-id', 'data'),
+    State('datatable-user-trips', 'page_count'),
+    State('store-user-trips-page-keys', 'data'),
+)
+def update_user_trips_page(page_current, page_size, n_clicks, user_id, page_count, page_keys):
+    if page_current is None or not perm_utils.has_permission('data_trips'):
+        raise PreventUpdate
+    after, skip = db_utils.get_page_cursor(page_keys, page_current, page_size)
+    try:
+        df = db_utils.query_user_trips_page(user_id, after, page_size, skip)
+    except ServerBusy:
+        # keep the current page, the retry button loads the page again
+        return (dash.no_update,) * 5 + (True,)
+    page_keys = db_utils.add_page_key(page_keys, page_current, df)
+    columns = perm_utils.get_permission_profile().trips_table_columns | {'trip_id'}
+    df = df.drop(columns=[col for col in df.columns if col not in columns])
+    df = db_utils.to_display_units(df)
+    # we do not count the trips up front, so let the user page on until a page is short
+    if len(df) == page_size:
+        page_count = max(page_count or 0, page_current + 2)
+    else:
+        page_count = page_current + 1
+    # the selection is an index into the rows, so it would point at another trip of the new page
+    return df.to_dict('records'), db_utils.get_trips_datatable_columns(df.columns), page_count, [], page_keys, False
+
+
+@callback(
+    Output('fig-user-trajectory', 'figure'),
+    Input('datatable-user-trips', 'selected_rows'),
+    State('datatable-user-trips', 'data'),
+    State('store-user-id', 'data'),
+)
+def update_user_trajectory(selected_rows, trips, user_id):
+    fig = go.Figure()
+    fig.update_layout(title='Select a trip to see its trajectory')
+    if not selected_rows or not trips or not perm_utils.has_permission('data_trajectories'):
+        return fig
+    trip = trips[selected_rows[0]]
+    try:
+        df = db_utils.query_user_trip_trajectory(user_id, trip['trip_id'])
+    except ServerBusy:
+        fig.update_layout(title=BUSY_MESSAGE)
+        return fig
+    if df.empty or not {'data.longitude', 'data.latitude'} <= perm_utils.get_trajectories_columns(df.columns):
+        return fig
+    fig.add_trace(
+        go.Scattermapbox(
+            lon=df['data.longitude'],
+            lat=df['data.latitude'],
+            mode='markers+lines',
+            text=df['data.mode_str'],
+            marker={'size': 6},
+        )
+    )
+    fig.update_layout(
+        title=f"Trajectory of the trip {trip['trip_id']}",
+        mapbox_style='open-street-map',
+        mapbox_center_lon=df['data.longitude'].iloc[0],
+        mapbox_center_lat=df['data.latitude'].iloc[0],
+        mapbox_zoom=12,
+        margin={'r': 0, 't': 30, 'l': 0, 'b': 0},
+        height=500,
+    )
+    return fig
+
+
+@callback(
+    Output('fig-user-api-calls', 'figure'),
+    Input('store-user-id', 'data'),
+)
+def update_user_api_calls(user_id):
+    if not perm_utils.has_permission('data_uuids'):
+        return go.Figure()
+    try:
+        df = db_utils.query_user_api_calls(user_id, API_CALLS_LIMIT)
+    except ServerBusy:
+        fig = go.Figure()
+        fig.update_layout(title=BUSY_MESSAGE)
+        return fig
+    if df.empty:
+        return go.Figure()
+    fig = px.scatter(df, x='time', y='name', hover_data=['duration'])
+    fig.update_layout(title=f"Last {len(df)} calls to the server", yaxis_title=None)
+    return fig
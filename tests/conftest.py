@@ -0,0 +1,20 @@
+import os
+import sys
+
+# make the dashboard modules importable, like benchmarks/run_benchmarks.py does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# utils.permissions builds the config URL from these when it is imported; the tests set the
+# config themselves (see the `config` fixture), so it is never fetched
+os.environ.setdefault('CONFIG_PATH', 'http://localhost/')
+os.environ.setdefault('STUDY_CONFIG', 'test')
+
+import pytest
+
+
+@pytest.fixture
+def config():
+    """A MULTILABEL study config with no column exclusions"""
+    from utils import permissions as perm_utils
+    perm_utils.set_config({'admin_dashboard': {}})
+    return perm_utils
@@ -0,0 +1,79 @@
+import pytest
+
+admission_utils = pytest.importorskip('utils.admission_utils')
+AdmissionController = admission_utils.AdmissionController
+ServerBusy = admission_utils.ServerBusy
+
+
+def controller(capacity=8, reserved_light=2):
+    # no waiting, so that a query that does not fit is rejected right away
+    return AdmissionController(capacity, reserved_light, max_waiters=0, timeout=0)
+
+
+def test_weights():
+    c = controller()
+    assert c.acquire('light') == 1
+    assert c.acquire('medium') == 2
+    assert c.acquire('heavy') == 4
+    assert c.in_use == 7
+
+
+def test_the_reserve_is_only_for_light_queries():
+    c = controller()
+    for _ in range(3):
+        c.acquire('medium')
+    assert c.in_use == 6
+    with pytest.raises(ServerBusy):
+        c.acquire('medium')
+    # the 2 reserved units still take light queries
+    c.acquire('light')
+    c.acquire('light')
+    with pytest.raises(ServerBusy):
+        c.acquire('light')
+
+
+def test_release_makes_room_again():
+    c = controller()
+    weight = c.acquire('heavy')
+    with pytest.raises(ServerBusy):
+        c.acquire('heavy')
+    c.release(weight)
+    assert c.acquire('heavy') == 4
+
+
+def test_a_query_heavier_than_the_limit_runs_alone():
+    c = controller(capacity=4, reserved_light=2)
+    # capped at the 2 units that the heavy queries can use
+    assert c.acquire('heavy') == 2
+    with pytest.raises(ServerBusy):
+        c.acquire('medium')
+
+
+def test_nested_queries_do_not_take_more_capacity():
+    c = controller()
+    with c.admitted('heavy'):
+        with c.admitted('heavy'):
+            assert c.in_use == 4
+    assert c.in_use == 0
+
+
+def test_holding_runs_the_queries_on_acquired_units():
+    c = controller()
+    weight = c.acquire('heavy')
+    with c.holding():
+        with c.admitted('heavy'):
+            assert c.in_use == 4
+    c.release(weight)
+    assert c.in_use == 0
+
+
+def test_admit_releases_when_the_query_fails():
+    c = controller()
+
+    @c.admit('medium')
+    def query():
+        raise ValueError('failed')
+
+    with pytest.raises(ValueError):
+        query()
+    assert c.in_use == 0
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+cache_utils = pytest.importorskip('utils.cache_utils')
+instrumentation = pytest.importorskip('utils.instrumentation')
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_single_flight_shares_the_error_of_the_running_call():
+    started = threading.Event()
+    finish = threading.Event()
+    calls = []
+
+    @cache_utils.single_flight()
+    def failing_query(key):
+        calls.append(key)
+        started.set()
+        finish.wait(5)
+        raise ValueError(key)
+
+    errors = []
+
+    def call():
+        try:
+            failing_query('a')
+        except ValueError as e:
+            errors.append(e)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    # the follower counts itself as shared before it waits for the leader
+    wait_for(lambda: instrumentation.counters['single_flight_shared'].get('failing_query'))
+    finish.set()
+    leader.join(5)
+    follower.join(5)
+
+    assert calls == ['a']
+    assert len(errors) == 2
+    assert errors[0] is errors[1]
+
+
+def test_single_flight_runs_again_after_the_call_is_done():
+    calls = []
+
+    @cache_utils.single_flight()
+    def query(key):
+        calls.append(key)
+        return key
+
+    assert query('a') == 'a'
+    assert query('a') == 'a'
+    assert calls == ['a', 'a']
+
+
+def test_ttl_cache_is_keyed_by_the_scope():
+    scope = ['v1']
+    calls = []
+
+    @cache_utils.ttl_cache(60, lambda: scope[0])
+    def query(key):
+        calls.append((scope[0], key))
+        return len(calls)
+
+    assert query('a') == 1
+    assert query('a') == 1
+    scope[0] = 'v2'
+    assert query('a') == 2
+    assert calls == [('v1', 'a'), ('v2', 'a')]
+
+
+def test_ttl_cache_expires():
+    calls = []
+
+    @cache_utils.ttl_cache(0)
+    def query():
+        calls.append(1)
+
+    query()
+    query()
+    assert len(calls) == 2
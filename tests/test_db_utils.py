@@ -0,0 +1,68 @@
+from uuid import UUID
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+db_utils = pytest.importorskip('utils.db_utils')
+
+TRIP_ID = '64c0f0f0f0f0f0f0f0f0f0f0'
+
+
+def test_first_page_cursor():
+    assert db_utils.get_page_cursor({}, 0, 50) == (None, 0)
+    assert db_utils.get_page_cursor(None, 0, 50) == (None, 0)
+    # a jump ahead skips from the start
+    assert db_utils.get_page_cursor({}, 3, 50) == (None, 150)
+
+
+def test_page_cursor_from_the_closest_loaded_page():
+    page_keys = {'1': [100.0, TRIP_ID], '2': [200.0, TRIP_ID]}
+    assert db_utils.get_page_cursor(page_keys, 2, 50) == ((200.0, TRIP_ID), 0)
+    assert db_utils.get_page_cursor(page_keys, 5, 50) == ((200.0, TRIP_ID), 150)
+    assert db_utils.get_page_cursor(page_keys, 0, 50) == (None, 0)
+
+
+def test_add_page_key():
+    df = pd.DataFrame({'data.start_ts': [100, 150], 'trip_id': ['a' * 24, TRIP_ID]})
+    page_keys = {'1': [50.0, 'a' * 24]}
+    assert db_utils.add_page_key(page_keys, 1, df) == {'1': [50.0, 'a' * 24], '2': [150.0, TRIP_ID]}
+    # the keys of the store are not changed in place
+    assert page_keys == {'1': [50.0, 'a' * 24]}
+    assert db_utils.add_page_key(page_keys, 2, pd.DataFrame()) == page_keys
+
+
+def test_keyset_query():
+    assert db_utils.keyset_query(None, db_utils.pymongo.ASCENDING) == {}
+    query = db_utils.keyset_query((100.0, TRIP_ID), db_utils.pymongo.DESCENDING)
+    assert query == {'$or': [
+        {'data.start_ts': {'$lt': 100.0}},
+        {'data.start_ts': 100.0, '_id': {'$lt': db_utils.ObjectId(TRIP_ID)}},
+    ]}
+
+
+def test_humanize_duration():
+    durations = pd.Series([5, 50, 170, 44 * 60, 3600, 5 * 3600, 22 * 3600, 3 * 86400], index=list('abcdefgh'))
+    humanized = db_utils.humanize_duration(durations)
+    assert humanized.tolist() == [
+        'seconds', 'a minute', '3 minutes', '44 minutes', 'an hour', '5 hours', 'a day', '3 days',
+    ]
+    assert list(humanized.index) == list('abcdefgh')
+
+
+def test_local_dates():
+    # 2023-01-01 03:00 UTC
+    timestamps = pd.Series([1672542000.0] * 4)
+    timezones = pd.Series(['America/Denver', 'Asia/Tokyo', 'Not/AZone', None])
+    dates = db_utils.get_local_dates(timestamps, timezones)
+    # the unknown and missing timezones are taken as UTC
+    assert dates.tolist() == [pd.Timestamp(day) for day in ['2022-12-31', '2023-01-01', '2023-01-01', '2023-01-01']]
+
+
+def test_uuids_to_str():
+    uuids = [UUID('12345678-1234-5678-1234-567812345678'), UUID('00000000-0000-0000-0000-0000000000ff')]
+    expected = [str(uuid) for uuid in uuids]
+    assert db_utils.uuids_to_str(pd.Series(uuids)).tolist() == expected
+    # the bson Binary of the uuids are bytes
+    assert db_utils.uuids_to_str(pd.Series([uuid.bytes for uuid in uuids])).tolist() == expected
+    # anything else is converted row by row
+    assert db_utils.uuids_to_str(pd.Series(expected + [None])).tolist() == expected + ['None']
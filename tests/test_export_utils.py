@@ -0,0 +1,61 @@
+import io
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+export_utils = pytest.importorskip('utils.export_utils')
+
+
+class FakeCursor:
+    def __init__(self, entries):
+        self.entries = entries
+        self.closed = False
+
+    def batch_size(self, size):
+        return self
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def close(self):
+        self.closed = True
+
+
+# the first chunk has no labeled trip, the second one does
+ENTRIES = [
+    {'user_id': 'a', 'data.distance': 1.0},
+    {'user_id': 'b', 'data.distance': 2.0},
+    {'user_id': 'c', 'data.distance': 3.0, 'mode_confirm': 'walk'},
+    {'user_id': 'd', 'data.distance': 4.0, 'mode_confirm': 'bike'},
+]
+COLUMNS = ['user_id', 'data.distance', 'mode_confirm']
+
+
+def export_frames(monkeypatch):
+    monkeypatch.setattr(export_utils, 'EXPORT_CHUNK_SIZE', 2)
+    cursor = FakeCursor(ENTRIES)
+    return export_utils.iter_frames(cursor, pd.DataFrame, COLUMNS, ['mode_confirm'])
+
+
+def test_frames_keep_the_declared_columns(monkeypatch):
+    first, second = export_frames(monkeypatch)
+    assert list(first.columns) == COLUMNS
+    assert list(second.columns) == COLUMNS
+    # a label column that no trip of the chunk has is text, not a float NaN column
+    assert first['mode_confirm'].tolist() == [None, None]
+    assert second['mode_confirm'].tolist() == ['walk', 'bike']
+
+
+def test_csv_export_of_chunks_with_different_labels(monkeypatch):
+    data = b''.join(export_utils.iter_csv(export_frames(monkeypatch)))
+    df = pd.read_csv(io.BytesIO(data))
+    assert list(df.columns) == COLUMNS
+    assert df['mode_confirm'].tolist()[2:] == ['walk', 'bike']
+
+
+def test_parquet_export_of_chunks_with_different_labels(monkeypatch):
+    pq = pytest.importorskip('pyarrow.parquet')
+    data = b''.join(export_utils.iter_parquet(export_frames(monkeypatch), ['mode_confirm']))
+    table = pq.read_table(io.BytesIO(data))
+    assert str(table.schema.field('mode_confirm').type) == 'string'
+    assert table.column('mode_confirm').to_pylist() == [None, None, 'walk', 'bike']
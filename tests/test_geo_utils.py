@@ -0,0 +1,59 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+geo_utils = pytest.importorskip('utils.geo_utils')
+
+
+def test_straight_line_is_simplified_to_its_endpoints():
+    points = np.column_stack([np.linspace(0, 1, 50), np.linspace(0, 1, 50)])
+    assert geo_utils.simplify(points, 1e-6).tolist() == [[0.0, 0.0], [1.0, 1.0]]
+
+
+def test_spike_is_kept():
+    points = np.array([[0, 0], [1, 2.5], [2, 5], [3, 2.5], [4, 0]], dtype=float)
+    assert geo_utils.simplify(points, 0.01).tolist() == [[0, 0], [2, 5], [4, 0]]
+    # all the points are within a large tolerance
+    assert geo_utils.simplify(points, 10).tolist() == [[0, 0], [4, 0]]
+
+
+def test_nothing_to_simplify():
+    points = np.array([[0, 0], [1, 1], [2, 0]], dtype=float)
+    assert geo_utils.simplify(points, 0) is points
+    assert geo_utils.simplify(points[:2], 1).tolist() == [[0, 0], [1, 1]]
+
+
+def test_simplified_routes_are_cached_by_their_points():
+    points = np.array([[0, 0], [1, 1], [2, 0]], dtype=float)
+    first = geo_utils.get_simplified_route('section', points, 20)
+    assert geo_utils.get_simplified_route('section', points.copy(), 20) is first
+    # the same section, clipped to another range
+    clipped = geo_utils.get_simplified_route('section', points[:2], 20)
+    assert clipped.tolist() == [[0, 0], [1, 1]]
+
+
+def test_routes_fit_in_the_budget():
+    zigzag = np.column_stack([np.arange(100, dtype=float), np.tile([0.0, 1.0], 50)])
+    routes = {'a': zigzag, 'b': zigzag + 0.5}
+    simplified, zoom_level = geo_utils.simplify_routes(routes, 15, budget=50)
+    assert sum(len(points) for points in simplified.values()) <= 50
+    assert zoom_level < 15
+
+
+def test_box_selection():
+    selected_data = {'range': {'mapbox': [[-105.0, 40.0], [-104.0, 39.0]]}}
+    ring = geo_utils.selection_to_polygon(selected_data)
+    assert len(ring) == 5 and ring[0] == ring[-1]
+    area = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:]))
+    assert area > 0
+
+
+def test_lasso_selection_is_counter_clockwise():
+    clockwise = [[0, 0], [0, 1], [1, 1], [1, 0]]
+    ring = geo_utils.selection_to_polygon({'lassoPoints': {'mapbox': clockwise}})
+    assert ring == [[1, 0], [1, 1], [0, 1], [0, 0], [1, 0]]
+
+
+def test_empty_selection():
+    assert geo_utils.selection_to_polygon(None) is None
+    assert geo_utils.selection_to_polygon({'points': []}) is None
+    assert geo_utils.selection_to_polygon({'lassoPoints': {'mapbox': [[0, 0], [1, 1]]}}) is None
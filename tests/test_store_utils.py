@@ -0,0 +1,66 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+store_utils = pytest.importorskip('utils.store_utils')
+
+
+def sample_frame():
+    return pd.DataFrame({
+        'mode': ['walk', 'walk', 'bike', None, 'walk', 'walk'],
+        'user_id': ['a', 'b', 'c', 'd', 'e', 'f'],
+        'coordinates': [[-105.0, 39.7], [-105.1, 39.8], [-105.2, 39.9], [-105.3, 40.0], [-105.4, 40.1], [-105.5, 40.2]],
+        'distance': [1.5, 2.5, 3.5, float('nan'), 5.5, 6.5],
+        'count': [1, 2, 3, 4, 5, 6],
+        'update_ts': pd.to_datetime(['2023-01-01 10:00', '2023-01-02 11:30', None, '2023-01-04', '2023-01-05', '2023-01-06']),
+        'write_ts': pd.to_datetime(['2023-01-01 10:00'] * 6, utc=True),
+    })
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_frame_round_trip(compress):
+    df = sample_frame()
+    store = store_utils.encode_frame(df, compress=compress)
+    assert store['length'] == len(df)
+    decoded = store_utils.decode_frame(store)
+    assert list(decoded.columns) == list(df.columns)
+    assert decoded['mode'].tolist() == df['mode'].tolist()
+    assert decoded['user_id'].tolist() == df['user_id'].tolist()
+    assert decoded['coordinates'].tolist() == df['coordinates'].tolist()
+    pd.testing.assert_series_equal(decoded['distance'], df['distance'])
+    assert decoded['count'].tolist() == df['count'].tolist()
+    pd.testing.assert_series_equal(decoded['update_ts'], df['update_ts'], check_dtype=False)
+    pd.testing.assert_series_equal(decoded['write_ts'], df['write_ts'], check_dtype=False)
+
+
+def test_repeated_strings_are_dictionary_encoded():
+    store = store_utils.encode_frame(sample_frame(), compress=False)
+    kinds = {column['name']: column['kind'] for column in store['columns']}
+    assert kinds['mode'] == 'dictionary'
+    assert kinds['user_id'] == 'values'
+    assert kinds['coordinates'] == 'pairs'
+    assert kinds['update_ts'] == 'datetime'
+
+
+def test_empty_stores():
+    assert store_utils.decode_frame({}).empty
+    assert store_utils.decode_frame(store_utils.encode_frame(pd.DataFrame())).empty
+
+
+def test_aggregates_round_trip():
+    daily = pd.DataFrame({'date': ['2023-01-01', '2023-01-02'], 'count': [3, 4]})
+    store = store_utils.encode_aggregates({'daily': daily}, 7)
+    assert store_utils.is_aggregated(store)
+    assert not store_utils.is_aggregated(store_utils.encode_frame(daily))
+    assert store['length'] == 7
+    assert store_utils.decode_aggregates(store)['daily'].to_dict('records') == daily.to_dict('records')
+
+
+def test_stale_stores():
+    date_range = {'start_date': '2023-01-01', 'end_date': '2023-01-31', 'version': '2023-01-01/2023-01-31'}
+    store = {'format': 'columnar', 'version': 'None/None'}
+    assert store_utils.is_stale(store, date_range)
+    assert not store_utils.is_stale(dict(store, version=date_range['version']), date_range)
+    # the initial stores are empty, not stale
+    assert not store_utils.is_stale({}, date_range)
+    assert store_utils.get_store_date_range(store) == {'start_date': None, 'end_date': None, 'version': 'None/None'}
+    assert store_utils.get_store_date_range(dict(store, version=date_range['version'])) == date_range
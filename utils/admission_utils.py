@@ -0,0 +1,147 @@
+"""
+Admission control for the database queries, per worker process.
+
+Every query class has a weight, and the queries running at the same time can use at most
+DASH_ADMISSION_CAPACITY units, so a few heavy queries (e.g. `add_user_stats` for every user,
+or a year of trajectories) cannot take all the threads and Mongo connections of a worker:
+- light: the cards, the login, the single user queries
+- medium: the trips and demographics of a range
+- heavy: the per-user stats, the trajectories, the exports
+DASH_ADMISSION_RESERVED_LIGHT units are reserved for the light queries, so that they still
+get through when the heavy ones use everything else.
+
+A query that cannot start right away waits, but at most DASH_ADMISSION_MAX_WAITERS queries
+wait at a time, and for at most DASH_ADMISSION_TIMEOUT_SECONDS. Past that it fails fast with
+`ServerBusy`, which the pages show as a "busy, retry" message.
+"""
+import contextlib
+import functools
+import logging
+import os
+import threading
+import time
+
+import flask
+
+from utils import instrumentation
+
+CAPACITY = int(os.getenv('DASH_ADMISSION_CAPACITY', '8'))
+RESERVED_LIGHT = int(os.getenv('DASH_ADMISSION_RESERVED_LIGHT', '2'))
+MAX_WAITERS = int(os.getenv('DASH_ADMISSION_MAX_WAITERS', '16'))
+TIMEOUT_SECONDS = float(os.getenv('DASH_ADMISSION_TIMEOUT_SECONDS', '5'))
+RETRY_AFTER_SECONDS = 5
+
+WEIGHTS = {
+    'light': 1,
+    'medium': 2,
+    'heavy': 4,
+}
+
+BUSY_MESSAGE = 'The dashboard is busy with other requests, retry in a few seconds.'
+
+
+class ServerBusy(Exception):
+    def __init__(self, query_class):
+        super().__init__(f"No capacity left for a {query_class} query")
+        self.query_class = query_class
+
+
+class AdmissionController:
+    def __init__(self, capacity, reserved_light, max_waiters, timeout):
+        self.capacity = capacity
+        self.reserved_light = min(reserved_light, capacity - 1)
+        self.max_waiters = max_waiters
+        self.timeout = timeout
+        self.in_use = 0
+        self.waiters = 0
+        self.condition = threading.Condition()
+        # the queries that are already admitted on a thread do not take more capacity
+        # for the queries they call (e.g. query_user_profile -> add_user_stats)
+        self.local = threading.local()
+
+    def _limit(self, query_class):
+        # the light queries can use the reserved units, the others cannot
+        return self.capacity if query_class == 'light' else self.capacity - self.reserved_light
+
+    def _fits(self, query_class, weight):
+        # a query heavier than the limit can still run alone
+        return self.in_use == 0 or self.in_use + weight <= self._limit(query_class)
+
+    def acquire(self, query_class):
+        weight = min(WEIGHTS[query_class], self._limit(query_class))
+        start = time.perf_counter()
+        with self.condition:
+            if not self._fits(query_class, weight):
+                if self.waiters >= self.max_waiters:
+                    self._reject(query_class, 'queue full')
+                self.waiters += 1
+                try:
+                    deadline = start + self.timeout
+                    while not self._fits(query_class, weight):
+                        remaining = deadline - time.perf_counter()
+                        if remaining <= 0:
+                            self._reject(query_class, 'timed out')
+                        self.condition.wait(remaining)
+                finally:
+                    self.waiters -= 1
+            self.in_use += weight
+        instrumentation.record('admission_wait', query_class, time.perf_counter() - start)
+        instrumentation.increment('admission_admitted', query_class, 1)
+        return weight
+
+    def _reject(self, query_class, reason):
+        instrumentation.increment('admission_rejected', query_class, 1)
+        logging.warning("Rejected a %s query (%s), %s/%s units in use" % (
+            query_class, reason, self.in_use, self.capacity))
+        raise ServerBusy(query_class)
+
+    def release(self, weight):
+        with self.condition:
+            self.in_use -= weight
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def holding(self):
+        """Run the queries of a caller that already acquired its units without taking more"""
+        previous = getattr(self.local, 'admitted', False)
+        self.local.admitted = True
+        try:
+            yield
+        finally:
+            self.local.admitted = previous
+
+    @contextlib.contextmanager
+    def admitted(self, query_class):
+        if getattr(self.local, 'admitted', False):
+            yield
+            return
+        weight = self.acquire(query_class)
+        try:
+            with self.holding():
+                yield
+        finally:
+            self.release(weight)
+
+    def admit(self, query_class):
+        """Decorator that runs the function once there is capacity for its class"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.admitted(query_class):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+
+controller = AdmissionController(CAPACITY, RESERVED_LIGHT, MAX_WAITERS, TIMEOUT_SECONDS)
+admit = controller.admit
+
+
+def init_admission(server):
+    # the callbacks that do not show the busy message themselves fail fast with a 503
+    @server.errorhandler(ServerBusy)
+    def server_busy(e):
+        response = flask.jsonify(error=BUSY_MESSAGE)
+        response.status_code = 503
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response
@@ -0,0 +1,92 @@
+import functools
+import logging
+import threading
+import time
+
+from utils import instrumentation
+
+
+def ttl_cache(ttl, get_scope=None):
+    """
+    Memoize a function for `ttl` seconds, keyed by its (hashable) arguments and, like
+    single_flight, by `get_scope()` (e.g. the permission profile that the result depends on,
+    so that a config change does not serve results filtered for the previous config).
+    Results are shared across callbacks and threads, so callers must treat them as read-only.
+    The wrapped function gets a `cache_clear()` to drop everything.
+    """
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = args + tuple(sorted(kwargs.items()))
+            if get_scope is not None:
+                key = (get_scope(),) + key
+            now = time.monotonic()
+            with lock:
+                hit = cache.get(key)
+            if hit is not None and now - hit[0] < ttl:
+                logging.debug("Cache hit for %s%s" % (func.__name__, key))
+                return hit[1]
+            result = func(*args, **kwargs)
+            with lock:
+                # drop the expired entries so that caches keyed by date range don't grow forever
+                for stale_key in [k for k, (ts, _) in cache.items() if now - ts >= ttl]:
+                    del cache[stale_key]
+                cache[key] = (now, result)
+            return result
+
+        def cache_clear():
+            with lock:
+                cache.clear()
+
+        wrapper.cache_clear = cache_clear
+        return wrapper
+    return decorator
+
+
+def single_flight(get_scope=None):
+    """
+    Share one execution of a function between the threads that call it with the same (hashable)
+    arguments at the same time, e.g. two admins loading the same default range: the first one
+    runs it, the others wait for it and get the same result (or exception). `get_scope` adds to
+    the key, e.g. the permission profile that the result depends on.
+    Like ttl_cache, the result is shared, so callers must treat it as read-only.
+    """
+    def decorator(func):
+        # key -> [done event, result, exception]
+        in_flight = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = args + tuple(sorted(kwargs.items()))
+            if get_scope is not None:
+                key = (get_scope(),) + key
+            with lock:
+                call = in_flight.get(key)
+                leader = call is None
+                if leader:
+                    call = in_flight[key] = [threading.Event(), None, None]
+            if not leader:
+                logging.debug("Waiting for the running %s%s" % (func.__name__, key))
+                instrumentation.increment('single_flight_shared', func.__name__, 1)
+                call[0].wait()
+                if call[2] is not None:
+                    raise call[2]
+                return call[1]
+            instrumentation.increment('single_flight_executed', func.__name__, 1)
+            try:
+                call[1] = func(*args, **kwargs)
+                return call[1]
+            except Exception as e:
+                call[2] = e
+                raise
+            finally:
+                with lock:
+                    del in_flight[key]
+                call[0].set()
+
+        return wrapper
+    return decorator
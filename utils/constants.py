@@ -1,10 +1,19 @@
-REQUIRED_NAMED_COLS = [
-    {'label': 'trip_start_time_str', 'path': 'data.start_fmt_time'},
-    {'label': 'trip_end_time_str', 'path': 'data.end_fmt_time'},
-    {'label': 'start_coordinates', 'path': 'data.start_loc.coordinates'},
-    {'label': 'end_coordinates', 'path': 'data.end_loc.coordinates'},
+# The trip columns that the pages need (the trends, the map), loaded even when the config
+# excludes them from the tables
+REQUIRED_TRIP_COLS = [
+    'user_id',
+    'data.start_ts',
+    'data.start_local_dt.timezone',
+    'data.start_loc.coordinates',
+    'data.end_loc.coordinates',
 ]
 
+# The [lon, lat] columns of the trips are split into these float columns when they are loaded
+COORDINATE_COLS = {
+    'data.start_loc.coordinates': ('data.start_loc.lon', 'data.start_loc.lat'),
+    'data.end_loc.coordinates': ('data.end_loc.lon', 'data.end_loc.lat'),
+}
+
 MULTILABEL_NAMED_COLS = [
     {'label': 'mode_confirm', 'path': 'data.user_input.mode_confirm'},
     {'label': 'purpose_confirm', 'path': 'data.user_input.purpose_confirm'},
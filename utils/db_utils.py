@@ -1,24 +1,95 @@
 import logging
+import os
+import threading
+from collections import OrderedDict
 from datetime import datetime, timezone
 from uuid import UUID
 
 import arrow
+from bson.objectid import ObjectId
 
+import numpy as np
 import pandas as pd
 import pymongo
+from dash.dash_table.Format import Format, Scheme
 
-import emission.core.get_database as edb
-import emission.storage.timeseries.abstract_timeseries as esta
-import emission.storage.timeseries.timequery as estt
-import emission.core.wrapper.motionactivity as ecwm
+from utils.import_utils import lazy_import
+
+# the emission modules are slow to import (and connect to the database), so they are
+# only loaded when the first query runs
+edb = lazy_import('emission.core.get_database')
+esta = lazy_import('emission.storage.timeseries.abstract_timeseries')
+estt = lazy_import('emission.storage.timeseries.timequery')
+ecwm = lazy_import('emission.core.wrapper.motionactivity')
 
 
 from utils import constants
+from utils.admission_utils import admit
+from utils.cache_utils import ttl_cache, single_flight
+from utils.instrumentation import timed_query
 from utils import permissions as perm_utils
 
 
-def query_uuids(start_date, end_date):
-    logging.debug("Querying the UUID DB for %s -> %s" % (start_date,end_date))
+def permission_scope():
+    # the results depend on the columns that the config allows, so the identical queries
+    # are only shared between the callers that use the same permission profile
+    return perm_utils.get_permission_profile().version
+
+
+# Users for the "All users" (no date range) case, which does not change from one
+# date-picker event to the next
+ALL_UUIDS_CACHE_TTL = 5 * 60
+
+UUIDS_PROJECTION = {
+    '_id': 0,
+    'user_id': '$uuid',
+    'user_token': '$user_email',
+    'update_ts': 1
+}
+
+_HEX_DIGITS = np.array(list('0123456789abcdef'))
+
+def uuids_to_str(values):
+    """
+    Vectorized `str()` for a column of UUIDs (or the bson Binary they are stored as).
+    Falls back to a per-row `str()` if the column contains anything else.
+    """
+    try:
+        raw = b''.join(v.bytes if isinstance(v, UUID) else bytes(v) for v in values)
+    except TypeError:
+        return values.apply(str)
+    if len(raw) != 16 * len(values):
+        return values.apply(str)
+    octets = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 16)
+    hex_chars = _HEX_DIGITS[np.stack([octets >> 4, octets & 0x0F], axis=-1).reshape(-1, 32)]
+    dashes = np.full((len(values), 1), '-')
+    chars = np.concatenate([
+        hex_chars[:, 0:8], dashes,
+        hex_chars[:, 8:12], dashes,
+        hex_chars[:, 12:16], dashes,
+        hex_chars[:, 16:20], dashes,
+        hex_chars[:, 20:32],
+    ], axis=1)
+    return pd.Series(chars.view('<U36').ravel(), index=values.index, dtype=object)
+
+def uuids_to_df(entries):
+    df = pd.DataFrame(list(entries), columns=list(UUIDS_PROJECTION)[1:])
+    if not df.empty:
+        df['update_ts'] = pd.to_datetime(df['update_ts'])
+        df['user_id'] = uuids_to_str(df['user_id'])
+    return df
+
+@timed_query
+@ttl_cache(ALL_UUIDS_CACHE_TTL, permission_scope)
+@single_flight(permission_scope)
+@admit('light')
+def query_all_uuids():
+    logging.debug("Querying the UUID DB for all users")
+    return uuids_to_df(edb.get_uuid_db().find({}, UUIDS_PROJECTION))
+
+def uuids_query(start_date, end_date):
+    if start_date is None and end_date is None:
+        return {}
     query = {'update_ts': {'$exists': True}}
     if start_date is not None:
         start_time = datetime.combine(start_date, datetime.min.time()).astimezone(timezone.utc)
@@ -27,35 +98,63 @@ def query_uuids(start_date, end_date):
     if end_date is not None:
         end_time = datetime.combine(end_date, datetime.max.time()).astimezone(timezone.utc)
         query['update_ts']['$lt'] = end_time
+    return query
 
-    projection = {
-        '_id': 0,
-        'user_id': '$uuid',
-        'user_token': '$user_email',
-        'update_ts': 1
-    }
+@timed_query
+@single_flight(permission_scope)
+@admit('medium')
+def query_uuids(start_date, end_date):
+    logging.debug("Querying the UUID DB for %s -> %s" % (start_date,end_date))
+    if start_date is None and end_date is None:
+        return query_all_uuids()
 
+    query = uuids_query(start_date, end_date)
     # This should actually use the profile DB instead of (or in addition to)
     # the UUID DB so that we can see the app version, os, manufacturer...
     # I will write a couple of functions to get all the users in a time range
     # (although we should define what that time range should be) and to merge
     # that with the profile data
-    entries = edb.get_uuid_db().find()
-    df = pd.json_normalize(list(entries))
-    if not df.empty:
-        df['update_ts'] = pd.to_datetime(df['update_ts'])
-        df['user_id'] = df['uuid'].apply(str)
-        df['user_token'] = df['user_email']
-        df.drop(columns=["uuid", "_id"], inplace=True)
-    return df
+    return uuids_to_df(edb.get_uuid_db().find(query, UUIDS_PROJECTION))
 
-def query_confirmed_trips(start_date, end_date):
+# Above this many confirmed trips in the selected range, the stores only carry
+# aggregates (see query_trip_aggregates) and the Data tab pages through the trips
+COARSE_TRIPS_THRESHOLD = int(os.getenv('DASH_COARSE_TRIPS_THRESHOLD', '50000'))
+# size of the map grid cells that the trip end points are counted in, in degrees
+TRIP_GRID_CELL_DEGREES = float(os.getenv('DASH_TRIP_GRID_CELL_DEGREES', '0.005'))
+
+def _ts_range(start_date, end_date):
     start_ts, end_ts = None, datetime.max.timestamp()
     if start_date is not None:
         start_ts = datetime.combine(start_date, datetime.min.time()).timestamp()
 
     if end_date is not None:
         end_ts = datetime.combine(end_date, datetime.max.time()).timestamp()
+    return start_ts, end_ts
+
+def confirmed_trips_query(start_date, end_date):
+    # the same filter as the TimeQuery in query_confirmed_trips, for the raw collection
+    start_ts, end_ts = _ts_range(start_date, end_date)
+    # (emission also skips the entries that were marked invalid)
+    match = {
+        'metadata.key': 'analysis/confirmed_trip',
+        'data.start_ts': {'$lte': end_ts},
+        'invalid': {'$exists': False},
+    }
+    if start_ts is not None:
+        match['data.start_ts']['$gte'] = start_ts
+    return match
+
+@timed_query
+@single_flight(permission_scope)
+@admit('light')
+def count_confirmed_trips(start_date, end_date):
+    return edb.get_analysis_timeseries_db().count_documents(confirmed_trips_query(start_date, end_date))
+
+@timed_query
+@single_flight(permission_scope)
+@admit('medium')
+def query_confirmed_trips(start_date, end_date):
+    start_ts, end_ts = _ts_range(start_date, end_date)
 
     ts = esta.TimeSeries.get_aggregate_time_series()
     # Note to self, allow end_ts to also be null in the timequery
@@ -64,92 +163,499 @@ def query_confirmed_trips(start_date, end_date):
         key_list=["analysis/confirmed_trip"],
         time_query=estt.TimeQuery("data.start_ts", start_ts, end_ts),
     )
+    return _confirmed_trips_to_df(entries)
+
+@timed_query
+@single_flight(permission_scope)
+@admit('light')
+def query_confirmed_trips_page(start_date, end_date, after, page_size, skip=0):
+    """
+    One page of the confirmed trips in the range, in the order of their start time: the trips
+    after the key `after` (see get_page_cursor), or from the start of the range if it is None
+    """
+    query = confirmed_trips_query(start_date, end_date)
+    query.update(keyset_query(after, pymongo.ASCENDING))
+    entries = list(
+        edb.get_analysis_timeseries_db()
+        .find(query)
+        .sort([('data.start_ts', pymongo.ASCENDING), ('_id', pymongo.ASCENDING)])
+        .skip(skip)
+        .limit(page_size)
+    )
+    df = _confirmed_trips_to_df(entries)
+    if not df.empty:
+        df['trip_id'] = [str(entry['_id']) for entry in entries]
+    return df
+
+# The trip tables page with a keyset on (data.start_ts, _id) instead of skipping the previous
+# pages, which the database would have to scan on every page change. The tables keep the key
+# that every page they loaded starts after, e.g. {'0': None, '1': [1690000000.0, '64c...']}.
+
+def keyset_query(after, direction):
+    """The trips that come after the (data.start_ts, trip_id) key `after` in the given order"""
+    if after is None:
+        return {}
+    start_ts, trip_id = after
+    op = '$gt' if direction == pymongo.ASCENDING else '$lt'
+    return {'$or': [
+        {'data.start_ts': {op: start_ts}},
+        {'data.start_ts': start_ts, '_id': {op: ObjectId(trip_id)}},
+    ]}
+
+def get_page_cursor(page_keys, page, page_size):
+    """
+    The key that the trips of the page come after, and how many trips to skip after it.
+    Only a jump past the pages that were loaded so far has to skip, from the closest one.
+    """
+    page_keys = page_keys or {}
+    known_page = max((int(p) for p in page_keys if int(p) <= page), default=0)
+    key = page_keys.get(str(known_page))
+    return (tuple(key) if key else None), (page - known_page) * page_size
+
+def add_page_key(page_keys, page, df):
+    """The page keys with the key that the page after `page` starts after (its last trip)"""
+    page_keys = dict(page_keys or {})
+    if not df.empty:
+        page_keys[str(page + 1)] = [float(df['data.start_ts'].iloc[-1]), df['trip_id'].iloc[-1]]
+    return page_keys
+
+# the trips in a region of the map are sent to the browser, so they are capped like the full range
+REGION_TRIPS_LIMIT = COARSE_TRIPS_THRESHOLD
+
+def region_query(polygon, match):
+    """Trips that start, end or either start or end in the polygon (a closed GeoJSON ring)"""
+    within = {'$geoWithin': {'$geometry': {'type': 'Polygon', 'coordinates': [polygon]}}}
+    if match == 'start':
+        return {'data.start_loc': within}
+    if match == 'end':
+        return {'data.end_loc': within}
+    return {'$or': [{'data.start_loc': within}, {'data.end_loc': within}]}
+
+@timed_query
+@admit('medium')
+def query_confirmed_trips_in_region(start_date, end_date, polygon, match):
+    query = confirmed_trips_query(start_date, end_date)
+    query.update(region_query(polygon, match))
+    entries = (
+        edb.get_analysis_timeseries_db()
+        .find(query)
+        .sort('data.start_ts', pymongo.ASCENDING)
+        .limit(REGION_TRIPS_LIMIT)
+    )
+    return _confirmed_trips_to_df(entries)
+
+def normalize_confirmed_trips(entries):
+    """The confirmed trips as a dataframe of the columns we are allowed to show"""
     df = pd.json_normalize(list(entries))
 
     # logging.debug("Before filtering, df columns are %s" % df.columns)
     if not df.empty:
-        columns = [col for col in perm_utils.get_all_trip_columns() if col in df.columns]
+        profile = perm_utils.get_permission_profile()
+        columns = [col for col in df.columns if col in profile.all_trip_columns]
         df = df[columns]
         # logging.debug("After getting all columns, they are %s" % df.columns)
         for col in constants.BINARY_TRIP_COLS:
             if col in df.columns:
                 df[col] = df[col].apply(str)
-        for named_col in perm_utils.get_all_named_trip_columns():
-            if named_col['path'] in df.columns:
-                df[named_col['label']] = df[named_col['path']]
-                # df = df.drop(columns=[named_col['path']])
-        # TODO: We should really display both the humanized value and the raw value
-        # humanized value for people to see the entries in real time
-        # raw value to support analyses on the downloaded data
-        # I still don't fully grok which columns are displayed
+        for path, label in profile.trip_rename_map.items():
+            if path in df.columns:
+                df[label] = df[path]
+                # the path is only kept if the tables also show it under that name
+                if path not in profile.allowed_trip_columns:
+                    df = df.drop(columns=[path])
+        df = split_coordinates(df)
+    return df
+
+def split_coordinates(df):
+    """Replace the [lon, lat] columns (see constants.COORDINATE_COLS) with two float columns"""
+    for col, (lon_col, lat_col) in constants.COORDINATE_COLS.items():
+        if col in df.columns:
+            df[lon_col] = df[col].str[0].astype(float)
+            df[lat_col] = df[col].str[1].astype(float)
+            df = df.drop(columns=[col])
+    return df
+
+def get_local_dates(timestamps, timezones):
+    """
+    The local dates (as datetime64 midnights) of epoch-second timestamps, each in its own
+    timezone. The conversion runs once per distinct timezone rather than once per row.
+    """
+    utc = pd.to_datetime(timestamps, unit='s', utc=True)
+    timezones = timezones.fillna('UTC')
+    dates = pd.Series(pd.NaT, index=timestamps.index, dtype='datetime64[ns]')
+    for tz, index in timezones.groupby(timezones).groups.items():
+        try:
+            local = utc[index].dt.tz_convert(tz)
+        except KeyError:
+            # the unknown timezone errors of pytz and zoneinfo are KeyErrors
+            logging.debug("Unknown timezone %s, using UTC" % tz)
+            local = utc[index]
+        dates[index] = local.dt.tz_localize(None).dt.floor('D')
+    return dates
+
+# the distances are stored in meters, and shown in km or miles depending on the config
+DISTANCE_UNITS = {
+    False: ('km', 1 / 1000),
+    # miles because this is the US, Liberia or Myanmar
+    # https://en.wikipedia.org/wiki/Mile
+    True: ('mi', 0.6213712 / 1000),
+}
+
+def get_distance_unit():
+    use_imperial = perm_utils.config.get("display_config",
+        {"use_imperial": False}).get("use_imperial", False)
+    return DISTANCE_UNITS[bool(use_imperial)]
+
+def humanize_distance(distance):
+    _, factor = get_distance_unit()
+    return distance * factor
+
+# (upper bound in seconds, unit in seconds, singular, plural), roughly what arrow's humanize() says
+DURATION_STEPS = [
+    (45, None, 'seconds', 'seconds'),
+    (45 * 60, 60, 'a minute', 'minutes'),
+    (22 * 3600, 3600, 'an hour', 'hours'),
+    (np.inf, 86400, 'a day', 'days'),
+]
+
+def humanize_duration(duration):
+    """The durations (a series of seconds) as e.g. '5 minutes', computed for the whole column at once"""
+    seconds = duration.astype(float).to_numpy()
+    humanized = np.full(len(seconds), '', dtype=object)
+    lower = -np.inf
+    for upper, unit, singular, plural in DURATION_STEPS:
+        in_step = (seconds >= lower) & (seconds < upper)
+        if unit is None:
+            humanized[in_step] = singular
+        else:
+            count = np.maximum(np.round(seconds[in_step] / unit), 1).astype(int)
+            humanized[in_step] = np.where(count == 1, singular, np.char.add(count.astype(str), ' ' + plural))
+        lower = upper
+    return pd.Series(humanized, index=duration.index)
+
+COORDINATE_COLUMNS = frozenset(col for split_cols in constants.COORDINATE_COLS.values() for col in split_cols)
+
+def get_trips_datatable_columns(columns, markdown_columns=()):
+    """
+    The DataTable columns of the trips. The distance and duration stay numeric, so that they
+    sort as numbers, and are formatted by the table; see to_display_units for the distance unit.
+    """
+    unit, _ = get_distance_unit()
+    specs = []
+    for col in columns:
+        if col == 'data.distance':
+            specs.append({"name": f"{col} ({unit})", "id": col, "type": "numeric",
+                          "format": Format(precision=2, scheme=Scheme.fixed)})
+        elif col == 'data.duration':
+            specs.append({"name": f"{col} (s)", "id": col, "type": "numeric",
+                          "format": Format(precision=0, scheme=Scheme.fixed)})
+        elif col in COORDINATE_COLUMNS:
+            # formatted by the table, so only for the rows on screen
+            specs.append({"name": col, "id": col, "type": "numeric",
+                          "format": Format(precision=6, scheme=Scheme.fixed)})
+        elif col in markdown_columns:
+            specs.append({"name": col, "id": col, "presentation": "markdown"})
+        else:
+            specs.append({"name": col, "id": col})
+    return specs
+
+def to_display_units(df):
+    """Convert the distances of the trips about to be shown from meters to the configured unit"""
+    if 'data.distance' in df.columns:
+        df = df.assign(**{'data.distance': humanize_distance(df['data.distance'])})
+    return df
+
+def _confirmed_trips_to_df(entries):
+    df = normalize_confirmed_trips(entries)
+    if not df.empty:
+        # the raw distance (m) and duration (s) are kept for sorting and for analyses on the
+        # downloaded data, the distance is converted at display time (to_display_units) and
+        # the duration also gets a humanized column for people to read
         # https://github.com/e-mission/op-admin-dashboard/issues/29#issuecomment-1530105040
         # https://github.com/e-mission/op-admin-dashboard/issues/29#issuecomment-1530439811
-        # so just replacing the distance and duration with the humanized values for now
-        use_imperial = perm_utils.config.get("display_config",
-            {"use_imperial": False}).get("use_imperial", False)
-        # convert to km to humanize
-        df['data.distance'] = df['data.distance'] / 1000
-        # convert km further to miles because this is the US, Liberia or Myanmar
-        # https://en.wikipedia.org/wiki/Mile
-        if use_imperial:
-            df['data.distance'] = df['data.distance'] * 0.6213712
-
-        df['data.duration'] = df['data.duration'].apply(lambda d: arrow.utcnow().shift(seconds=d).humanize(only_distance=True))
+        for col in ['data.distance', 'data.duration']:
+            if col in df.columns:
+                df[col] = df[col].astype(float)
+        if 'data.duration' in df.columns:
+            df['data.duration_humanized'] = humanize_duration(df['data.duration'])
 
     # logging.debug("After filtering, df columns are %s" % df.columns)
     # logging.debug("After filtering, the actual data is %s" % df.head())
-    # logging.debug("After filtering, the actual data is %s" % df.head().trip_start_time_str)
+    # logging.debug("After filtering, the actual data is %s" % df.head()["data.start_ts"])
     return df
 
+def _grid_cell_center(point, index):
+    coordinate = {'$arrayElemAt': [point, index]}
+    cell = {'$floor': {'$divide': [coordinate, TRIP_GRID_CELL_DEGREES]}}
+    return {'$add': [{'$multiply': [cell, TRIP_GRID_CELL_DEGREES]}, TRIP_GRID_CELL_DEGREES / 2]}
+
+@timed_query
+@single_flight(permission_scope)
+@admit('heavy')
+def query_trip_aggregates(start_date, end_date):
+    """
+    Counts of the confirmed trips in the range, computed in the database instead of
+    loading every trip:
+    - daily: trips per local start day, user and confirmed mode
+    - cells: trip start and end points per map grid cell
+    """
+    timeseries_db = edb.get_analysis_timeseries_db()
+    match = confirmed_trips_query(start_date, end_date)
+
+    daily = pd.json_normalize(list(timeseries_db.aggregate([
+        {'$match': match},
+        {'$group': {
+            '_id': {
+                'year': '$data.start_local_dt.year',
+                'month': '$data.start_local_dt.month',
+                'day': '$data.start_local_dt.day',
+                'user_id': '$user_id',
+                'mode': '$data.user_input.mode_confirm',
+            },
+            'count': {'$sum': 1},
+        }},
+    ], allowDiskUse=True)))
+    if daily.empty:
+        daily = pd.DataFrame(columns=['date', 'user_id', 'mode', 'count'])
+    else:
+        daily = daily.rename(columns=lambda col: col.replace('_id.', ''))
+        for col in ['user_id', 'mode']:
+            if col not in daily.columns:
+                daily[col] = None
+        daily['date'] = pd.to_datetime(daily[['year', 'month', 'day']]).dt.strftime('%Y-%m-%d')
+        daily['user_id'] = uuids_to_str(daily['user_id'])
+        daily = daily[['date', 'user_id', 'mode', 'count']]
+
+    cells = pd.json_normalize(list(timeseries_db.aggregate([
+        {'$match': match},
+        {'$project': {'_id': 0, 'point': ['$data.start_loc.coordinates', '$data.end_loc.coordinates']}},
+        {'$unwind': '$point'},
+        {'$group': {
+            '_id': {'lon': _grid_cell_center('$point', 0), 'lat': _grid_cell_center('$point', 1)},
+            'count': {'$sum': 1},
+        }},
+    ], allowDiskUse=True)))
+    if cells.empty:
+        cells = pd.DataFrame(columns=['lon', 'lat', 'count'])
+    else:
+        cells = cells.rename(columns={'_id.lon': 'lon', '_id.lat': 'lat'})[['lon', 'lat', 'count']]
+
+    return {'daily': daily, 'cells': cells}
+
+# The label statistics are asked for the same ranges over and over
+LABEL_STATS_CACHE_TTL = 5 * 60
+
+def query_label_stats(start_date, end_date):
+    """
+    Label statistics of the confirmed trips in the range, computed in the database:
+    - counts: number of trips per value of each label (mode_confirm, purpose_confirm...)
+    - transitions: number of trips per (mode_confirm, replaced_mode)
+    - total and labeled: number of trips, and of trips with at least one label
+    Only the labels that the config allows are included.
+    """
+    profile = perm_utils.get_permission_profile()
+    labels = tuple((col['label'], col['path']) for col in profile.allowed_named_trip_columns)
+    return _query_label_stats(start_date, end_date, labels)
+
+@timed_query
+@ttl_cache(LABEL_STATS_CACHE_TTL, permission_scope)
+@single_flight(permission_scope)
+@admit('medium')
+def _query_label_stats(start_date, end_date, labels):
+    facets = {
+        'total': [{'$count': 'count'}],
+        'labeled': [{'$match': {'data.user_input': {'$nin': [{}, None]}}}, {'$count': 'count'}],
+    }
+    for label, path in labels:
+        facets[label] = [
+            {'$match': {path: {'$exists': True}}},
+            {'$group': {'_id': f'${path}', 'count': {'$sum': 1}}},
+        ]
+    paths = dict(labels)
+    if 'mode_confirm' in paths and 'replaced_mode' in paths:
+        facets['transitions'] = [
+            {'$match': {paths['mode_confirm']: {'$exists': True}, paths['replaced_mode']: {'$exists': True}}},
+            {'$group': {
+                '_id': {'mode': f"${paths['mode_confirm']}", 'replaced_mode': f"${paths['replaced_mode']}"},
+                'count': {'$sum': 1},
+            }},
+        ]
+
+    result = next(edb.get_analysis_timeseries_db().aggregate([
+        {'$match': confirmed_trips_query(start_date, end_date)},
+        {'$facet': facets},
+    ], allowDiskUse=True))
+
+    counts = pd.DataFrame(
+        [{'label': label, 'value': group['_id'], 'count': group['count']}
+         for label, _ in labels for group in result[label]],
+        columns=['label', 'value', 'count'],
+    )
+    transitions = pd.DataFrame(
+        [{'mode': group['_id']['mode'], 'replaced_mode': group['_id']['replaced_mode'], 'count': group['count']}
+         for group in result.get('transitions', [])],
+        columns=['mode', 'replaced_mode', 'count'],
+    )
+    return {
+        'counts': counts,
+        'transitions': transitions,
+        'total': result['total'][0]['count'] if result['total'] else 0,
+        'labeled': result['labeled'][0]['count'] if result['labeled'] else 0,
+    }
+
+# The demographic surveys are not filtered by the date picker, so there is no point
+# in re-running the query every time the range changes
+DEMOGRAPHICS_CACHE_TTL = 5 * 60
+
+@timed_query
+@ttl_cache(DEMOGRAPHICS_CACHE_TTL, permission_scope)
+@single_flight(permission_scope)
+@admit('medium')
 def query_demographics():
     # Returns dictionary of df where key represent differnt survey id and values are df for each survey
     logging.debug("Querying the demographics for (no date range)")
-    ts = esta.TimeSeries.get_aggregate_time_series()
+    timeseries_db = edb.get_timeseries_db()
 
-    entries = ts.find_entries(["manual/demographic_survey"])
-    data = list(entries)
-
-    available_key = {}
-    for entry in data:
-        survey_key = list(entry['data']['jsonDocResponse'].keys())[0]
-        if survey_key not in available_key:
-            available_key[survey_key] = []
-        available_key[survey_key].append(entry)
+    # Get the surveys (the first key of the jsonDocResponse) from the DB, then load them one
+    # at a time so that we only ever hold the entries of one survey in memory
+    survey_keys = timeseries_db.aggregate([
+        {'$match': {'metadata.key': 'manual/demographic_survey', 'invalid': {'$exists': False}}},
+        {'$group': {'_id': SURVEY_KEY_EXPR}},
+    ])
 
     dataframes = {}
-    for key, json_object in available_key.items():
-        df = pd.json_normalize(json_object)
-        dataframes[key] = df
-
-    for key, df in dataframes.items():
-        if not df.empty:
-            for col in constants.BINARY_DEMOGRAPHICS_COLS:
-                if col in df.columns:
-                    df[col] = df[col].apply(str) 
-            columns_to_drop = [col for col in df.columns if col.startswith("metadata")]
-            df.drop(columns= columns_to_drop, inplace=True) 
-            modified_columns = perm_utils.get_demographic_columns(df.columns)  
-            df.columns = modified_columns 
-            df.columns=[col.rsplit('.',1)[-1] if col.startswith('data.jsonDocResponse.') else col for col in df.columns]  
-            for col in constants.EXCLUDED_DEMOGRAPHICS_COLS:
-                if col in df.columns:
-                    df.drop(columns= [col], inplace=True) 
-                    
+    for group in survey_keys:
+        key = group['_id']
+        entries = timeseries_db.find(demographics_query(key))
+        dataframes[key] = normalize_demographics(key, entries)
+
     return dataframes
 
-def query_trajectories(start_date, end_date):
-    start_ts, end_ts = None, datetime.max.timestamp()
-    if start_date is not None:
-        start_ts = datetime.combine(start_date, datetime.min.time()).timestamp()
+# the survey of a response: the first key of its jsonDocResponse
+SURVEY_KEY_EXPR = {'$let': {
+    'vars': {'first': {'$arrayElemAt': [{'$objectToArray': '$data.jsonDocResponse'}, 0]}},
+    'in': '$$first.k',
+}}
+
+def demographics_query(survey_key):
+    return {
+        'metadata.key': 'manual/demographic_survey',
+        f'data.jsonDocResponse.{survey_key}': {'$exists': True},
+        # a response can have the keys of other surveys after its own, it only belongs to the first one
+        '$expr': {'$eq': [SURVEY_KEY_EXPR, survey_key]},
+        # like emission's find_entries, skip the entries marked as invalid
+        'invalid': {'$exists': False},
+    }
 
-    if end_date is not None:
-        end_ts = datetime.combine(end_date, datetime.max.time()).timestamp()
+def normalize_demographics(survey_key, entries):
+    df = pd.json_normalize(list(entries))
+    if not df.empty:
+        keep, rename = get_demographic_column_plan(survey_key, df.columns)
+        df = df.loc[:, keep].rename(columns=rename)
+        for col in constants.BINARY_DEMOGRAPHICS_COLS:
+            if col in df.columns:
+                df[col] = df[col].apply(str)
+    return df
+
+
+# (survey key, input columns, permission profile version) -> (columns to keep, rename map);
+# every chunk of an export can have other columns, so only the most recent plans are kept
+MAX_DEMOGRAPHIC_COLUMN_PLANS = 256
+_demographic_column_plans = OrderedDict()
+_demographic_column_plans_lock = threading.Lock()
+
+def get_demographic_column_plan(survey_key, columns):
+    """
+    Work out, once per survey schema, which of the normalized survey columns we display
+    and what they are called, so that every load applies it as a single select + rename
+    instead of dropping the metadata, excluded and internal columns one at a time.
+    """
+    columns = tuple(columns)
+    profile = perm_utils.get_permission_profile()
+    plan_key = (survey_key, columns, profile.version)
+    with _demographic_column_plans_lock:
+        plan = _demographic_column_plans.get(plan_key)
+        if plan is not None:
+            _demographic_column_plans.move_to_end(plan_key)
+    if plan is None:
+        excluded_cols = set(constants.EXCLUDED_DEMOGRAPHICS_COLS)
+        keep, rename = [], {}
+        for col in columns:
+            if col.startswith("metadata") or col in profile.demographics_columns_exclude:
+                continue
+            new_col = col.rsplit('.', 1)[-1] if col.startswith('data.jsonDocResponse.') else col
+            if new_col in excluded_cols:
+                continue
+            keep.append(col)
+            if new_col != col:
+                rename[col] = new_col
+        plan = (keep, rename)
+        logging.debug("Computed the column plan for survey %s: keeping %s of %s columns"
+            % (survey_key, len(keep), len(columns)))
+        with _demographic_column_plans_lock:
+            _demographic_column_plans[plan_key] = plan
+            while len(_demographic_column_plans) > MAX_DEMOGRAPHIC_COLUMN_PLANS:
+                _demographic_column_plans.popitem(last=False)
+    return plan
+
+@timed_query
+@single_flight(permission_scope)
+@admit('heavy')
+def query_trajectories(start_date, end_date):
+    start_ts, end_ts = _ts_range(start_date, end_date)
     ts = esta.TimeSeries.get_aggregate_time_series()
    
     entries = ts.find_entries(
         key_list=["analysis/recreated_location"],
         time_query=estt.TimeQuery("data.ts", start_ts, end_ts),
     )
+    return normalize_trajectories(entries)
+
+def trajectories_query(start_date, end_date):
+    # the same filter as the TimeQuery in query_trajectories, for the raw collection
+    start_ts, end_ts = _ts_range(start_date, end_date)
+    query = {
+        'metadata.key': 'analysis/recreated_location',
+        'data.ts': {'$lte': end_ts},
+        'invalid': {'$exists': False},
+    }
+    if start_ts is not None:
+        query['data.ts']['$gte'] = start_ts
+    return query
+
+# The routes only change when new trips are processed, and re-simplifying them on every
+# zoom should not re-run the query
+TRIP_ROUTES_CACHE_TTL = 5 * 60
+
+@timed_query
+@ttl_cache(TRIP_ROUTES_CACHE_TTL, permission_scope)
+@single_flight(permission_scope)
+@admit('heavy')
+def query_trip_routes(start_date, end_date):
+    """
+    The recreated locations in the range as one route per section:
+    {section id: {'user_id': ..., 'points': n x 2 array of lon, lat}}
+    """
+    sections = edb.get_analysis_timeseries_db().aggregate([
+        {'$match': trajectories_query(start_date, end_date)},
+        {'$sort': {'data.ts': 1}},
+        {'$group': {
+            '_id': '$data.section',
+            'user_id': {'$first': '$user_id'},
+            'lon': {'$push': '$data.longitude'},
+            'lat': {'$push': '$data.latitude'},
+        }},
+    ], allowDiskUse=True)
+    routes = {}
+    for section in sections:
+        user_id = section['user_id']
+        routes[str(section['_id'])] = {
+            'user_id': str(user_id if isinstance(user_id, UUID) else UUID(bytes=bytes(user_id))),
+            'points': np.column_stack([section['lon'], section['lat']]).astype(float),
+        }
+    return routes
+
+def normalize_trajectories(entries):
     df = pd.json_normalize(list(entries))
     if not df.empty:
         for col in df.columns:
@@ -164,6 +670,8 @@ def query_trajectories(start_date, end_date):
     return df
 
 
+@timed_query
+@admit('heavy')
 def add_user_stats(user_data):
     for user in user_data:
         user_uuid = UUID(user['user_id'])
@@ -218,3 +726,76 @@ def add_user_stats(user_data):
                 user['last_call'] = arrow.get(last_call).format(time_format)
 
     return user_data
+
+# The single user queries of the user page (pages/user.py). They are all bounded by the
+# user_id (and a page or a time range), so each one is a small indexed query.
+
+@timed_query
+@admit('light')
+def query_user_profile(user_id):
+    user_uuid = UUID(user_id)
+    uuid_entry = edb.get_uuid_db().find_one({'uuid': user_uuid}, UUIDS_PROJECTION)
+    if uuid_entry is None:
+        return None
+    user = uuids_to_df([uuid_entry]).to_dict('records')[0]
+    return add_user_stats([user])[0]
+
+@timed_query
+@admit('light')
+def query_user_trips_page(user_id, after, page_size, skip=0):
+    """One page of the trips of a user, the most recent first (see query_confirmed_trips_page)"""
+    query = {
+        'user_id': UUID(user_id),
+        'metadata.key': 'analysis/confirmed_trip',
+        # like emission's find_entries, skip the entries marked as invalid
+        'invalid': {'$exists': False},
+    }
+    query.update(keyset_query(after, pymongo.DESCENDING))
+    entries = list(
+        edb.get_analysis_timeseries_db()
+        .find(query)
+        .sort([('data.start_ts', pymongo.DESCENDING), ('_id', pymongo.DESCENDING)])
+        .skip(skip)
+        .limit(page_size)
+    )
+    df = _confirmed_trips_to_df(entries)
+    if not df.empty:
+        df['trip_id'] = [str(entry['_id']) for entry in entries]
+    return df
+
+@timed_query
+@admit('light')
+def query_user_trip_trajectory(user_id, trip_id):
+    """The recreated locations of one trip of a user"""
+    user_uuid = UUID(user_id)
+    trip = edb.get_analysis_timeseries_db().find_one(
+        {'_id': ObjectId(trip_id), 'user_id': user_uuid},
+        {'data.start_ts': 1, 'data.end_ts': 1},
+    )
+    if trip is None:
+        return pd.DataFrame()
+    ts = esta.TimeSeries.get_time_series(user_uuid)
+    entries = ts.find_entries(
+        key_list=["analysis/recreated_location"],
+        time_query=estt.TimeQuery("data.ts", trip['data']['start_ts'], trip['data']['end_ts']),
+    )
+    return normalize_trajectories(entries)
+
+@timed_query
+@admit('light')
+def query_user_api_calls(user_id, limit):
+    """The last `limit` calls of a user to the server"""
+    entries = (
+        edb.get_timeseries_db()
+        .find(
+            {'user_id': UUID(user_id), 'metadata.key': 'stats/server_api_time'},
+            {'_id': 0, 'data.name': 1, 'data.ts': 1, 'data.reading': 1},
+        )
+        .sort('data.ts', pymongo.DESCENDING)
+        .limit(limit)
+    )
+    df = pd.json_normalize(list(entries))
+    if not df.empty:
+        df = df.rename(columns={'data.name': 'name', 'data.ts': 'ts', 'data.reading': 'duration'})
+        df['time'] = pd.to_datetime(df['ts'], unit='s', utc=True)
+    return df
@@ -25,15 +25,23 @@ user_pool_id = CognitoConfig.USER_POOL_ID
 region = CognitoConfig.REGION
 
 keys_url = f'https://cognito-idp.{region}.amazonaws.com/{user_pool_id}/.well-known/jwks.json'
-# instead of re-downloading the public keys every time
-# we download them only on cold start
-# https://aws.amazon.com/blogs/compute/container-reuse-in-lambda/
-with urllib.request.urlopen(keys_url) as f:
-    response = f.read()
-keys = json.loads(response.decode('utf-8'))['keys']
+keys = None
+
+
+def get_keys():
+    # instead of re-downloading the public keys every time
+    # we download them only once, on first use (or in the warmup)
+    # https://aws.amazon.com/blogs/compute/container-reuse-in-lambda/
+    global keys
+    if keys is None:
+        with urllib.request.urlopen(keys_url) as f:
+            response = f.read()
+        keys = json.loads(response.decode('utf-8'))['keys']
+    return keys
 
 
 def lambda_handler(token):
+    keys = get_keys()
     # get the kid from the headers prior to verification
     headers = jwt.get_unverified_headers(token)
     kid = headers['kid']
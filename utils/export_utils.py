@@ -0,0 +1,326 @@
+"""
+Server-side exports of the Data tab datasets, streamed straight from a Mongo cursor:
+
+    /export/trips?format=csv&start_date=2023-01-01&end_date=2023-12-31
+    /export/trajectories?format=csv.gz&start_date=...&end_date=...
+    /export/uuids?format=parquet
+    /export/demographics?format=csv&survey=UserProfileSurvey
+
+The cursor is read EXPORT_CHUNK_SIZE documents at a time, and every chunk goes through the
+same normalization (and permission column exclusions) as the Data tab before it is written
+out, so the memory use does not depend on the size of the export. Unlike the Data tab, the
+trips keep the raw distance (meters) and duration (seconds) next to the humanized values.
+
+The header (and the Parquet schema) is sent before the rest of the file, so the columns are
+worked out up front rather than from the first chunk: a label or a survey answer that the
+first chunk does not have would otherwise be dropped, or typed from a column of NaNs.
+"""
+import logging
+import math
+import os
+import zlib
+from datetime import date
+
+import flask
+import pandas as pd
+
+from utils import admission_utils
+from utils import constants
+from utils import db_utils
+from utils import http_utils
+from utils import instrumentation
+from utils import permissions as perm_utils
+from utils.import_utils import lazy_import
+
+edb = lazy_import('emission.core.get_database')
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # pyarrow is optional, without it only the CSV formats are available
+    pa = None
+    pq = None
+
+EXPORT_CHUNK_SIZE = int(os.getenv('DASH_EXPORT_CHUNK_SIZE', '5000'))
+
+FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'csv.gz': ('application/gzip', 'csv.gz'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet'),
+}
+
+HUMANIZED_TRIP_COLUMNS = ['data.distance_humanized', 'data.duration_humanized']
+# dicts in the trip documents, that json_normalize flattens into columns the tables do not show
+NESTED_TRIP_COLUMNS = {'data.start_local_dt', 'data.end_local_dt'}
+
+
+def _chunks(cursor):
+    chunk = []
+    for entry in cursor:
+        chunk.append(entry)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _trips_frame(entries):
+    df = db_utils.normalize_confirmed_trips(entries)
+    if 'data.distance' in df.columns:
+        df['data.distance_humanized'] = db_utils.humanize_distance(df['data.distance'])
+    if 'data.duration' in df.columns:
+        df['data.duration_humanized'] = db_utils.humanize_duration(df['data.duration'])
+    return df
+
+
+def _trips_columns():
+    """The trip columns of the export, and the ones that are text (the labels)"""
+    profile = perm_utils.get_permission_profile()
+    columns = []
+    for col in constants.VALID_TRIP_COLS:
+        if col not in profile.trips_table_columns or col in NESTED_TRIP_COLUMNS:
+            continue
+        # the coordinates are loaded as separate lon and lat columns
+        columns += constants.COORDINATE_COLS.get(col, (col,))
+    for col, humanized_col in zip(['data.distance', 'data.duration'], HUMANIZED_TRIP_COLUMNS):
+        if col in profile.trips_table_columns:
+            columns.append(humanized_col)
+    labels = [col['label'] for col in profile.allowed_named_trip_columns]
+    return columns + labels, labels
+
+
+def _uuids_frame(entries):
+    data = db_utils.uuids_to_df(entries).to_dict('records')
+    return pd.DataFrame(db_utils.add_user_stats(data))
+
+
+def _uuids_columns():
+    uuids_columns = perm_utils.get_permission_profile().uuids_columns
+    return [col for col in constants.valid_uuids_columns if col in uuids_columns], []
+
+
+def _trajectories_columns(df):
+    allowed = perm_utils.get_trajectories_columns(df.columns)
+    return [col for col in df.columns if col in allowed]
+
+
+def _demographics_columns(survey):
+    """
+    The columns of all the responses to the survey (they only have the questions that were
+    answered), collected by a first pass over them; the answers are all exported as text
+    """
+    columns = {}
+    cursor = (edb.get_timeseries_db()
+              .find(db_utils.demographics_query(survey), {'metadata': 0, 'data.xmlResponse': 0})
+              .batch_size(EXPORT_CHUNK_SIZE))
+    try:
+        for chunk in _chunks(cursor):
+            columns.update(dict.fromkeys(db_utils.normalize_demographics(survey, chunk).columns))
+    finally:
+        cursor.close()
+    allowed = perm_utils.get_demographic_columns(columns)
+    columns = [col for col in columns if col in allowed]
+    return columns, columns
+
+
+def get_export(dataset, start_date, end_date, survey=None):
+    """
+    Return the cursor, the chunk -> dataframe function, the columns of the export and the
+    columns that are exported as text, for a dataset. The recreated locations all have the
+    same fields, so the columns of the trajectories are a first chunk -> columns function.
+    """
+    if dataset == 'trips':
+        cursor = (edb.get_analysis_timeseries_db()
+                  .find(db_utils.confirmed_trips_query(start_date, end_date))
+                  .sort('data.start_ts', 1))
+        return (cursor, _trips_frame) + _trips_columns()
+    if dataset == 'trajectories':
+        cursor = (edb.get_analysis_timeseries_db()
+                  .find(db_utils.trajectories_query(start_date, end_date))
+                  .sort('data.ts', 1))
+        return cursor, db_utils.normalize_trajectories, _trajectories_columns, []
+    if dataset == 'uuids':
+        cursor = (edb.get_uuid_db()
+                  .find(db_utils.uuids_query(start_date, end_date), db_utils.UUIDS_PROJECTION)
+                  .sort('update_ts', 1))
+        return (cursor, _uuids_frame) + _uuids_columns()
+    if dataset == 'demographics':
+        columns, text_columns = _demographics_columns(survey)
+        cursor = edb.get_timeseries_db().find(db_utils.demographics_query(survey))
+        return cursor, lambda entries: db_utils.normalize_demographics(survey, entries), columns, text_columns
+    raise KeyError(dataset)
+
+
+def _to_text(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return str(value)
+
+
+def iter_frames(cursor, to_frame, columns, text_columns):
+    """
+    The export as dataframes of (at most) EXPORT_CHUNK_SIZE rows, all with the same columns
+    (see get_export), the text columns as strings or None
+    """
+    try:
+        for chunk in _chunks(cursor.batch_size(EXPORT_CHUNK_SIZE)):
+            df = to_frame(chunk)
+            if callable(columns):
+                columns = columns(df)
+            df = df.reindex(columns=columns)
+            for col in text_columns:
+                df[col] = df[col].map(_to_text).astype(object)
+            yield df
+    finally:
+        cursor.close()
+
+
+def iter_csv(frames):
+    header = True
+    for df in frames:
+        yield df.to_csv(index=False, header=header).encode('utf-8')
+        header = False
+
+
+def iter_csv_gz(frames):
+    # wbits=31 writes the gzip header and trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for data in iter_csv(frames):
+        compressed = compressor.compress(data)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _StreamSink:
+    """Write-only file for the ParquetWriter that hands out what was written so far"""
+    closed = False
+
+    def __init__(self):
+        self._buffer = []
+        self._position = 0
+
+    def write(self, data):
+        self._buffer.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._buffer)
+        self._buffer = []
+        return data
+
+
+def _arrow_table(df, schema=None, text_columns=()):
+    # the lists (e.g. coordinates) are kept, anything else that is not a plain value is written as text
+    for col in df.columns:
+        if df[col].dtype == object and not df[col].map(lambda v: v is None or isinstance(v, (str, list))).all():
+            df[col] = df[col].astype(str)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if schema is None:
+        # the text columns are declared up front, the columns that are empty in the first
+        # chunk have no type yet
+        schema = pa.schema([
+            field.with_type(pa.string()) if field.name in text_columns or pa.types.is_null(field.type) else field
+            for field in table.schema
+        ])
+    return table.cast(schema), schema
+
+
+def iter_parquet(frames, text_columns=()):
+    sink = _StreamSink()
+    writer = None
+    schema = None
+    for df in frames:
+        table, schema = _arrow_table(df, schema, text_columns)
+        if writer is None:
+            writer = pq.ParquetWriter(pa.PythonFile(sink, mode='w'), schema)
+        # one row group per chunk
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+    yield sink.drain()
+
+
+WRITERS = {
+    'csv': iter_csv,
+    'csv.gz': iter_csv_gz,
+    'parquet': iter_parquet,
+}
+
+
+def _count_rows(frames, dataset):
+    for df in frames:
+        instrumentation.increment('query_rows', f'export_{dataset}', len(df))
+        yield df
+
+
+def _parse_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def init_export(server):
+    @server.route('/export/<dataset>')
+    def export(dataset):
+        if not http_utils.is_authenticated():
+            flask.abort(401)
+        if dataset not in ('trips', 'trajectories', 'uuids', 'demographics'):
+            flask.abort(404)
+        if not perm_utils.has_permission(f'data_{dataset}'):
+            flask.abort(403)
+
+        fmt = flask.request.args.get('format', 'csv')
+        if fmt not in FORMATS:
+            flask.abort(400, f"Unknown format {fmt}, use one of {', '.join(FORMATS)}")
+        if fmt == 'parquet' and pa is None:
+            flask.abort(400, "The parquet export needs pyarrow, use csv or csv.gz")
+        try:
+            start_date = _parse_date(flask.request.args.get('start_date'))
+            end_date = _parse_date(flask.request.args.get('end_date'))
+        except ValueError:
+            flask.abort(400, "The dates must be formatted as YYYY-MM-DD")
+        survey = flask.request.args.get('survey')
+        if dataset == 'demographics' and (not survey or '.' in survey or survey.startswith('$')):
+            flask.abort(400, "Pick the survey to export with ?survey=")
+
+        logging.debug("Exporting %s as %s for %s -> %s" % (dataset, fmt, start_date, end_date))
+        # held until the whole file is sent, a busy server answers 503 before anything is streamed
+        weight = admission_utils.controller.acquire('heavy')
+        try:
+            cursor, to_frame, columns, text_columns = get_export(dataset, start_date, end_date, survey)
+            frames = iter_frames(cursor, to_frame, columns, text_columns)
+            writer_args = (text_columns,) if fmt == 'parquet' else ()
+
+            def generate():
+                # the queries of the export (e.g. add_user_stats) run on the units it holds
+                with admission_utils.controller.holding():
+                    for data in WRITERS[fmt](_count_rows(frames, dataset), *writer_args):
+                        if data:
+                            yield data
+
+            mimetype, extension = FORMATS[fmt]
+            filename = '_'.join(str(part) for part in [dataset, survey, start_date, end_date] if part)
+            response = flask.Response(
+                flask.stream_with_context(generate()),
+                mimetype=mimetype,
+                headers={'Content-Disposition': f'attachment; filename="{filename}.{extension}"'},
+            )
+            response.call_on_close(lambda: admission_utils.controller.release(weight))
+        except Exception:
+            admission_utils.controller.release(weight)
+            raise
+        return response
@@ -1,9 +1,18 @@
-import secrets
 import argparse
-import base64
+import hashlib
 import os
-import qrcode
-import PIL as pil
+import tempfile
+from xml.sax.saxutils import escape
+
+# Bump when the look of the codes changes (size, label, ...), so that the cached files are
+# rendered again instead of being served as they are
+QR_TEMPLATE_VERSION = 2
+
+# pixels per module of the QR code, and the height of the label above it
+MODULE_SIZE = 10
+LABEL_HEIGHT = 30
+
+FORMATS = ('svg', 'png')
 
 def readRandomTokens(filename):
     tokens = []
@@ -11,13 +20,86 @@ def readRandomTokens(filename):
         tokens = [t.strip() for t in fp.readlines()]
     return tokens
 
-def saveAsQRCode(outdir, token):
-    qrcode_data = "nrelopenpath://login_token?token="+token
-    qrcode_img = qrcode.make(qrcode_data)
-    draw = pil.ImageDraw.Draw(qrcode_img)
-    draw.text((55,10), token, fill=0, align="center", anchor="mm")
-    qrcode_filename = outdir+"/"+token+".png"
-    qrcode_img.save(qrcode_filename)
+def getQRCodeData(token):
+    return "nrelopenpath://login_token?token="+token
+
+def getQRCodeFilename(token, fmt='svg'):
+    """
+    The rendered codes are content-addressed: the name only depends on the token, the
+    template version and the format, so an existing file never has to be rendered again.
+    """
+    key = f"{QR_TEMPLATE_VERSION}/{fmt}/{token}".encode('utf-8')
+    return hashlib.sha256(key).hexdigest()[:32] + "." + fmt
+
+def getQRCodeMatrix(token):
+    import qrcode
+    qr = qrcode.QRCode(border=4)
+    qr.add_data(getQRCodeData(token))
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+def renderSVG(token):
+    """The QR code as an SVG path (one subpath per run of dark modules), with the token as text"""
+    matrix = getQRCodeMatrix(token)
+    size = len(matrix)
+    runs = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if row[x]:
+                start = x
+                while x < size and row[x]:
+                    x += 1
+                runs.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+            else:
+                x += 1
+    width = size * MODULE_SIZE
+    height = width + LABEL_HEIGHT
+    return (
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" viewBox="0 0 {width} {height}">'
+        f'<rect width="100%" height="100%" fill="#fff"/>'
+        f'<text x="{width / 2}" y="{LABEL_HEIGHT * 0.75}" font-family="sans-serif" font-size="{LABEL_HEIGHT // 2}" '
+        f'text-anchor="middle">{escape(token)}</text>'
+        f'<path transform="translate(0 {LABEL_HEIGHT}) scale({MODULE_SIZE})" d="{"".join(runs)}"/>'
+        f'</svg>'
+    ).encode('utf-8')
+
+def renderPNG(token):
+    """The raster version of the same layout, for the printing vendors that need one"""
+    import io
+    import qrcode
+    from PIL import Image, ImageDraw
+    qrcode_img = qrcode.make(getQRCodeData(token), box_size=MODULE_SIZE).get_image().convert('L')
+    img = Image.new('L', (qrcode_img.width, qrcode_img.height + LABEL_HEIGHT), 255)
+    img.paste(qrcode_img, (0, LABEL_HEIGHT))
+    draw = ImageDraw.Draw(img)
+    draw.text((img.width / 2, LABEL_HEIGHT / 2), token, fill=0, align="center", anchor="mm")
+    output = io.BytesIO()
+    img.save(output, format='PNG')
+    return output.getvalue()
+
+RENDERERS = {
+    'svg': renderSVG,
+    'png': renderPNG,
+}
+
+def saveAsQRCode(outdir, token, fmt='svg'):
+    """Render the QR code of the token into outdir, unless it is already there; returns its path"""
+    qrcode_filename = os.path.join(outdir, getQRCodeFilename(token, fmt))
+    if not os.path.exists(qrcode_filename):
+        # rendered before any file is created, so that a failed render leaves nothing behind
+        data = RENDERERS[fmt](token)
+        os.makedirs(outdir, exist_ok=True)
+        # written under a temporary name first, so that a concurrent reader never sees half a file
+        # (a unique name per call, as the threads of a worker can render the same code at once)
+        fp = tempfile.NamedTemporaryFile(dir=outdir, suffix='.tmp', delete=False)
+        try:
+            with fp:
+                fp.write(data)
+            os.replace(fp.name, qrcode_filename)
+        except OSError:
+            os.remove(fp.name)
+            raise
     return qrcode_filename
 
 if __name__ == '__main__':
@@ -25,11 +107,14 @@ if __name__ == '__main__':
 
     parser.add_argument("token_file_name")
     parser.add_argument("qr_code_dir")
+    parser.add_argument("--format", choices=FORMATS, default='svg')
     args = parser.parse_args()
 
     tokens = readRandomTokens(args.token_file_name)
     for t in tokens[0:10]:
         print(t)
     os.makedirs(args.qr_code_dir, exist_ok=True)
+    # named after the tokens rather than content-addressed, for the people handing them out
     for t in tokens:
-        saveAsQRCode(args.qr_code_dir, t)    
+        with open(os.path.join(args.qr_code_dir, t + "." + args.format), 'wb') as fp:
+            fp.write(RENDERERS[args.format](t))
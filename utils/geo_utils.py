@@ -0,0 +1,133 @@
+"""
+Geometry helpers of the map page: the region selection, and the polyline simplification
+of the trajectories map.
+
+The recreated locations of a trip have a point every few seconds, far more than can be seen
+at city or region zoom levels. The routes are simplified with Ramer-Douglas-Peucker, with a
+tolerance of a few pixels at the current zoom level, and the simplified geometry is cached
+per route (its points, as a section is clipped to the date range) and zoom level. If the routes still have more than the vertex budget, they are
+simplified as for a lower zoom level until they fit.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# how far (in pixels on screen) a point can be from the simplified route
+SIMPLIFY_PIXELS = float(os.getenv('DASH_MAP_SIMPLIFY_PIXELS', '2'))
+VERTEX_BUDGET = int(os.getenv('DASH_MAP_VERTEX_BUDGET', '50000'))
+MAX_CACHED_ROUTES = int(os.getenv('DASH_MAP_ROUTE_CACHE_SIZE', '20000'))
+
+
+def segment_distances(points, start, end):
+    """Distances from the points (an n x 2 array) to the segment start -> end"""
+    segment = end - start
+    length_sq = segment @ segment
+    if length_sq == 0:
+        return np.hypot(*(points - start).T)
+    t = np.clip(((points - start) @ segment) / length_sq, 0, 1)
+    projections = start + t[:, None] * segment
+    return np.hypot(*(points - projections).T)
+
+
+def simplify(points, tolerance):
+    """
+    Ramer-Douglas-Peucker simplification of a polyline (an n x 2 array of lon, lat).
+    Each step handles all the points of a segment at once, and the recursion is unrolled
+    into a stack so that long routes do not hit the recursion limit.
+    """
+    n = len(points)
+    if n < 3 or tolerance <= 0:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        distances = segment_distances(points[first + 1:last], points[first], points[last])
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            farthest += first + 1
+            keep[farthest] = True
+            stack.append((first, farthest))
+            stack.append((farthest, last))
+    return points[keep]
+
+
+def tolerance_for_zoom(zoom_level):
+    # at zoom 0, the 256 pixels of a web mercator tile span 360 degrees
+    return SIMPLIFY_PIXELS * 360 / (256 * 2 ** zoom_level)
+
+
+# (route key, hash of its points, zoom level) -> simplified points
+_simplified_routes = OrderedDict()
+_simplified_routes_lock = threading.Lock()
+
+
+def get_simplified_route(key, points, zoom_level):
+    # the same section has other points in a range that only covers part of it
+    points_hash = hashlib.blake2b(np.ascontiguousarray(points).tobytes(), digest_size=16).digest()
+    cache_key = (key, points_hash, zoom_level)
+    with _simplified_routes_lock:
+        simplified = _simplified_routes.get(cache_key)
+        if simplified is not None:
+            _simplified_routes.move_to_end(cache_key)
+            return simplified
+    simplified = simplify(points, tolerance_for_zoom(zoom_level))
+    with _simplified_routes_lock:
+        _simplified_routes[cache_key] = simplified
+        while len(_simplified_routes) > MAX_CACHED_ROUTES:
+            _simplified_routes.popitem(last=False)
+    return simplified
+
+
+def simplify_routes(routes, zoom, budget=VERTEX_BUDGET):
+    """
+    Simplify the routes ({key: n x 2 array}) for the zoom level, and keep the total number of
+    vertices under the budget. Returns the simplified routes and the zoom level they were
+    simplified for.
+    """
+    zoom_level = max(0, int(zoom))
+    while True:
+        simplified = {key: get_simplified_route(key, points, zoom_level) for key, points in routes.items()}
+        total = sum(len(points) for points in simplified.values())
+        if total <= budget or zoom_level == 0:
+            break
+        zoom_level -= 1
+    if total > budget:
+        # even the coarsest routes do not fit, draw as many as we can
+        kept, total = {}, 0
+        for key, points in simplified.items():
+            if total + len(points) > budget:
+                break
+            kept[key] = points
+            total += len(points)
+        simplified = kept
+    return simplified, zoom_level
+
+
+def selection_to_polygon(selected_data):
+    """
+    The box or lasso selection of a mapbox graph (its `selectedData`) as the closed ring of
+    a GeoJSON polygon, or None if nothing is selected.
+    """
+    if not selected_data:
+        return None
+    if 'range' in selected_data and 'mapbox' in selected_data['range']:
+        (lon1, lat1), (lon2, lat2) = selected_data['range']['mapbox']
+        ring = [[lon1, lat1], [lon2, lat1], [lon2, lat2], [lon1, lat2]]
+    elif 'lassoPoints' in selected_data and 'mapbox' in selected_data['lassoPoints']:
+        ring = [list(point) for point in selected_data['lassoPoints']['mapbox']]
+    else:
+        return None
+    if len(ring) < 3:
+        return None
+    # GeoJSON rings are closed and counter-clockwise
+    area = sum(x1 * y2 - x2 * y1 for (x1, y1), (x2, y2) in zip(ring, ring[1:] + ring[:1]))
+    if area < 0:
+        ring = ring[::-1]
+    return ring + [ring[0]]
@@ -0,0 +1,97 @@
+"""
+HTTP level optimizations for the flask server that hosts the dashboard:
+- gzip/brotli compression of the (often multi-megabyte) callback responses
+- long-lived cache headers for the static assets and the generated QR codes
+"""
+import gzip
+import os
+
+import flask
+
+from utils import instrumentation
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, we fall back to gzip
+    brotli = None
+
+COMPRESSION_MIN_BYTES = int(os.getenv('DASH_COMPRESSION_MIN_BYTES', '1024'))
+COMPRESSIBLE_MIMETYPES = {
+    'application/json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/plain',
+    'image/svg+xml',
+}
+
+ONE_YEAR = 365 * 24 * 60 * 60
+ASSETS_MAX_AGE = int(os.getenv('DASH_ASSETS_MAX_AGE', str(60 * 60)))
+
+
+def _compress(data, accepted):
+    if brotli is not None and 'br' in accepted:
+        return 'br', brotli.compress(data, quality=5)
+    if 'gzip' in accepted:
+        return 'gzip', gzip.compress(data, compresslevel=6)
+    return None, data
+
+
+def is_authenticated():
+    """For the plain flask routes, which the cognito login of the Dash pages does not cover"""
+    # basic auth is enforced by dash_auth for every route of the server
+    if os.getenv('AUTH_TYPE') != 'cognito':
+        return True
+    from utils import decode_jwt
+    token = flask.request.cookies.get('token')
+    return token is not None and bool(decode_jwt.lambda_handler(token))
+
+
+def init_compression(server):
+    @server.after_request
+    def compress_response(response):
+        if (response.direct_passthrough
+                or response.is_streamed
+                or response.status_code != 200
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_BYTES:
+            return response
+        encoding, compressed = _compress(data, flask.request.accept_encodings)
+        if encoding is None:
+            return response
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        instrumentation.increment('compression_bytes_in', encoding, len(data))
+        instrumentation.increment('compression_bytes_out', encoding, len(compressed))
+        return response
+
+
+def init_static_caching(server):
+    """
+    Flask already serves the assets with (strong, mtime and size based) ETags and handles
+    If-None-Match, so we only need to tell the browsers how long they can skip revalidating.
+    """
+    @server.after_request
+    def cache_static(response):
+        path = flask.request.path
+        if '/assets/' not in path or response.status_code not in (200, 304):
+            return response
+        if '/assets/qrcodes/' in path:
+            # a QR code never changes once it has been generated for a token
+            response.cache_control.public = True
+            response.cache_control.max_age = ONE_YEAR
+            response.cache_control.immutable = True
+        elif 'm' in flask.request.args:
+            # dash fingerprints the assets it links to with their modification time
+            response.cache_control.public = True
+            response.cache_control.max_age = ONE_YEAR
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = ASSETS_MAX_AGE
+        response.cache_control.no_cache = None
+        return response
@@ -0,0 +1,38 @@
+import importlib
+import logging
+import threading
+import time
+import types
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for a module that is only imported the first time one of its attributes is used.
+    Unlike importlib.util.LazyLoader, the first load is safe to trigger from several threads
+    (e.g. the store loaders), and the real module is imported normally into sys.modules.
+    """
+    def __init__(self, name):
+        super().__init__(name)
+        self._lazy_lock = threading.Lock()
+        self._lazy_module = None
+
+    def _load(self):
+        with self._lazy_lock:
+            if self._lazy_module is None:
+                start = time.perf_counter()
+                self._lazy_module = importlib.import_module(self.__name__)
+                logging.debug("Lazily imported %s in %.3f s" % (self.__name__, time.perf_counter() - start))
+        return self._lazy_module
+
+    def __getattr__(self, attr):
+        module = self._lazy_module or self._load()
+        return getattr(module, attr)
+
+
+def lazy_import(name):
+    """
+    `edb = lazy_import('emission.core.get_database')` behaves like
+    `import emission.core.get_database as edb`, but defers the (slow, and for emission
+    database-connecting) import to the first use, so that the app boots quickly.
+    """
+    return LazyModule(name)
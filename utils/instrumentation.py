@@ -0,0 +1,212 @@
+"""
+Latency instrumentation for the dashboard.
+
+- every Dash callback request (wall time and response size, i.e. what ends up in a dcc.Store)
+- every `db_utils` query decorated with `timed_query` (wall time and rows fetched)
+- every store loader run by `loader_utils.run_loaders` (wall time)
+- every Mongo command, through pymongo command monitoring
+
+The numbers are kept in memory per worker process. They are shown on the Settings page and
+exported in the Prometheus text format at `/metrics`.
+"""
+import bisect
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+import flask
+import pandas as pd
+from pymongo import monitoring
+
+SLOW_THRESHOLD_SECONDS = float(os.getenv('DASH_SLOW_QUERY_SECONDS', '1.0'))
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+RECENT_SAMPLES = 500
+
+_lock = threading.Lock()
+
+
+class Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.bucket_counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+# metric name -> label value -> Histogram
+histograms = {
+    'callback': {},
+    'query': {},
+    'loader': {},
+    'mongo_command': {},
+    'admission_wait': {},
+}
+# metric name -> label value -> running total
+counters = {
+    'callback_response_bytes': {},
+    'query_rows': {},
+    'compression_bytes_in': {},
+    'compression_bytes_out': {},
+    'admission_admitted': {},
+    'admission_rejected': {},
+    'single_flight_executed': {},
+    'single_flight_shared': {},
+}
+# (kind, name, duration) of the most recent callbacks, loaders and queries, for the latency histogram
+recent_samples = deque(maxlen=RECENT_SAMPLES)
+# everything slower than SLOW_THRESHOLD_SECONDS
+slow_log = deque(maxlen=100)
+
+METRIC_HELP = {
+    'callback': ('dashboard_callback_duration_seconds', 'Wall time of the Dash callback requests', 'callback'),
+    'query': ('dashboard_query_duration_seconds', 'Wall time of the db_utils queries', 'query'),
+    'loader': ('dashboard_loader_duration_seconds', 'Wall time of the store loaders', 'loader'),
+    'mongo_command': ('dashboard_mongo_command_duration_seconds', 'Duration of the Mongo commands', 'command'),
+    'callback_response_bytes': ('dashboard_callback_response_bytes_total', 'Bytes returned by the Dash callbacks', 'callback'),
+    'query_rows': ('dashboard_query_rows_total', 'Rows fetched by the db_utils queries', 'query'),
+    'compression_bytes_in': ('dashboard_compression_bytes_in_total', 'Response bytes before compression', 'encoding'),
+    'compression_bytes_out': ('dashboard_compression_bytes_out_total', 'Response bytes after compression', 'encoding'),
+    'admission_wait': ('dashboard_admission_wait_seconds', 'Time the queries waited for capacity', 'class'),
+    'admission_admitted': ('dashboard_admission_admitted_total', 'Queries admitted by the admission control', 'class'),
+    'admission_rejected': ('dashboard_admission_rejected_total', 'Queries rejected as busy by the admission control', 'class'),
+    'single_flight_executed': ('dashboard_single_flight_executed_total', 'Queries run against the database by the single-flight layer', 'query'),
+    'single_flight_shared': ('dashboard_single_flight_shared_total', 'Queries saved by sharing the result of an identical running query', 'query'),
+}
+
+
+def record(kind, name, duration, **details):
+    with _lock:
+        histograms[kind].setdefault(name, Histogram()).observe(duration)
+        if kind in ('callback', 'loader', 'query'):
+            recent_samples.append((kind, name, duration))
+        if duration >= SLOW_THRESHOLD_SECONDS:
+            slow_log.append(dict(
+                time=time.strftime('%Y-%m-%d %H:%M:%S'),
+                kind=kind,
+                name=name,
+                duration=round(duration, 3),
+                **details,
+            ))
+
+
+def increment(counter, name, value):
+    with _lock:
+        counters[counter][name] = counters[counter].get(name, 0) + value
+
+
+def count_rows(result):
+    if isinstance(result, pd.DataFrame):
+        return len(result)
+    if isinstance(result, dict):
+        return sum(count_rows(value) for value in result.values())
+    if isinstance(result, list):
+        return len(result)
+    return 0
+
+
+def timed_query(func):
+    """Record the wall time and number of rows returned by a db_utils query"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        duration = time.perf_counter() - start
+        rows = count_rows(result)
+        record('query', func.__name__, duration, rows=rows)
+        increment('query_rows', func.__name__, rows)
+        return result
+    return wrapper
+
+
+class CommandTimer(monitoring.CommandListener):
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        record('mongo_command', event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        record('mongo_command', event.command_name, event.duration_micros / 1e6, failure=str(event.failure))
+
+
+# Only applies to the clients created after this, so this module has to be imported before
+# anything that connects to the database
+monitoring.register(CommandTimer())
+
+
+def init_instrumentation(server):
+    """Time the Dash callback requests and expose /metrics on the flask server"""
+    @server.before_request
+    def start_timer():
+        flask.g.request_start = time.perf_counter()
+
+    @server.after_request
+    def record_callback(response):
+        if flask.request.path.endswith('/_dash-update-component') and 'request_start' in flask.g:
+            duration = time.perf_counter() - flask.g.request_start
+            body = flask.request.get_json(silent=True) or {}
+            name = body.get('output', 'unknown')
+            size = response.calculate_content_length() or 0
+            record('callback', name, duration, bytes=size)
+            increment('callback_response_bytes', name, size)
+        return response
+
+    @server.route('/metrics')
+    def metrics():
+        # imported here, http_utils records its compression savings in this module
+        from utils.http_utils import is_authenticated
+        if not is_authenticated():
+            flask.abort(401)
+        return flask.Response(render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus():
+    lines = []
+    with _lock:
+        for kind, by_name in histograms.items():
+            metric, help_text, label = METRIC_HELP[kind]
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, hist in by_name.items():
+                cumulative = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + ['+Inf'], hist.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f'{metric}_bucket{{{label}="{_escape(name)}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{{label}="{_escape(name)}"}} {hist.sum}')
+                lines.append(f'{metric}_count{{{label}="{_escape(name)}"}} {hist.count}')
+        for counter, by_name in counters.items():
+            metric, help_text, label = METRIC_HELP[counter]
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for name, value in by_name.items():
+                lines.append(f'{metric}{{{label}="{_escape(name)}"}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def get_recent_samples():
+    with _lock:
+        return pd.DataFrame(list(recent_samples), columns=['kind', 'name', 'duration'])
+
+
+def get_compression_savings():
+    """Bytes saved by the response compression, per encoding"""
+    with _lock:
+        return {
+            encoding: bytes_in - counters['compression_bytes_out'].get(encoding, 0)
+            for encoding, bytes_in in counters['compression_bytes_in'].items()
+        }
+
+
+def get_slow_log():
+    with _lock:
+        return list(reversed(slow_log))
@@ -0,0 +1,182 @@
+"""
+Live mode of the overview (home page): instead of re-running the queries of the whole date
+range every few seconds, every worker keeps the overview counts of a range in memory along
+with a watermark per dataset, and only fetches what was written after the watermark:
+- confirmed trips: `metadata.write_ts`
+- sign-ups: `update_ts` of the UUID entries
+- calls to /usercache/get (for the active users): `metadata.write_ts`
+
+The pipeline stamps the entries before it inserts them in batches, so an entry can show up
+after entries with a later timestamp. Every fetch re-reads the last LIVE_OVERLAP_SECONDS
+before the watermark: the sign-ups and the last calls are keyed by user, and the trips of
+that window are remembered by `_id`, so nothing is counted twice.
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+from datetime import timedelta
+from uuid import UUID
+
+from utils import db_utils
+from utils.admission_utils import admit
+from utils.import_utils import lazy_import
+from utils.instrumentation import timed_query
+
+edb = lazy_import('emission.core.get_database')
+
+ACTIVE_USER_SECONDS = 24 * 60 * 60
+# number of date ranges that we keep the live counts of
+MAX_LIVE_RANGES = 8
+# how late an entry can be inserted after its timestamp and still be counted
+LIVE_OVERLAP_SECONDS = int(os.getenv('DASH_LIVE_OVERLAP_SECONDS', '300'))
+
+
+def _user_id_str(value):
+    # the user ids come back as UUIDs or as the bson Binary they are stored as
+    return str(value if isinstance(value, UUID) else UUID(bytes=bytes(value)))
+
+
+class LiveOverview:
+    def __init__(self, start_date, end_date, trips_start_date, trips_end_date):
+        # the home page shows all the users when no range is picked, but only the last week of trips
+        self.uuids_range = (start_date, end_date)
+        self.trips_range = (trips_start_date, trips_end_date)
+        self.lock = threading.Lock()
+        self.watermarks = {'trips': None, 'uuids': None, 'api_calls': None}
+        self.signup_days = {}
+        self.trips_per_day = Counter()
+        # _id -> metadata.write_ts of the trips that the next fetch can return again
+        self.recent_trips = {}
+        # the trips before this were counted in bulk by the first fetch
+        self.trips_floor = None
+        self.last_get = {}
+
+    def refresh(self):
+        with self.lock:
+            self._fetch_uuids()
+            self._fetch_trips()
+            self._fetch_api_calls()
+            logging.debug("Live overview watermarks %s" % self.watermarks)
+
+    def _fetch_uuids(self):
+        query = db_utils.uuids_query(*self.uuids_range)
+        if self.watermarks['uuids'] is not None:
+            overlap_start = self.watermarks['uuids'] - timedelta(seconds=LIVE_OVERLAP_SECONDS)
+            query.setdefault('update_ts', {})['$gte'] = overlap_start
+        for entry in edb.get_uuid_db().find(query, {'_id': 0, 'uuid': 1, 'update_ts': 1}):
+            if entry.get('update_ts') is None:
+                continue
+            # keyed by user, so that an updated entry is not counted twice
+            self.signup_days[_user_id_str(entry['uuid'])] = entry['update_ts'].date().isoformat()
+            if self.watermarks['uuids'] is None or entry['update_ts'] > self.watermarks['uuids']:
+                self.watermarks['uuids'] = entry['update_ts']
+
+    def _fetch_trips(self):
+        match = db_utils.confirmed_trips_query(*self.trips_range)
+        if self.trips_floor is None:
+            # count everything but the overlap window in the database
+            self.trips_floor = time.time() - LIVE_OVERLAP_SECONDS
+            days = edb.get_analysis_timeseries_db().aggregate([
+                {'$match': dict(match, **{'metadata.write_ts': {'$lt': self.trips_floor}})},
+                {'$group': {
+                    '_id': {
+                        'year': '$data.start_local_dt.year',
+                        'month': '$data.start_local_dt.month',
+                        'day': '$data.start_local_dt.day',
+                    },
+                    'count': {'$sum': 1},
+                }},
+            ])
+            for day in days:
+                self.trips_per_day[self._day_key(day['_id'])] += day['count']
+            self.watermarks['trips'] = self.trips_floor
+
+        overlap_start = max(self.trips_floor, self.watermarks['trips'] - LIVE_OVERLAP_SECONDS)
+        match['metadata.write_ts'] = {'$gte': overlap_start}
+        trips = edb.get_analysis_timeseries_db().find(match, {
+            'metadata.write_ts': 1,
+            'data.start_local_dt.year': 1,
+            'data.start_local_dt.month': 1,
+            'data.start_local_dt.day': 1,
+        })
+        for trip in trips:
+            write_ts = trip['metadata']['write_ts']
+            self.watermarks['trips'] = max(self.watermarks['trips'], write_ts)
+            if trip['_id'] in self.recent_trips:
+                continue
+            self.recent_trips[trip['_id']] = write_ts
+            self.trips_per_day[self._day_key(trip['data']['start_local_dt'])] += 1
+
+        # the next fetch does not go back further than this
+        overlap_start = max(self.trips_floor, self.watermarks['trips'] - LIVE_OVERLAP_SECONDS)
+        self.recent_trips = {_id: ts for _id, ts in self.recent_trips.items() if ts >= overlap_start}
+
+    @staticmethod
+    def _day_key(local_dt):
+        return '%04d-%02d-%02d' % (local_dt['year'], local_dt['month'], local_dt['day'])
+
+    def _fetch_api_calls(self):
+        if self.watermarks['api_calls'] is None:
+            # only the calls of the last day can make a user active
+            watermark = time.time() - ACTIVE_USER_SECONDS
+            since = watermark
+        else:
+            watermark = self.watermarks['api_calls']
+            since = watermark - LIVE_OVERLAP_SECONDS
+        last_gets = edb.get_timeseries_db().aggregate([
+            {'$match': {
+                'metadata.key': 'stats/server_api_time',
+                'data.name': 'POST_/usercache/get',
+                'metadata.write_ts': {'$gte': since},
+            }},
+            {'$group': {'_id': '$user_id', 'write_ts': {'$max': '$metadata.write_ts'}}},
+        ])
+        for item in last_gets:
+            user_id = _user_id_str(item['_id'])
+            self.last_get[user_id] = max(item['write_ts'], self.last_get.get(user_id, 0))
+            watermark = max(watermark, item['write_ts'])
+        self.watermarks['api_calls'] = watermark
+
+    def get_number_of_active_users(self):
+        now = time.time()
+        return sum(
+            1 for user_id in self.signup_days
+            if now - self.last_get.get(user_id, 0) <= ACTIVE_USER_SECONDS
+        )
+
+    def get_signups_per_day(self):
+        return Counter(self.signup_days.values())
+
+    def get_summary(self):
+        with self.lock:
+            return {
+                'users': len(self.signup_days),
+                'active_users': self.get_number_of_active_users(),
+                'trips': sum(self.trips_per_day.values()),
+                'signups_per_day': self.get_signups_per_day(),
+                'trips_per_day': Counter(self.trips_per_day),
+            }
+
+
+_live_overviews = OrderedDict()
+_live_overviews_lock = threading.Lock()
+
+
+@timed_query
+@admit('light')
+def get_live_summary(start_date, end_date, trips_start_date, trips_end_date):
+    """The overview counts of the range, brought up to date with what was written since the last call"""
+    key = (start_date, end_date, trips_start_date, trips_end_date)
+    with _live_overviews_lock:
+        overview = _live_overviews.get(key)
+        if overview is None:
+            overview = LiveOverview(*key)
+            _live_overviews[key] = overview
+            if len(_live_overviews) > MAX_LIVE_RANGES:
+                _live_overviews.popitem(last=False)
+        else:
+            _live_overviews.move_to_end(key)
+    overview.refresh()
+    return overview.get_summary()
@@ -0,0 +1,50 @@
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import instrumentation
+
+# The store loaders are I/O bound (they mostly wait on Mongo), and pymongo is thread-safe,
+# so they run on threads. The pool is shared by every request handled by this worker process,
+# which caps the number of concurrent loads (and Mongo connections) per worker.
+MAX_CONCURRENT_LOADERS = int(os.getenv('DASH_MAX_CONCURRENT_LOADERS', '4'))
+
+_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_LOADERS, thread_name_prefix='store-loader')
+
+
+def _timed(name, func, args):
+    start = time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        elapsed = time.perf_counter() - start
+        # shown on the settings page and at /metrics
+        instrumentation.record('loader', name, elapsed)
+        logging.debug("Loader %s took %.3f s" % (name, elapsed))
+
+
+def run_loaders(loaders):
+    """
+    Run independent loaders concurrently and wait for all of them.
+    `loaders` maps a name to a (function, args) pair; returns a dict of name -> result.
+    The total wall time is that of the slowest loader rather than the sum of all of them.
+    If a loader raises, the exception is re-raised here once the others have finished.
+    """
+    start = time.perf_counter()
+    futures = {
+        name: _executor.submit(_timed, name, func, args)
+        for name, (func, args) in loaders.items()
+    }
+    results = {}
+    errors = []
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logging.exception("Loader %s failed" % name)
+            errors.append(e)
+    logging.debug("Ran loaders %s in %.3f s" % (list(loaders), time.perf_counter() - start))
+    if errors:
+        raise errors[0]
+    return results
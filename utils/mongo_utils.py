@@ -0,0 +1,199 @@
+"""
+Database setup for the dashboard's own query patterns:
+- connection pool size and timeouts sized for the dashboard's concurrency
+- the compound indexes that the dashboard queries rely on, verified at warmup (and created if asked to)
+- `explain()` plans logged for the slow queries, so that a missing index shows up in the logs
+"""
+import logging
+import os
+import queue
+import threading
+from urllib.parse import urlencode, urlsplit, parse_qsl, urlunsplit
+
+from pymongo import monitoring
+
+from utils.import_utils import lazy_import
+
+edb = lazy_import('emission.core.get_database')
+
+POOL_OPTIONS = {
+    # the store loaders run concurrently on every gunicorn thread, so the default pool of
+    # 100 is plenty per worker, but we want to fail fast instead of hanging when Mongo is away
+    'maxPoolSize': os.getenv('DB_MAX_POOL_SIZE', '50'),
+    'minPoolSize': os.getenv('DB_MIN_POOL_SIZE', '2'),
+    'maxIdleTimeMS': os.getenv('DB_MAX_IDLE_TIME_MS', '60000'),
+    'waitQueueTimeoutMS': os.getenv('DB_WAIT_QUEUE_TIMEOUT_MS', '10000'),
+    'serverSelectionTimeoutMS': os.getenv('DB_SERVER_SELECTION_TIMEOUT_MS', '10000'),
+    'connectTimeoutMS': os.getenv('DB_CONNECT_TIMEOUT_MS', '10000'),
+    'socketTimeoutMS': os.getenv('DB_SOCKET_TIMEOUT_MS', '120000'),
+}
+
+SLOW_QUERY_MS = int(os.getenv('DB_SLOW_QUERY_MS', '1000'))
+# building an index (especially a 2dsphere one) on a production collection is an operator's
+# decision, so by default the missing indexes are only reported
+CREATE_MISSING_INDEXES = os.getenv('DB_CREATE_INDEXES', 'False').lower() == 'true'
+
+# collection getter -> the indexes (as key lists) that the dashboard queries need
+DASHBOARD_INDEXES = {
+    'get_analysis_timeseries_db': [
+        # confirmed trips in a date range (query_confirmed_trips), and their pages by (start, _id)
+        [('metadata.key', 1), ('data.start_ts', 1), ('_id', 1)],
+        # recreated locations in a date range (query_trajectories)
+        [('metadata.key', 1), ('data.ts', 1)],
+        # first/last trip and trip counts of a user (add_user_stats)
+        [('user_id', 1), ('metadata.key', 1), ('data.end_ts', 1)],
+        # the pages of the trips of a user, by (start, _id)
+        [('user_id', 1), ('metadata.key', 1), ('data.start_ts', 1), ('_id', 1)],
+        # the trajectory of a trip on the user page
+        [('user_id', 1), ('metadata.key', 1), ('data.ts', 1)],
+        # the trips that start or end in the region selected on the map (query_confirmed_trips_in_region)
+        [('data.start_loc', '2dsphere')],
+        [('data.end_loc', '2dsphere')],
+    ],
+    'get_timeseries_db': [
+        # last usercache/get of the users (the active users card)
+        [('metadata.key', 1), ('data.name', 1), ('user_id', 1)],
+        # last server call of a user (add_user_stats), the API calls of the user page
+        [('user_id', 1), ('metadata.key', 1), ('data.ts', 1)],
+    ],
+    'get_uuid_db': [
+        # users who signed up in a date range (query_uuids)
+        [('update_ts', 1)],
+    ],
+}
+
+
+def _with_pool_options(url):
+    if '://' not in url:
+        # a plain host name, e.g. the `db` container
+        url = f"mongodb://{url}/"
+    parts = urlsplit(url)
+    options = dict(parse_qsl(parts.query))
+    for option, value in POOL_OPTIONS.items():
+        # anything already set in the URL wins
+        options.setdefault(option, value)
+    return urlunsplit(parts._replace(path=parts.path or '/', query=urlencode(options)))
+
+
+def configure_connection_pool():
+    """
+    emission creates its MongoClient from a URL, so the pool options are passed as URI options.
+    docker/start.sh writes them into conf/storage/db.conf (see the __main__ below); this covers
+    the setups that pass the URL through DB_HOST, and has to run before
+    emission.core.get_database is first imported.
+    """
+    db_host = os.getenv('DB_HOST')
+    if db_host:
+        os.environ['DB_HOST'] = _with_pool_options(db_host)
+        logging.debug("Configured the connection pool: %s" % POOL_OPTIONS)
+
+
+def log_pool_options():
+    pool_options = edb.get_uuid_db().database.client.options.pool_options
+    logging.info("Mongo pool: max size %s, min size %s, wait queue timeout %s s" % (
+        pool_options.max_pool_size, pool_options.min_pool_size, pool_options.wait_queue_timeout))
+    if str(pool_options.max_pool_size) != POOL_OPTIONS['maxPoolSize']:
+        logging.warning("The Mongo pool options were not applied, check the url in conf/storage/db.conf")
+
+
+def _same_key(index_key, key):
+    # (field, direction) pairs; a hashed index serves the same equality lookups as an ascending one
+    (index_field, index_direction), (field, direction) = index_key, key
+    return index_field == field and (
+        index_direction == direction or {index_direction, direction} == {'hashed', 1}
+    )
+
+
+def _index_exists(index_information, keys):
+    """Whether an existing index starts with the keys, e.g. one of emission's compound indexes"""
+    return any(
+        len(info['key']) >= len(keys) and all(map(_same_key, info['key'][:len(keys)], keys))
+        for info in index_information.values()
+    )
+
+
+def ensure_indexes():
+    """Verify that the indexes the dashboard queries need exist, and create the missing ones"""
+    missing = []
+    for getter, indexes in DASHBOARD_INDEXES.items():
+        collection = getattr(edb, getter)()
+        index_information = collection.index_information()
+        for keys in indexes:
+            if _index_exists(index_information, keys):
+                continue
+            if CREATE_MISSING_INDEXES:
+                logging.info("Creating index %s on %s" % (keys, collection.name))
+                collection.create_index(keys, background=True)
+            else:
+                logging.warning("Missing index %s on %s" % (keys, collection.name))
+                missing.append((collection.name, keys))
+    return missing
+
+
+class SlowQueryExplainer(monitoring.CommandListener):
+    """
+    Keeps the find/aggregate/count commands that took longer than SLOW_QUERY_MS and logs
+    their query plans from a background thread (the listener itself must not block).
+    """
+    EXPLAINABLE = {'find', 'aggregate', 'count', 'distinct'}
+    MAX_PENDING = 1000
+
+    def __init__(self):
+        self._commands = {}
+        self._slow = queue.Queue(maxsize=100)
+        self._thread = None
+
+    def started(self, event):
+        if event.command_name in self.EXPLAINABLE and len(self._commands) < self.MAX_PENDING:
+            self._commands[event.request_id] = (event.database_name, event.command)
+
+    def succeeded(self, event):
+        command = self._commands.pop(event.request_id, None)
+        if command is not None and event.duration_micros / 1000 >= SLOW_QUERY_MS:
+            try:
+                self._slow.put_nowait((command, event.duration_micros / 1000))
+            except queue.Full:
+                pass
+
+    def failed(self, event):
+        self._commands.pop(event.request_id, None)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._explain_loop, name='slow-query-explainer', daemon=True)
+            self._thread.start()
+
+    def _explain_loop(self):
+        while True:
+            (database_name, command), duration_ms = self._slow.get()
+            try:
+                self.explain(database_name, command, duration_ms)
+            except Exception:
+                logging.exception("Unable to explain the slow %s" % next(iter(command)))
+
+    def explain(self, database_name, command, duration_ms):
+        # drop the session and cluster time fields that the driver adds to every command
+        command = {k: v for k, v in command.items() if not k.startswith('$') and k != 'lsid'}
+        database = edb.get_uuid_db().database.client[database_name]
+        plan = database.command('explain', command, verbosity='queryPlanner')
+        winning_plan = plan.get('queryPlanner', plan).get('winningPlan', {})
+        stages = []
+        stage = winning_plan
+        while stage:
+            stages.append(stage.get('stage'))
+            stage = stage.get('inputStage')
+        log = logging.warning if 'COLLSCAN' in stages else logging.info
+        log("Slow %s on %s (%.0f ms): plan %s, filter %s" % (
+            next(iter(command)), command.get(next(iter(command))), duration_ms,
+            ' <- '.join(str(s) for s in stages), command.get('filter', command.get('pipeline'))))
+
+
+slow_query_explainer = SlowQueryExplainer()
+# like the instrumentation, this only applies to the clients created after this import
+monitoring.register(slow_query_explainer)
+
+
+if __name__ == '__main__':
+    # used by docker/start.sh to write the url of conf/storage/db.conf
+    import sys
+    print(_with_pool_options(sys.argv[1]))
@@ -1,5 +1,7 @@
 import json
 import os
+import threading
+from types import MappingProxyType
 
 import requests
 import logging
@@ -9,100 +11,170 @@ from utils import constants
 STUDY_CONFIG = os.getenv('STUDY_CONFIG')
 PATH = os.getenv('CONFIG_PATH')
 CONFIG_URL = PATH + STUDY_CONFIG + ".nrel-op.json"
-response = requests.get(CONFIG_URL)
-config = json.loads(response.text)
-surveyinfo = config.get("survey_info",
-    {
-      "surveys": {
-        "UserProfileSurvey": {
-          "formPath": "json/demo-survey-v2.json",
-          "version": 1,
-          "compatibleWith": 1,
-          "dataKey": "manual/demographic_survey",
-          "labelTemplate": {
-            "en": "Answered",
-            "es": "Contestada"
-          }
-        }
-      },
-      "trip-labels": "MULTILABEL"
-    })
-permissions = config.get("admin_dashboard", {})
-
-# TODO: The current dynamic config does not have the data_demographics_columns_exclude.
-# When all the current studies are completed we can remove the below changes.
-if 'data_demographics_columns_exclude' not in permissions:
-    permissions['data_demographics_columns_exclude'] = []
-if 'data_trajectories_columns_exclude' not in permissions:
-    permissions['data_trajectories_columns_exclude'] = []
+
+DEFAULT_SURVEY_INFO = {
+  "surveys": {
+    "UserProfileSurvey": {
+      "formPath": "json/demo-survey-v2.json",
+      "version": 1,
+      "compatibleWith": 1,
+      "dataKey": "manual/demographic_survey",
+      "labelTemplate": {
+        "en": "Answered",
+        "es": "Contestada"
+      }
+    }
+  },
+  "trip-labels": "MULTILABEL"
+}
+
+# Bumped every time the config is (re)loaded, so that anything derived from it
+# (e.g. the compiled permission profile) knows when it has to be rebuilt
+config_version = 0
+_config_lock = threading.Lock()
+
+
+def set_config(new_config):
+    global config, surveyinfo, permissions, config_version
+    config = new_config
+    surveyinfo = config.get("survey_info", DEFAULT_SURVEY_INFO)
+    permissions = config.get("admin_dashboard", {})
+
+    # TODO: The current dynamic config does not have the data_demographics_columns_exclude.
+    # When all the current studies are completed we can remove the below changes.
+    if 'data_demographics_columns_exclude' not in permissions:
+        permissions['data_demographics_columns_exclude'] = []
+    if 'data_trajectories_columns_exclude' not in permissions:
+        permissions['data_trajectories_columns_exclude'] = []
+    config_version += 1
+    logging.debug("Loaded config version %s from %s" % (config_version, CONFIG_URL))
+
+
+def load_config():
+    response = requests.get(CONFIG_URL)
+    set_config(json.loads(response.text))
+
+
+def ensure_config():
+    """
+    The config is fetched over HTTP, so it is loaded on first use (or by the warmup)
+    instead of when this module is imported
+    """
+    if config_version == 0:
+        with _config_lock:
+            if config_version == 0:
+                load_config()
+
+
+def __getattr__(name):
+    # `config`, `surveyinfo` and `permissions` only exist once the config has been loaded
+    if name in ('config', 'surveyinfo', 'permissions'):
+        ensure_config()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 def has_permission(perm):
+    ensure_config()
     return False if permissions.get(perm) is False else True
 
 
 def get_allowed_named_trip_columns():
-    if surveyinfo["trip-labels"] == "MULTILABEL":
-        return constants.MULTILABEL_NAMED_COLS
-    elif surveyinfo["trip-labels"] == "ENKETO":
-        # TODO: Figure out how to specify these
-        # can we re-use the existing labels in survey_info
-        # if not, we should add the label paths to survey info
-        # since the paths are survey info and not permissions
-        # we should also make sure that there are sufficient examples
-        # of this
-        return permissions.get('additional_trip_columns', [])
+    return [dict(col) for col in get_permission_profile().allowed_named_trip_columns]
 
-def get_required_columns():
-    required_cols = {'user_id'}
-    required_cols.update(col['path'] for col in constants.REQUIRED_NAMED_COLS)
-    return required_cols
 
+def get_required_columns():
+    return set(get_permission_profile().required_columns)
 
-def get_all_named_trip_columns():
-    named_columns = [item for item in constants.REQUIRED_NAMED_COLS]
-    named_columns.extend(
-        get_allowed_named_trip_columns()
-    )
-    return named_columns
 
 def get_all_trip_columns():
-    columns = set()
-    # logging.debug("get_all_trip_columns: curr set is %s" % columns)
-    columns.update(get_allowed_trip_columns())
-    # logging.debug("get_all_trip_columns: curr set is %s" % columns)
-    columns.update(
-        col['path'] for col in get_allowed_named_trip_columns()
-    )
-    # logging.debug("get_all_trip_columns: curr set is %s" % columns)
-
-    columns.update(get_required_columns())
-    # logging.debug("get_all_trip_columns: curr set is %s" % columns)
-    return columns
+    return set(get_permission_profile().all_trip_columns)
 
 
 def get_allowed_trip_columns():
-    columns = set(constants.VALID_TRIP_COLS)
-    for column in permissions.get("data_trips_columns_exclude", []):
-        columns.discard(column)
-    return columns
+    return set(get_permission_profile().allowed_trip_columns)
 
 
 def get_uuids_columns():
-    columns = set(constants.valid_uuids_columns)
-    for column in permissions.get("data_uuids_columns_exclude", []):
-        columns.discard(column)
-    return columns
+    return set(get_permission_profile().uuids_columns)
+
 
 def get_demographic_columns(columns):
-    for column in permissions.get("data_demographics_columns_exclude", []):
-        columns.discard(column)
-    return columns
+    return set(columns) - get_permission_profile().demographics_columns_exclude
+
 
 def get_trajectories_columns(columns):
-    columns = set(columns)
-    for column in permissions.get("data_trajectories_columns_exclude", []):
-        columns.discard(column)
-    return columns
+    return set(columns) - get_permission_profile().trajectories_columns_exclude
+
 
 def get_token_prefix():
+    ensure_config()
     return permissions['token_prefix'] + '_' if permissions.get('token_prefix') else ''
+
+
+class PermissionProfile:
+    """
+    The column sets derived from `constants` and the `admin_dashboard` section of the config.
+    They only change when the config does, so they are computed once per config version
+    instead of on every query and every table render. All the members are immutable (tuples,
+    frozensets and read-only mappings, copied from the config) so the profile can be shared
+    across callbacks and threads.
+    """
+    def __init__(self, version):
+        self.version = version
+
+        if surveyinfo["trip-labels"] == "MULTILABEL":
+            allowed_named_cols = constants.MULTILABEL_NAMED_COLS
+        elif surveyinfo["trip-labels"] == "ENKETO":
+            # TODO: Figure out how to specify these
+            # can we re-use the existing labels in survey_info
+            # if not, we should add the label paths to survey info
+            # since the paths are survey info and not permissions
+            # we should also make sure that there are sufficient examples
+            # of this
+            allowed_named_cols = permissions.get('additional_trip_columns', [])
+        else:
+            allowed_named_cols = []
+        # copies, so that the columns of constants and of the config cannot be changed through the profile
+        self.allowed_named_trip_columns = tuple(MappingProxyType(dict(col)) for col in allowed_named_cols)
+
+        # path -> label for every named column, used to rename the query results
+        self.trip_rename_map = MappingProxyType({col['path']: col['label'] for col in self.allowed_named_trip_columns})
+
+        self.required_columns = frozenset(constants.REQUIRED_TRIP_COLS)
+        self.trips_columns_exclude = frozenset(permissions.get("data_trips_columns_exclude", []))
+        self.allowed_trip_columns = frozenset(constants.VALID_TRIP_COLS) - self.trips_columns_exclude
+        self.all_trip_columns = (
+            self.allowed_trip_columns
+            | frozenset(col['path'] for col in self.allowed_named_trip_columns)
+            | self.required_columns
+        )
+        # the columns that the Data page shows for trips: the allowed raw columns, the
+        # labels (not the paths) of the allowed named columns and the humanized duration
+        self.trips_table_columns = self.allowed_trip_columns | frozenset(
+            col['label'] for col in self.allowed_named_trip_columns
+        )
+        if 'data.duration' in self.allowed_trip_columns:
+            self.trips_table_columns |= {'data.duration_humanized'}
+        # the coordinates are loaded as separate lon and lat columns
+        for col, split_cols in constants.COORDINATE_COLS.items():
+            if col in self.trips_table_columns:
+                self.trips_table_columns |= set(split_cols)
+
+        self.uuids_columns_exclude = frozenset(permissions.get("data_uuids_columns_exclude", []))
+        self.uuids_columns = frozenset(constants.valid_uuids_columns) - self.uuids_columns_exclude
+
+        self.demographics_columns_exclude = frozenset(permissions.get("data_demographics_columns_exclude", []))
+        self.trajectories_columns_exclude = frozenset(permissions.get("data_trajectories_columns_exclude", []))
+
+
+_permission_profile = None
+
+
+def get_permission_profile():
+    global _permission_profile
+    ensure_config()
+    if _permission_profile is None or _permission_profile.version != config_version:
+        logging.debug("Compiling the permission profile for config version %s" % config_version)
+        _permission_profile = PermissionProfile(config_version)
+    return _permission_profile
@@ -0,0 +1,143 @@
+"""
+Columnar encoding of the dataframes that we ship to the browser in dcc.Store components.
+
+`df.to_dict("records")` repeats every column name in every row. Instead, each column is sent
+once as an array, with
+- low-cardinality string columns dictionary-encoded (a list of distinct values + integer codes)
+- [lon, lat] style pair columns split into two float arrays
+- datetime columns as epoch milliseconds
+and, optionally, the whole payload zlib-compressed and base64-encoded.
+
+All the producers use `encode_frame` and all the consumers use `decode_frame`, so the store
+layout can change without touching the pages.
+"""
+import base64
+import json
+import os
+import zlib
+
+import numpy as np
+import pandas as pd
+
+STORE_FORMAT = 'columnar'
+COMPRESS_STORES = os.getenv('DASH_STORE_COMPRESSION', 'False').lower() == 'true'
+
+# only dictionary-encode when at least half of the values are repeats
+MAX_DICTIONARY_RATIO = 0.5
+
+
+def _is_pair(value):
+    return isinstance(value, (list, tuple)) and len(value) == 2
+
+
+def _encode_column(name, series):
+    if pd.api.types.is_datetime64_any_dtype(series):
+        millis = series.values.astype('datetime64[ms]').astype('int64')
+        return {
+            'name': name,
+            'kind': 'datetime',
+            'utc': getattr(series.dt, 'tz', None) is not None,
+            'values': np.where(series.isna(), None, millis).tolist(),
+        }
+    if series.dtype == object and len(series) > 0:
+        if series.map(_is_pair).all():
+            try:
+                pairs = np.array(series.tolist(), dtype=float)
+                return {'name': name, 'kind': 'pairs', 'first': pairs[:, 0].tolist(), 'second': pairs[:, 1].tolist()}
+            except (TypeError, ValueError):
+                # not numeric pairs
+                pass
+        try:
+            codes, uniques = pd.factorize(series)
+        except TypeError:
+            # unhashable values (e.g. dicts), send them as they are
+            codes, uniques = None, None
+        if uniques is not None and len(uniques) <= MAX_DICTIONARY_RATIO * len(series):
+            return {'name': name, 'kind': 'dictionary', 'codes': codes.tolist(), 'dictionary': uniques.tolist()}
+    return {'name': name, 'kind': 'values', 'values': series.tolist()}
+
+
+def _decode_column(column):
+    kind = column['kind']
+    if kind == 'datetime':
+        values = pd.to_datetime(pd.Series(column['values'], dtype='float64'), unit='ms', utc=True)
+        return values if column['utc'] else values.dt.tz_localize(None)
+    if kind == 'pairs':
+        return pd.Series([[first, second] for first, second in zip(column['first'], column['second'])], dtype=object)
+    if kind == 'dictionary':
+        # the code for missing values is -1, which picks the trailing None
+        dictionary = np.array(column['dictionary'] + [None], dtype=object)
+        return pd.Series(dictionary[np.asarray(column['codes'], dtype=int)], dtype=object)
+    return pd.Series(column['values'])
+
+
+def encode_frame(df, compress=COMPRESS_STORES):
+    """Encode a dataframe into the (JSON serializable) store format"""
+    df = df.reset_index(drop=True)
+    encoded = {
+        'format': STORE_FORMAT,
+        'columns': [_encode_column(str(name), df[name]) for name in df.columns],
+    }
+    if compress:
+        payload = zlib.compress(json.dumps(encoded, default=str).encode('utf-8'))
+        encoded = {'format': STORE_FORMAT, 'compressed': base64.b64encode(payload).decode('ascii')}
+    encoded['length'] = len(df)
+    return encoded
+
+
+def decode_frame(store):
+    """Decode a store created by `encode_frame` back into a dataframe"""
+    if not store or store.get('format') != STORE_FORMAT:
+        # the initial (empty) store
+        return pd.DataFrame()
+    if 'compressed' in store:
+        store = json.loads(zlib.decompress(base64.b64decode(store['compressed'])))
+    columns = store['columns']
+    if not columns:
+        return pd.DataFrame()
+    return pd.DataFrame({column['name']: _decode_column(column) for column in columns})
+
+
+def encode_frames(dataframes):
+    """Encode a dict of dataframes, e.g. the demographics (one dataframe per survey)"""
+    return {key: encode_frame(df) for key, df in dataframes.items()}
+
+
+def decode_frames(stores):
+    return {key: decode_frame(store) for key, store in stores.items()}
+
+
+AGGREGATES_FORMAT = 'aggregates'
+
+
+def encode_aggregates(aggregates, length):
+    """
+    Encode the aggregates that stand in for the rows of a large range (a dict of dataframes,
+    see db_utils.query_trip_aggregates); `length` is the number of rows they summarize.
+    """
+    return {
+        'format': AGGREGATES_FORMAT,
+        'aggregates': encode_frames(aggregates),
+        'length': length,
+    }
+
+
+def is_aggregated(store):
+    return bool(store) and store.get('format') == AGGREGATES_FORMAT
+
+
+def is_stale(store, date_range):
+    # the stores are stamped with the version of the range they were loaded for (see update_stores)
+    return bool(store) and store.get('version') != date_range.get('version')
+
+
+def get_store_date_range(store):
+    """The date range (as in store-date-range) that the store was loaded for"""
+    start_date, end_date = (None if part == 'None' else part for part in store['version'].split('/'))
+    return {'start_date': start_date, 'end_date': end_date, 'version': store['version']}
+
+
+def decode_aggregates(store):
+    if not is_aggregated(store):
+        return {}
+    return decode_frames(store['aggregates'])
@@ -0,0 +1,91 @@
+"""
+Warmup of the configuration and caches before a server process starts taking traffic, and the
+health/readiness endpoints that report on it.
+
+The warmup is split in two because pymongo clients are not fork-safe:
+- `warmup_process` (config, permission profile, JWKS) has no database connection, so with
+  gunicorn --preload it runs once in the master and the workers inherit the result
+- `warmup_caches` (pool, indexes, user list, demographics) connects to the database, so
+  it runs in every worker after the fork, in the background (`start_warmup_caches`): on a
+  slow database it could otherwise take longer than the gunicorn timeout, and the worker
+  would be killed and restarted before it ever took a request. /readyz says when it is done.
+"""
+import logging
+import os
+import threading
+import time
+
+import flask
+
+from utils import permissions as perm_utils
+
+# step name -> seconds it took, or the error message if it failed
+warmup_state = {
+    'process_ready': False,
+    'caches_ready': False,
+    'steps': {},
+}
+
+
+def _run_step(name, func):
+    start = time.perf_counter()
+    try:
+        func()
+        warmup_state['steps'][name] = round(time.perf_counter() - start, 3)
+        return True
+    except Exception as e:
+        logging.exception("Warmup step %s failed" % name)
+        warmup_state['steps'][name] = f"failed: {e}"
+        return False
+
+
+def _prime_jwks():
+    if os.getenv('AUTH_TYPE') == 'cognito':
+        from utils import decode_jwt
+        decode_jwt.get_keys()
+
+
+def warmup_process():
+    ok = _run_step('config', perm_utils.ensure_config)
+    ok = _run_step('permission_profile', perm_utils.get_permission_profile) and ok
+    ok = _run_step('jwks', _prime_jwks) and ok
+    warmup_state['process_ready'] = ok
+    return ok
+
+
+def warmup_caches():
+    from utils import db_utils, mongo_utils
+    ok = _run_step('mongo_pool', mongo_utils.log_pool_options)
+    # only reported: a missing index makes the queries slower, not wrong
+    _run_step('indexes', mongo_utils.ensure_indexes)
+    mongo_utils.slow_query_explainer.start()
+    ok = _run_step('all_uuids', db_utils.query_all_uuids) and ok
+    ok = _run_step('demographics', db_utils.query_demographics) and ok
+    warmup_state['caches_ready'] = ok
+    return ok
+
+
+def start_warmup_caches():
+    def run():
+        if not warmup_caches():
+            logging.warning("Process %s started with cold caches, see /readyz" % os.getpid())
+    thread = threading.Thread(target=run, name='warmup-caches', daemon=True)
+    thread.start()
+    return thread
+
+
+def is_ready():
+    return warmup_state['process_ready'] and warmup_state['caches_ready']
+
+
+def init_health_checks(server):
+    @server.route('/healthz')
+    def healthz():
+        # liveness: the process is up and serving requests
+        return flask.jsonify(status='ok')
+
+    @server.route('/readyz')
+    def readyz():
+        # readiness: the config and caches are warm
+        status = 200 if is_ready() else 503
+        return flask.jsonify(ready=is_ready(), **warmup_state), status
@@ -0,0 +1,18 @@
+"""
+Production entry point, served by gunicorn with the settings in gunicorn.conf.py:
+
+    gunicorn -c gunicorn.conf.py wsgi:server
+
+With preload_app, this module is imported once in the gunicorn master, so the app, the config,
+the permission profile and the JWKS are loaded once and shared by the forked workers.
+The database-backed caches are warmed in every worker (see post_worker_init in gunicorn.conf.py).
+"""
+from app_sidebar_collapsible import app, server
+from utils.warmup import warmup_process
+
+server.config.update(
+    SESSION_COOKIE_SECURE=True,
+    SESSION_COOKIE_HTTPONLY=True
+)
+
+warmup_process()